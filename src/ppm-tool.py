@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Guenther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Command line tools to handle prepaid SIM cards without the GUI"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+import ppm
+from ppm.modemproxy import (ModemManagerProxy, USSD_SESSION_TIMEOUT,
+                            MM_DBUS_TIMEOUT)
+from ppm.ussdbatch import UssdBatch
+from ppm.history import BalanceHistory
+from ppm.governor import UssdGovernor
+from ppm.journal import Journal
+from ppm.accountdb import AccountDB
+from ppm.providerdb import ProviderDB
+from ppm.workers import (Worker, Supervisor)
+from ppm.benchmark import Benchmark
+from ppm.simulator import ModemManagerSimulator
+from ppm.timeouts import AdaptiveTimeouts
+from ppm import export
+from ppm import forecast
+from ppm import profiling
+
+from gi.repository import Gio
+from gi.repository import GLib
+
+
+def open_input(path):
+    """Open path as Gio.InputStream, '-' is stdin"""
+    if path == '-':
+        return Gio.UnixInputStream.new(sys.stdin.fileno(), False)
+    return Gio.File.new_for_commandline_arg(path).read(None)
+
+
+def cmd_ussd(options):
+    loop = GLib.MainLoop()
+    governor = UssdGovernor.from_settings(AccountDB().settings)
+    batch = UssdBatch(ModemManagerProxy(governor=governor),
+                      open_input(options.input),
+                      sys.stdout,
+                      loop,
+                      timeout=options.timeout)
+    batch.start()
+    loop.run()
+    return 1 if batch.failed else 0
+
+
+def parse_time(value):
+    """Parse an ISO 8601 date or date and time into seconds since the epoch"""
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '%s'" % value)
+
+
+def cmd_export(options):
+    history = BalanceHistory(options.history)
+    records = history.records(since=options.since,
+                              until=options.until,
+                              providers=options.providers,
+                              identifiers=options.accounts)
+    if options.output == '-':
+        count = export.export(records, sys.stdout, options.format)
+    else:
+        with open(options.output, 'w', newline='') as output:
+            count = export.export(records, output, options.format)
+    logging.debug("Exported %d records", count)
+    return 0
+
+
+def cmd_forecast(options):
+    if not forecast.available():
+        logging.error("Forecasting needs NumPy")
+        return 1
+
+    since = options.since
+    if since is None:
+        since = time.time() - options.days * forecast.SECONDS_PER_DAY
+    history = BalanceHistory(options.history)
+    forecasts = forecast.forecast(history.records(since=since,
+                                                  providers=options.providers,
+                                                  identifiers=options.accounts))
+    if options.before is not None:
+        forecasts = forecast.running_dry(forecasts, options.before)
+
+    for f in forecasts:
+        row = f._asdict()
+        if f.empty_at is not None:
+            row['empty_at'] = export.isotime(f.empty_at)
+        sys.stdout.write(json.dumps(row, ensure_ascii=False) + '\n')
+    return 0
+
+
+def check_refresh_interval(accountdb):
+    if not accountdb.refresh_interval:
+        logging.error("Continuous refreshes need a refresh-interval in "
+                      "GSettings")
+        return False
+    return True
+
+
+def cmd_worker(options):
+    loop = GLib.MainLoop()
+    accountdb = AccountDB()
+    if options.continuous and not check_refresh_interval(accountdb):
+        return 1
+    worker = Worker(options.shard, options.shards, ProviderDB(), accountdb,
+                    sys.stdout, loop, continuous=options.continuous)
+    worker.start()
+    loop.run()
+    return 0
+
+
+def cmd_supervise(options):
+    loop = GLib.MainLoop()
+    worker_argv = [sys.executable, os.path.abspath(__file__)]
+    if options.debug:
+        worker_argv.append('--debug')
+    worker_argv.append('worker')
+    accountdb = AccountDB(delay=True)
+    if options.continuous:
+        if not check_refresh_interval(accountdb):
+            return 1
+        worker_argv.append('--continuous')
+    journal = Journal(accountdb, name='supervise')
+    journal.replay()
+    timeouts = AdaptiveTimeouts(MM_DBUS_TIMEOUT)
+    timeouts.load()
+    supervisor = Supervisor(worker_argv, options.workers, accountdb,
+                            BalanceHistory(), loop,
+                            result_func=lambda result: logging.info(
+                                "%s: %s", result['modem'],
+                                result['error'] or result['balance']),
+                            journal=journal,
+                            timeouts=timeouts)
+    supervisor.start()
+    loop.run()
+    journal.close()
+    timeouts.save()
+    logging.debug("Got %d results, %d failed", supervisor.results,
+                  supervisor.failed)
+    return 1 if supervisor.failed else 0
+
+
+def cmd_bench(options):
+    # Keep the user's accounts out of it
+    os.environ['GSETTINGS_BACKEND'] = 'memory'
+    accountdb = AccountDB()
+    simulator_argv = [sys.executable, os.path.abspath(__file__)]
+    if options.debug:
+        simulator_argv.append('--debug')
+    simulator_argv += ['simulate',
+                       '--modems', str(options.modems),
+                       '--latency', str(options.latency),
+                       '--sigma', str(options.sigma),
+                       '--error-rate', str(options.error_rate)]
+    if options.seed is not None:
+        simulator_argv += ['--seed', str(options.seed)]
+
+    governor_func = None
+    if options.governor:
+        governor_func = lambda: UssdGovernor.from_settings(accountdb.settings)
+
+    def print_result(result):
+        sys.stdout.write(json.dumps(result) + '\n')
+        sys.stdout.flush()
+
+    benchmark = Benchmark(simulator_argv, accountdb,
+                          governor_func=governor_func,
+                          deadline=options.deadline)
+    results = benchmark.run(options.cycles, result_func=print_result)
+    return 1 if any(result['error'] for result in results) else 0
+
+
+def cmd_simulate(options):
+    loop = GLib.MainLoop()
+    connection = Gio.DBusConnection.new_for_address_sync(
+        options.address,
+        Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+        Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+        None, None)
+    simulator = ModemManagerSimulator(connection, options.modems,
+                                      latency=options.latency,
+                                      sigma=options.sigma,
+                                      error_rate=options.error_rate,
+                                      seed=options.seed)
+    simulator.start()
+    sys.stdout.write('ready\n')
+    sys.stdout.flush()
+    loop.run()
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='ppm-tool',
+                                     description=__doc__)
+    parser.add_argument("--debug", "-d", action="store_true",
+                        help="enable debugging")
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s " + ppm.version)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write cProfile data to FILE and a timeline of "
+                             "phases to FILE.spans on exit")
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.required = True
+
+    ussd = subparsers.add_parser(
+        'ussd',
+        help="send raw USSD commands",
+        description="Send raw USSD commands read line by line as "
+                    "'<modem|imsi> <command>' and print the results as "
+                    "JSON lines")
+    ussd.add_argument("input", nargs='?', default='-',
+                      help="file to read the commands from, default: stdin")
+    ussd.add_argument("--timeout", type=int, default=USSD_SESSION_TIMEOUT,
+                      help="seconds to wait for a reply, default: %(default)s")
+    ussd.set_defaults(func=cmd_ussd)
+
+    exp = subparsers.add_parser(
+        'export',
+        help="export the balance history",
+        description="Export the balance history ordered by time")
+    exp.add_argument("--format", "-f", choices=export.FORMATS, default='csv',
+                     help="output format, default: %(default)s")
+    exp.add_argument("--output", "-o", default='-',
+                     help="file to write to, default: stdout")
+    exp.add_argument("--since", type=parse_time,
+                     help="only balances from this date (ISO 8601) on")
+    exp.add_argument("--until", type=parse_time,
+                     help="only balances before this date (ISO 8601)")
+    exp.add_argument("--provider", dest='providers', action='append',
+                     help="only balances of this provider, can be repeated")
+    exp.add_argument("--account", dest='accounts', action='append',
+                     help="only balances of this account, can be repeated")
+    exp.add_argument("--history", default=None,
+                     help="balance history database to use")
+    exp.set_defaults(func=cmd_export)
+
+    fc = subparsers.add_parser(
+        'forecast',
+        help="predict when accounts run out of credit",
+        description="Predict from the balance history when accounts run "
+                    "out of credit and print the results as JSON lines")
+    fc.add_argument("--before", type=parse_time,
+                    help="only accounts running out of credit before this "
+                         "date (ISO 8601), soonest first")
+    fc.add_argument("--since", type=parse_time,
+                    help="only use balances from this date (ISO 8601) on")
+    fc.add_argument("--days", type=int, default=90,
+                    help="only use balances of the last days unless --since "
+                         "is given, default: %(default)s")
+    fc.add_argument("--provider", dest='providers', action='append',
+                    help="only accounts of this provider, can be repeated")
+    fc.add_argument("--account", dest='accounts', action='append',
+                    help="only this account, can be repeated")
+    fc.add_argument("--history", default=None,
+                    help="balance history database to use")
+    fc.set_defaults(func=cmd_forecast)
+
+    supervise = subparsers.add_parser(
+        'supervise',
+        help="refresh all balances using several processes",
+        description="Refresh the balances of all modems. The modems are "
+                    "split into shards each handled by a worker process, "
+                    "results get stored by this process only")
+    supervise.add_argument("--workers", "-j", type=int,
+                           default=os.cpu_count() or 1,
+                           help="number of worker processes, "
+                                "default: %(default)s")
+    supervise.add_argument("--continuous", action="store_true",
+                           help="keep refreshing balances when they're due")
+    supervise.set_defaults(func=cmd_supervise)
+
+    worker = subparsers.add_parser(
+        'worker',
+        help="refresh the balances of one shard of the modems",
+        description="Refresh the balances of the modems in one shard and "
+                    "print the results as JSON lines. This is usually "
+                    "started by 'supervise'")
+    worker.add_argument("--shard", type=int, required=True,
+                        help="the shard to handle, starting at 0")
+    worker.add_argument("--shards", type=int, required=True,
+                        help="total number of shards")
+    worker.add_argument("--continuous", action="store_true",
+                        help="keep refreshing balances when they're due")
+    worker.set_defaults(func=cmd_worker)
+
+    bench = subparsers.add_parser(
+        'bench',
+        help="benchmark balance refreshes",
+        description="Refresh the balances of simulated modems on a private "
+                    "message bus and print the timings of each cycle as "
+                    "JSON lines")
+    simulate = subparsers.add_parser(
+        'simulate',
+        help="simulate ModemManager",
+        description="Serve simulated modems on a message bus. This is "
+                    "usually started by 'bench'")
+    simulate.add_argument("--address", required=True,
+                          help="address of the message bus")
+    for p in [bench, simulate]:
+        p.add_argument("--modems", "-n", type=int, default=100,
+                       help="number of modems, default: %(default)s")
+        p.add_argument("--latency", type=int, default=500,
+                       help="median USSD latency in milliseconds, "
+                            "default: %(default)s")
+        p.add_argument("--sigma", type=float, default=0.5,
+                       help="spread of the log-normal latency distribution, "
+                            "0 for a fixed latency, default: %(default)s")
+        p.add_argument("--error-rate", type=float, default=0.0,
+                       help="fraction of failing USSD requests, "
+                            "default: %(default)s")
+        p.add_argument("--seed", type=int,
+                       help="seed for the random latencies and errors")
+    bench.add_argument("--cycles", "-c", type=int, default=1,
+                       help="number of refresh cycles, default: %(default)s")
+    bench.add_argument("--governor", action="store_true",
+                       help="limit the USSD traffic as configured in "
+                            "GSettings")
+    bench.add_argument("--deadline", type=int,
+                       default=Benchmark.CYCLE_DEADLINE,
+                       help="seconds a cycle may take, default: %(default)s")
+    bench.set_defaults(func=cmd_bench)
+    simulate.set_defaults(func=cmd_simulate)
+
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    options = parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if options.debug else logging.INFO,
+                        format='ppm-tool: %(levelname)s: %(message)s',
+                        stream=sys.stderr)
+    logging.debug("%s %s", ppm.app_id, ppm.version)
+    if options.profile:
+        profiling.enable(options.profile)
+    return options.func(options)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv))
+    except KeyboardInterrupt:
+        logging.debug("Received KeyboardInterrupt. Exiting.")
+        sys.exit(130)
@@ -18,6 +18,99 @@ from builtins import object
 from gi.repository import Gio
 from gi.repository import GObject
 import logging
+import re
+import time
+
+
+# Month names as written by time.asctime() independent of the locale
+_MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+           'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+# Numbers with optional thousands separators and decimals
+_AMOUNT_RE = re.compile(r"[-+]?[1-9]\d{0,2}([.,'\u00a0\u202f])\d{3}"
+                        r"(?:\1\d{3})*"
+                        r"(?:(?!\1)[.,]\d+)?(?![\d.,]\d)"
+                        r"|[-+]?\d+(?:[.,]\d+)?")
+# Parts of dates and times rather than amounts
+_DATE_RE = re.compile(r'\d[.:/-]$|^[.:/-]\d')
+_CURRENCY = (r"(?:[€$£¥₽₺₹]|\b(?:EUR|USD|GBP|CHF|PLN|CZK|SEK|NOK|DKK|HUF|"
+             r"RON|BGN|RUB|UAH|TRY|INR|BRL|MXN|ZAR|AUD|CAD|NZD|"
+             r"euros?|cents?|kr|lei|zł|Kč|Ft|руб)(?!\w))")
+_CURRENCY_BEFORE_RE = re.compile(_CURRENCY + r'\s*$', re.IGNORECASE)
+_CURRENCY_AFTER_RE = re.compile(r'^\s*' + _CURRENCY, re.IGNORECASE)
+_BALANCE_RE = re.compile(r'\b(?:balance|credit|guthaben|saldo|solde|'
+                         r'credito|crédito|kredit|остаток|баланс)\b',
+                         re.IGNORECASE)
+
+
+def _parse_amount(m):
+    """Turn a match of L{_AMOUNT_RE} into a float"""
+    amount = m.group(0)
+    if m.group(1):
+        # Drop the thousands separators, what's left is the decimal mark
+        amount = amount.replace(m.group(1), '')
+    return float(amount.replace(',', '.'))
+
+
+def parse_balance(balance):
+    """
+    Extract the amount from a provider's balance message
+
+    This is a heuristic: providers send free form text that can mention
+    tariffs, dates or bonuses as well. Numbers next to a currency win,
+    then the first number after a keyword like "balance". A message with
+    a single number is taken as is.
+
+    @return: the amount or C{None} if there's no number in the message or
+        it's unclear which one is the balance
+    @rtype: C{float}
+    """
+    if not balance:
+        return None
+    candidates = []
+    for m in _AMOUNT_RE.finditer(balance):
+        (start, end) = m.span()
+        if (_DATE_RE.search(balance[max(start - 2, 0):start]) or
+                _DATE_RE.search(balance[end:end + 2])):
+            continue
+        currency = (_CURRENCY_BEFORE_RE.search(balance[:start]) or
+                    _CURRENCY_AFTER_RE.search(balance[end:]))
+        candidates.append((start, _parse_amount(m), bool(currency)))
+    if not candidates:
+        return None
+
+    after_keyword = set()
+    for k in _BALANCE_RE.finditer(balance):
+        following = [c for c in candidates if c[0] >= k.end()]
+        if following:
+            after_keyword.add(following[0])
+
+    with_currency = [c for c in candidates if c[2]]
+    for preferred in (with_currency, list(after_keyword), candidates):
+        amounts = set(c[1] for c in preferred)
+        if len(amounts) == 1:
+            return amounts.pop()
+        if len(amounts) > 1:
+            # Several amounts, use the one the keyword points at
+            amounts = set(c[1] for c in preferred if c in after_keyword)
+            return amounts.pop() if len(amounts) == 1 else None
+    return None
+
+
+def parse_timestamp(timestamp):
+    """
+    Turn a timestamp as stored in the account into seconds since the epoch
+
+    @return: the timestamp or C{None} if it can't be parsed
+    @rtype: C{float}
+    """
+    try:
+        (_, month, day, clock, year) = timestamp.split()
+        (hour, minute, second) = clock.split(':')
+        return time.mktime((int(year), _MONTHS.index(month) + 1, int(day),
+                            int(hour), int(minute), int(second), 0, 0, -1))
+    except (AttributeError, ValueError):
+        return None
 
 
 class Account(GObject.GObject):
@@ -36,6 +129,13 @@ class Account(GObject.GObject):
     timestamp = GObject.property(type=str,
                                  nick='update timestamp',
                                  blurb='last time the balance info got updated')
+    threshold = GObject.property(type=float,
+                                 default=-1.0,
+                                 nick='low balance threshold',
+                                 blurb='balance below which the account is low')
+    min_interval = GObject.property(type=GObject.TYPE_UINT,
+                                    nick='minimum refresh interval',
+                                    blurb='minimum seconds between two balance refreshes')
 
     def update_provider(self, provider):
         """Update the provider information"""
@@ -50,6 +150,16 @@ class Account(GObject.GObject):
             self.props.balance = balance
             self.props.timestamp = timestamp
 
+    @property
+    def amount(self):
+        """The balance as number"""
+        return parse_balance(self.props.balance)
+
+    @property
+    def updated(self):
+        """Time of the last balance update in seconds since the epoch"""
+        return parse_timestamp(self.props.timestamp)
+
 
 class AccountDB(object):
     """
@@ -61,9 +171,52 @@ class AccountDB(object):
     PPM_GSETTINGS_ID = 'org.gnome.PrepaidManager'
     PPM_GSETTINGS_ACCOUNT_ID = PPM_GSETTINGS_ID + '.account'
 
-    def __init__(self):
+    def __init__(self, delay=False):
+        """
+        @param delay: keep changes to accounts in memory until L{apply}
+            gets called, see L{ppm.journal.Journal}
+        """
+        self.delay = delay
+        self.accounts = {}
         self.settings = Gio.Settings(self.PPM_GSETTINGS_ID)
         self.accounts_path_prefix = self.settings.get_property("path") + 'accounts/'
+        self._thresholds = None
+        self.settings.connect('changed::low-balance-thresholds',
+                              self.on_thresholds_changed)
+
+    def on_thresholds_changed(self, settings, key):
+        self._thresholds = None
+
+    @property
+    def balance_max_age(self):
+        """Seconds a stored balance is considered current"""
+        return self.settings.get_uint('balance-max-age')
+
+    @property
+    def refresh_interval(self):
+        """Seconds between refreshes of a steady balance, 0 if disabled"""
+        return self.settings.get_uint('refresh-interval')
+
+    @property
+    def refresh_min_interval(self):
+        """Minimum seconds between two refreshes of an account"""
+        return self.settings.get_uint('refresh-min-interval')
+
+    @property
+    def low_balance_hook(self):
+        """Command to run when a balance gets low"""
+        return self.settings.get_string('low-balance-hook')
+
+    @property
+    def low_balance_debounce(self):
+        """Minimum seconds between two low balance alerts of an account"""
+        return self.settings.get_uint('low-balance-debounce')
+
+    def get_provider_threshold(self, country, name):
+        """The default low balance threshold of a provider"""
+        if self._thresholds is None:
+            self._thresholds = self.settings.get_value('low-balance-thresholds').unpack()
+        return self._thresholds.get('%s:%s' % (country, name))
 
     def is_known_account(self, imsi):
         """Do we know about this account in GSettings?"""
@@ -87,10 +240,17 @@ class AccountDB(object):
     def _bind_account(self, imsi):
         """Bind a new account object to a gsettings path"""
 
+        identifier = self.imsi_to_identifier(imsi)
+        if identifier in self.accounts:
+            return self.accounts[identifier][0]
+
         path = self._account_path(imsi)
         account = Account()
-        account.props.identifier = self.imsi_to_identifier(imsi)
+        account.props.identifier = identifier
         gsettings_account = Gio.Settings(self.PPM_GSETTINGS_ACCOUNT_ID, path)
+        if self.delay:
+            gsettings_account.delay()
+        self.accounts[identifier] = (account, gsettings_account)
         gsettings_account.bind('provider', account, 'name',
                                Gio.SettingsBindFlags.DEFAULT)
         gsettings_account.bind('country', account, 'code',
@@ -99,6 +259,10 @@ class AccountDB(object):
                                Gio.SettingsBindFlags.DEFAULT)
         gsettings_account.bind('timestamp', account, 'timestamp',
                                Gio.SettingsBindFlags.DEFAULT)
+        gsettings_account.bind('low-balance-threshold', account, 'threshold',
+                               Gio.SettingsBindFlags.DEFAULT)
+        gsettings_account.bind('min-refresh-interval', account, 'min_interval',
+                               Gio.SettingsBindFlags.DEFAULT)
         return account
 
     def fetch(self, imsi):
@@ -132,3 +296,11 @@ class AccountDB(object):
         account = self._bind_account(imsi)
         account.props.name = provider.name
         account.props.code = provider.country
+        return account
+
+    def apply(self):
+        """Write delayed changes of all accounts to GSettings"""
+        for (account, settings) in self.accounts.values():
+            if settings.get_has_unapplied():
+                settings.apply()
+        Gio.Settings.sync()
@@ -0,0 +1,227 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""
+asyncio interface to L{ModemManagerProxy}
+
+The GLib main loop has to run alongside the asyncio one for any of this to
+work. Use L{run} which picks PyGObject's asyncio integration if available
+and otherwise iterates the GLib main context from within asyncio:
+
+    async def main():
+        mm = AsyncModemManager()
+        await mm.wait_ready()
+        modems = await mm.get_modems()
+        imsis = await asyncio.gather(*[mm.get_imsi(m) for m in modems])
+
+    ppm.aio.run(main())
+"""
+
+from builtins import object
+import asyncio
+import collections
+import logging
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . modemproxy import (Modem, ModemManagerProxy, MM_DBUS_SERVICE,
+                          USSD_SESSION_TIMEOUT)
+from . ussd import UssdScript
+
+# Seconds between iterations of the GLib main context without gi.events
+PUMP_INTERVAL = 0.01
+# Seconds between checks whether we're connected to ModemManager
+READY_POLL = 0.1
+
+
+def install_event_loop_policy():
+    """
+    Let asyncio run on top of the GLib main loop
+
+    @return: C{True} if PyGObject's asyncio integration is available
+    """
+    try:
+        from gi.events import GLibEventLoopPolicy
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(GLibEventLoopPolicy())
+    return True
+
+
+async def pump_glib(interval=PUMP_INTERVAL):
+    """Dispatch pending GLib events until cancelled"""
+    context = GLib.MainContext.default()
+    while True:
+        while context.pending():
+            context.iteration(False)
+        await asyncio.sleep(interval)
+
+
+def run(coro):
+    """Run coro to completion with the GLib main loop running as well"""
+    if install_event_loop_policy():
+        return asyncio.run(coro)
+
+    async def with_pump():
+        pump = asyncio.ensure_future(pump_glib())
+        try:
+            return await coro
+        finally:
+            pump.cancel()
+
+    logging.debug("gi.events not available, pumping the GLib main context")
+    return asyncio.run(with_pump())
+
+
+class AsyncModemManager(object):
+    """
+    Awaitable versions of the L{ModemManagerProxy} operations
+
+    Operations on different modems run concurrently, operations on the
+    same modem are queued since a modem only handles one USSD session at
+    a time. Errors are raised as L{ModemError}.
+    """
+
+    def __init__(self, mm=None):
+        self.mm = mm or ModemManagerProxy()
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+    def _callbacks(self, future):
+        """reply_func and error_func resolving future"""
+        def reply_func(*args):
+            if not future.done():
+                future.set_result(args)
+
+        def error_func(error):
+            if not future.done():
+                future.set_exception(error)
+        return reply_func, error_func
+
+    async def wait_ready(self):
+        """Wait until we're connected to ModemManager"""
+        while not self.mm.ready():
+            await asyncio.sleep(READY_POLL)
+
+    async def get_modems(self):
+        """The modems currently known to ModemManager"""
+        await self.wait_ready()
+        future = asyncio.get_running_loop().create_future()
+
+        def on_got_modems(obj, mm):
+            if not future.done():
+                future.set_result(list(mm.modems))
+
+        handler = self.mm.connect('got-modems', on_got_modems)
+        try:
+            self.mm.dbus_find_modems()
+            return await future
+        finally:
+            self.mm.disconnect(handler)
+
+    async def get_imsi(self, modem):
+        """The IMSI of the SIM card in modem"""
+        future = asyncio.get_running_loop().create_future()
+        reply_func, error_func = self._callbacks(future)
+        self.mm.get_imsi_async(modem, reply_func, error_func)
+        (imsi, modem) = await future
+        return imsi
+
+    async def ussd(self, modem, command, timeout=USSD_SESSION_TIMEOUT):
+        """
+        Send a USSD command and return the network's reply
+
+        @param command: the USSD command or a L{UssdScript} for
+            multi step sessions
+        """
+        if not isinstance(command, UssdScript):
+            command = UssdScript('raw', command)
+
+        async with self.locks[modem.path]:
+            while not modem.ussd_proxy:
+                await asyncio.sleep(READY_POLL)
+            future = asyncio.get_running_loop().create_future()
+            reply_func, error_func = self._callbacks(future)
+            session = self.mm.ussd_session(command, modem=modem,
+                                           reply_func=reply_func,
+                                           error_func=error_func,
+                                           timeout=timeout)
+            try:
+                (var, session) = await future
+            except asyncio.CancelledError:
+                if session:
+                    session.cancel()
+                raise
+            return var.unpack()[0]
+
+    async def sms(self, modem, number, text, reply_senders=None):
+        """
+        Send an SMS and return the provider's reply
+
+        @param reply_senders: senders besides number the provider replies
+            from
+        """
+        async with self.locks[modem.path]:
+            while not modem.messaging_proxy:
+                await asyncio.sleep(READY_POLL)
+            future = asyncio.get_running_loop().create_future()
+            reply_func, error_func = self._callbacks(future)
+            self.mm.sms_request(number, text, modem=modem,
+                                reply_func=reply_func,
+                                error_func=error_func,
+                                reply_senders=reply_senders)
+            (var, request) = await future
+            return var.unpack()[0]
+
+    async def watch_modems(self):
+        """
+        Yield the current modems and then every modem that shows up
+
+        Iterate with C{async for}, the iteration never ends on its own.
+        """
+        queue = asyncio.Queue()
+        seen = set()
+
+        def on_interfaces_added(connection, sender, path, iface, signal,
+                                params, user_data):
+            (obj_path, ifaces) = params.unpack()
+            if Modem.MM_DBUS_INTERFACE_MODEM in ifaces:
+                self.mm.objs = None
+                queue.put_nowait(Modem(obj_path))
+
+        await self.wait_ready()
+        connection = self.mm.object_manager.get_connection()
+        subscription = connection.signal_subscribe(
+            MM_DBUS_SERVICE,
+            ModemManagerProxy.DBUS_INTERFACE_OBJECT_MANAGER,
+            'InterfacesAdded',
+            ModemManagerProxy.MM_DBUS_OBJECT_MODEM_MANAGER,
+            None,
+            Gio.DBusSignalFlags.NONE,
+            on_interfaces_added,
+            None)
+        try:
+            for modem in await self.get_modems():
+                queue.put_nowait(modem)
+            while True:
+                modem = await queue.get()
+                if modem.path in seen:
+                    continue
+                seen.add(modem.path)
+                yield modem
+        finally:
+            connection.signal_unsubscribe(subscription)
+
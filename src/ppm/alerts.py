@@ -0,0 +1,109 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import os
+import time
+
+from gi.repository import GLib
+
+
+class LowBalanceMonitor(object):
+    """
+    Decide whether an account's balance dropped below its threshold
+
+    Only the account whose balance changed gets looked at. An alert is
+    raised when the balance drops below the threshold. The account is only
+    armed again once the balance rose HYSTERESIS above the threshold, and
+    no two alerts for an account are raised within the debounce
+    interval. A balance flapping around the threshold therefore doesn't
+    raise an alert on every update.
+    """
+
+    # Relative amount the balance needs to rise above the threshold to
+    # rearm the alert
+    HYSTERESIS = 0.1
+
+    def __init__(self, accountdb):
+        self.accountdb = accountdb
+        # identifier -> (balance is low, time of the last alert)
+        self.state = {}
+
+    def get_threshold(self, account):
+        """The account's threshold, falls back to the provider's default"""
+        if account.props.threshold >= 0:
+            return account.props.threshold
+        return self.accountdb.get_provider_threshold(account.props.code,
+                                                     account.props.name)
+
+    def check(self, account, now=None):
+        """
+        Check an account after its balance changed
+
+        @return: the threshold if an alert should be raised, C{None} otherwise
+        """
+        amount = account.amount
+        threshold = self.get_threshold(account)
+        if amount is None or threshold is None:
+            return None
+
+        now = time.time() if now is None else now
+        identifier = account.props.identifier
+        (low, last_alert) = self.state.get(identifier, (False, None))
+
+        if amount >= threshold:
+            if low and amount >= threshold + abs(threshold) * self.HYSTERESIS:
+                self.state[identifier] = (False, last_alert)
+            return None
+
+        if low:
+            return None
+        self.state[identifier] = (True, last_alert)
+        if (last_alert is not None and
+                now - last_alert < self.accountdb.low_balance_debounce):
+            logging.debug("Not alerting on low balance of '%s' again yet",
+                          identifier)
+            return None
+
+        self.state[identifier] = (True, now)
+        return threshold
+
+
+def run_hook(command, account, amount, threshold):
+    """Run the low balance hook command without waiting for it"""
+    try:
+        argv = GLib.shell_parse_argv(command)[1]
+    except GLib.Error as err:
+        logging.error("Invalid low balance hook '%s': %s", command, err.message)
+        return
+
+    env = dict(os.environ)
+    env.update({
+        'PPM_ACCOUNT': account.props.identifier,
+        'PPM_PROVIDER': account.props.name or '',
+        'PPM_COUNTRY': account.props.code or '',
+        'PPM_BALANCE': account.props.balance or '',
+        'PPM_AMOUNT': repr(amount),
+        'PPM_THRESHOLD': repr(threshold),
+    })
+    try:
+        GLib.spawn_async(argv,
+                         envp=['%s=%s' % item for item in env.items()],
+                         flags=GLib.SpawnFlags.SEARCH_PATH)
+    except GLib.Error as err:
+        logging.error("Running low balance hook '%s' failed: %s", command,
+                      err.message)
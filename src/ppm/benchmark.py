@@ -0,0 +1,222 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . modemproxy import (ModemManagerProxy, MM_DBUS_TIMEOUT)
+from . providerdb import ProviderDB
+from . refresh import BalanceRefresher
+from . simulator import NETWORK_ID
+from . timeouts import AdaptiveTimeouts
+
+
+PROVIDER_INFO = """<?xml version="1.0" encoding="UTF-8"?>
+<serviceproviders format="2.0">
+  <country code="xx">
+    <provider>
+      <name>Benchmark</name>
+      <gsm>
+        <network-id mcc="%s" mnc="%s"/>
+        <balance-check>
+          <ussd>*100#</ussd>
+        </balance-check>
+      </gsm>
+    </provider>
+  </country>
+</serviceproviders>
+""" % NETWORK_ID
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Benchmark(object):
+    """
+    Time balance refresh cycles against a simulated ModemManager
+
+    A private message bus is started and a simulator serving ModemManager's
+    name on it gets spawned. The system bus address is pointed at that bus
+    so the regular L{ModemManagerProxy} and L{BalanceRefresher} talk to the
+    simulator. Every cycle refreshes all modems with a new proxy.
+
+    The results of each cycle are a dict with the keys cycle, modems,
+    startup (seconds until the modems were found), time (seconds to refresh
+    all modems once found), requests, errors, p50, p95 and p99 (request
+    latencies in milliseconds), cpu (seconds of CPU time used by this
+    process, the simulator doesn't count), maxrss (peak resident set
+    size of this process in KiB) and error (why the cycle failed or
+    C{None}). A cycle that doesn't finish within the deadline fails and
+    ends the run.
+    """
+
+    PERCENTILES = [('p50', 0.50), ('p95', 0.95), ('p99', 0.99)]
+
+    # Seconds a cycle may take
+    CYCLE_DEADLINE = 300
+
+    def __init__(self, simulator_argv, accountdb, governor_func=None,
+                 deadline=CYCLE_DEADLINE):
+        """
+        @param simulator_argv: command to start the simulator,
+            --address gets appended
+        @param accountdb: the account store, should be in memory
+        @param governor_func: returns a new L{ppm.governor.UssdGovernor}
+            per cycle, no governor if C{None}
+        @param deadline: seconds a cycle may take
+        """
+        self.simulator_argv = simulator_argv
+        self.accountdb = accountdb
+        self.governor_func = governor_func
+        self.deadline = deadline
+        self.tmpdir = None
+        self.bus = None
+        self.simulator = None
+        self.loop = GLib.MainLoop()
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='ppm-bench-')
+        self.providerdb = ProviderDB()
+        self.providerdb.provider_info = os.path.join(self.tmpdir,
+                                                     'serviceproviders.xml')
+        self.providerdb.ussd_scripts = os.path.join(self.tmpdir,
+                                                    'ussd-scripts.xml')
+        with open(self.providerdb.provider_info, 'w') as f:
+            f.write(PROVIDER_INFO)
+
+        self.bus = Gio.TestDBus.new(Gio.TestDBusFlags.NONE)
+        self.bus.up()
+        address = self.bus.get_bus_address()
+        # Must happen before anything connects to the system bus
+        os.environ['DBUS_SYSTEM_BUS_ADDRESS'] = address
+
+        self.simulator = Gio.Subprocess.new(self.simulator_argv +
+                                            ['--address', address],
+                                            Gio.SubprocessFlags.STDOUT_PIPE)
+        stdout = Gio.DataInputStream.new(self.simulator.get_stdout_pipe())
+        (line, _) = stdout.read_line_utf8(None)
+        if line != 'ready':
+            raise RuntimeError("Simulator failed to start")
+        logging.debug("Simulator running on '%s'", address)
+
+    def teardown(self):
+        if self.simulator:
+            self.simulator.force_exit()
+            self.simulator.wait(None)
+            self.simulator = None
+        if self.bus:
+            self.bus.down()
+            self.bus = None
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
+
+    def cycle(self, number):
+        """Refresh all modems once and return the cycle's results"""
+        latencies = []
+        errors = []
+        found = []
+        expired = []
+
+        def on_deadline():
+            expired.append(True)
+            self.loop.quit()
+            return False
+
+        def on_result(result):
+            if result['error']:
+                errors.append(result['error'])
+            elif result['latency'] is not None:
+                latencies.append(result['latency'])
+
+        timeouts = AdaptiveTimeouts(MM_DBUS_TIMEOUT,
+                                    path=os.path.join(self.tmpdir,
+                                                      'latencies.json'))
+        governor = self.governor_func() if self.governor_func else None
+        mm = ModemManagerProxy(timeouts=timeouts, governor=governor)
+        # Connected before the refresher so it runs first
+        mm.connect('got-modems',
+                   lambda obj, mm: found.append((time.monotonic(),
+                                                 len(mm.modems))))
+        refresher = BalanceRefresher(mm, self.providerdb, self.accountdb,
+                                     on_result, done_func=self.loop.quit)
+
+        cpu = _cpu_time()
+        start = time.monotonic()
+        refresher.start()
+        timer = GLib.timeout_add_seconds(self.deadline, on_deadline)
+        self.loop.run()
+        end = time.monotonic()
+        cpu = _cpu_time() - cpu
+        if not expired:
+            GLib.source_remove(timer)
+
+        (found_at, modems) = found[0] if found else (end, 0)
+        result = {
+            'cycle': number,
+            'modems': modems,
+            'startup': found_at - start,
+            'time': end - found_at,
+            'requests': len(latencies) + len(errors),
+            'errors': len(errors),
+            'cpu': cpu,
+            'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'error': None,
+        }
+        if expired:
+            result['error'] = ("Cycle didn't finish within %d seconds, %s" %
+                               (self.deadline,
+                                "%d modems found" % modems if found
+                                else "no modems found"))
+        for (name, p) in self.PERCENTILES:
+            result[name] = (AdaptiveTimeouts.percentile(latencies, p) * 1000
+                            if latencies else None)
+        return result
+
+    def run(self, cycles=1, result_func=None):
+        """
+        Run the benchmark
+
+        @param result_func: called with the results of each cycle
+        @return: the results of all cycles
+        """
+        results = []
+        try:
+            # A failed setup leaves a bus or simulator behind
+            self.setup()
+            for number in range(cycles):
+                result = self.cycle(number)
+                if result_func:
+                    result_func(result)
+                results.append(result)
+                if result['error']:
+                    # Leftovers of the cycle would disturb the next one
+                    logging.error("Benchmark cycle %d failed: %s", number,
+                                  result['error'])
+                    break
+        finally:
+            self.teardown()
+        return results
@@ -0,0 +1,115 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+
+from gi.repository import GLib
+from gi.repository import Gtk
+
+
+class DashboardModel(object):
+    """
+    All modems and their accounts in a single list store
+
+    Updates are collected and written to the store once per frame of the
+    widget showing it so a burst of balances arriving at once only causes
+    a single redraw. Without a widget attached updates are kept until one
+    gets attached.
+
+    @ivar store: one row per modem
+    @type store: C{Gtk.ListStore}
+    """
+
+    COLUMN_MODEM = 0
+    COLUMN_ACCOUNT = 1
+    COLUMN_PROVIDER = 2
+    COLUMN_BALANCE = 3
+    COLUMN_UPDATED = 4
+    COLUMN_STATE = 5
+
+    FIELDS = {
+        'account': COLUMN_ACCOUNT,
+        'provider': COLUMN_PROVIDER,
+        'balance': COLUMN_BALANCE,
+        'updated': COLUMN_UPDATED,
+        'state': COLUMN_STATE,
+    }
+
+    def __init__(self):
+        self.store = Gtk.ListStore(str, str, str, str, str, str)
+        # List store iters stay valid as long as the row exists
+        self.rows = {}
+        self.pending = {}
+        self.widget = None
+        self.tick = None
+
+    @property
+    def modems(self):
+        """The modems shown or about to be shown"""
+        return set(self.rows) | set(self.pending)
+
+    def remove(self, modem):
+        """Remove the row of a modem that went away"""
+        self.pending.pop(modem, None)
+        it = self.rows.pop(modem, None)
+        if it is not None:
+            self.store.remove(it)
+
+    def update(self, modem, **fields):
+        """
+        Update the row of modem, it's added if needed
+
+        @param fields: the columns to change, see L{FIELDS}
+        """
+        self.pending.setdefault(modem, {}).update(fields)
+        self._schedule()
+
+    def attach(self, widget):
+        """Flush updates on the frames of widget"""
+        self.detach()
+        self.widget = widget
+        self._schedule()
+
+    def detach(self):
+        if self.tick:
+            self.widget.remove_tick_callback(self.tick)
+            self.tick = None
+        self.widget = None
+
+    def _schedule(self):
+        if self.widget and self.pending and not self.tick:
+            self.tick = self.widget.add_tick_callback(self.on_tick)
+
+    def on_tick(self, widget, frame_clock):
+        self.tick = None
+        self.flush()
+        return GLib.SOURCE_REMOVE
+
+    def flush(self):
+        """Write all pending updates to the store"""
+        (pending, self.pending) = (self.pending, {})
+        for (modem, fields) in pending.items():
+            columns = []
+            values = []
+            for (field, value) in fields.items():
+                columns.append(self.FIELDS[field])
+                values.append(value or '')
+            it = self.rows.get(modem)
+            if it is None:
+                self.rows[modem] = self.store.insert_with_valuesv(
+                    -1, [self.COLUMN_MODEM] + columns, [modem] + values)
+            elif columns:
+                self.store.set(it, columns, values)
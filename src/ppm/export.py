@@ -0,0 +1,84 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import csv
+import datetime
+import io
+import json
+
+from . history import BalanceRecord
+
+
+FORMATS = ['csv', 'jsonl']
+
+
+def isotime(timestamp):
+    """Seconds since the epoch as ISO 8601 date in the local timezone"""
+    return datetime.datetime.fromtimestamp(timestamp).astimezone().isoformat()
+
+
+def to_dicts(records):
+    """Turn balance records into ordered dicts with an ISO 8601 timestamp"""
+    for record in records:
+        row = collections.OrderedDict(zip(BalanceRecord._fields, record))
+        row['timestamp'] = isotime(record.timestamp)
+        yield row
+
+
+def format_csv(rows):
+    """Format rows as CSV lines, starting with a header"""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=BalanceRecord._fields)
+
+    def pop_line():
+        line = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return line
+
+    writer.writeheader()
+    yield pop_line()
+    for row in rows:
+        writer.writerow(row)
+        yield pop_line()
+
+
+def format_jsonl(rows):
+    """Format rows as JSON lines"""
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def export(records, output, fmt='csv'):
+    """
+    Write balance records to output
+
+    Records are formatted and written one by one so memory use
+    doesn't depend on the number of records.
+
+    @param records: the records to write
+    @type records: iterator over L{BalanceRecord}
+    @param output: file like object to write to
+    @param fmt: one of L{FORMATS}
+    @return: the number of records written
+    """
+    formatter = {'csv': format_csv, 'jsonl': format_jsonl}[fmt]
+    count = 0
+    for line in formatter(to_dicts(records)):
+        output.write(line)
+        count += 1
+    return count - 1 if fmt == 'csv' else count
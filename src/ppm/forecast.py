@@ -0,0 +1,148 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""
+Predict when accounts run out of credit
+
+The consumption rate of every account is the slope of a least squares
+line through its balances since the last top up. All accounts are fitted
+together using NumPy so this stays cheap for thousands of SIM cards.
+"""
+
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+Forecast = collections.namedtuple('Forecast',
+                                  ['identifier',
+                                   'provider',
+                                   'country',
+                                   'amount',    # latest balance
+                                   'rate',      # consumption per day
+                                   'empty_at',  # seconds since the epoch or None
+                                   'samples',   # balances used for the fit
+                                   ])
+
+
+class ForecastError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def available():
+    """Whether forecasting is possible, it needs NumPy"""
+    return numpy is not None
+
+
+def forecast(records):
+    """
+    Fit the consumption of all accounts in records
+
+    Balances that went up mark a top up, only the balances after an
+    account's last top up are used. Accounts with less than two such
+    balances get no rate. Accounts that don't consume anything get no
+    empty date.
+
+    @param records: balance history ordered by time
+    @type records: iterator over L{ppm.history.BalanceRecord}
+    @return: a forecast per account
+    @rtype: C{list} of L{Forecast}
+    """
+    if numpy is None:
+        raise ForecastError("Forecasting needs NumPy")
+
+    ids = {}
+    meta = []
+    rows = []
+    for record in records:
+        if record.amount is None:
+            continue
+        account = ids.get(record.identifier)
+        if account is None:
+            account = ids[record.identifier] = len(meta)
+            meta.append(record)
+        else:
+            meta[account] = record
+        rows.append((account, record.timestamp, record.amount))
+    if not rows:
+        return []
+
+    data = numpy.array(rows, dtype=float)
+    order = numpy.lexsort((data[:, 1], data[:, 0]))
+    account = data[order, 0].astype(int)
+    ts = data[order, 1]
+    amount = data[order, 2]
+    naccounts = len(meta)
+
+    # A new segment starts with every account and every top up
+    starts = numpy.ones(len(account), dtype=bool)
+    starts[1:] = (account[1:] != account[:-1]) | (amount[1:] > amount[:-1])
+    segment = numpy.cumsum(starts) - 1
+    last_segment = numpy.zeros(naccounts, dtype=int)
+    numpy.maximum.at(last_segment, account, segment)
+    keep = segment == last_segment[account]
+    account, ts, amount = account[keep], ts[keep], amount[keep]
+
+    # Days since the segment's first balance keep the sums well conditioned
+    first_ts = numpy.full(naccounts, numpy.inf)
+    numpy.minimum.at(first_ts, account, ts)
+    t = (ts - first_ts[account]) / SECONDS_PER_DAY
+
+    n = numpy.bincount(account, minlength=naccounts).astype(float)
+    sum_t = numpy.bincount(account, t, minlength=naccounts)
+    sum_a = numpy.bincount(account, amount, minlength=naccounts)
+    sum_tt = numpy.bincount(account, t * t, minlength=naccounts)
+    sum_ta = numpy.bincount(account, t * amount, minlength=naccounts)
+    denom = n * sum_tt - sum_t * sum_t
+    valid = (n >= 2) & (denom > 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        slope = numpy.where(valid, (n * sum_ta - sum_t * sum_a) / denom,
+                            numpy.nan)
+    rate = -slope
+
+    last_ts = numpy.full(naccounts, -numpy.inf)
+    numpy.maximum.at(last_ts, account, ts)
+    latest = numpy.array([record.amount for record in meta])
+    consuming = valid & (rate > 0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        empty_at = numpy.where(consuming,
+                               last_ts + numpy.maximum(latest, 0) / rate *
+                               SECONDS_PER_DAY,
+                               numpy.nan)
+
+    forecasts = []
+    for (i, record) in enumerate(meta):
+        forecasts.append(Forecast(record.identifier,
+                                  record.provider,
+                                  record.country,
+                                  record.amount,
+                                  float(rate[i]) + 0.0 if valid[i] else None,
+                                  float(empty_at[i]) if consuming[i] else None,
+                                  int(n[i])))
+    return forecasts
+
+
+def running_dry(forecasts, until):
+    """Forecasts of accounts that run out of credit before until"""
+    return sorted((f for f in forecasts
+                   if f.empty_at is not None and f.empty_at < until),
+                  key=lambda f: f.empty_at)
@@ -0,0 +1,203 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import collections
+import logging
+import math
+import time
+
+from gi.repository import GLib
+
+from . metrics import RequestStats
+
+
+class TokenBucket(object):
+    """Allow rate operations per second with bursts of up to burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now=None):
+        """Take a token if there's one"""
+        self._refill(now or time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self, now=None):
+        """Seconds until the next token is available"""
+        self._refill(now or time.monotonic())
+        if self.tokens >= 1 or self.rate <= 0:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class UssdGovernor(object):
+    """
+    Limit the USSD traffic we send to each provider and from this host
+
+    Every provider gets a token bucket limiting how fast sessions start
+    and a maximum of sessions in flight. On top of that there's a maximum
+    for all sessions. Requests that can't start right away are queued per
+    provider and the queues are served round robin so a busy provider
+    doesn't starve the others. Requests without a provider are only
+    subject to the host limit.
+
+    @ivar waits: how long requests were queued, per provider
+    """
+
+    def __init__(self, rate=1.0, burst=3, max_per_provider=4, max_per_host=16):
+        """
+        @param rate: sessions per second started per provider
+        @param burst: sessions a provider may start at once after idling
+        @param max_per_provider: sessions in flight per provider
+        @param max_per_host: sessions in flight overall
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_per_provider = max_per_provider
+        self.max_per_host = max_per_host
+        self.buckets = {}
+        self.in_flight = collections.Counter()
+        self.total_in_flight = 0
+        self.queues = collections.OrderedDict()
+        self.waits = RequestStats()
+        self.timer = None
+
+    @classmethod
+    def from_settings(klass, settings, share=1):
+        """
+        Create a governor configured in GSettings
+
+        @param share: split all limits between this many processes, each
+            process can still start at least one session
+        """
+        def split(key):
+            return max(1, settings.get_uint(key) // share)
+
+        return klass(rate=settings.get_double('ussd-rate') / share,
+                     burst=split('ussd-burst'),
+                     max_per_provider=split('ussd-max-per-provider'),
+                     max_per_host=split('ussd-max-per-host'))
+
+    def queue_depth(self):
+        """Number of queued requests per provider seen so far"""
+        depth = {provider: 0 for provider in self.in_flight}
+        depth.update((provider, len(queue))
+                     for (provider, queue) in self.queues.items())
+        return depth
+
+    def submit(self, provider, start_func):
+        """
+        Run start_func as soon as the limits allow
+
+        start_func gets called without arguments, the caller must call
+        L{release} with the same provider once the request finished.
+        """
+        queue = self.queues.setdefault(provider, collections.deque())
+        queue.append((start_func, time.monotonic()))
+        self._dispatch()
+
+    def cancel(self, provider, start_func):
+        """
+        Drop a request that didn't start yet
+
+        @return: C{True} if the request was still queued
+        """
+        queue = self.queues.get(provider)
+        if not queue:
+            return False
+        for entry in queue:
+            if entry[0] == start_func:
+                queue.remove(entry)
+                if not queue:
+                    del self.queues[provider]
+                return True
+        return False
+
+    def release(self, provider):
+        """A request to provider finished"""
+        self.in_flight[provider] -= 1
+        self.total_in_flight -= 1
+        self._dispatch()
+
+    def _may_start(self, provider, now):
+        if provider is None:
+            return True
+        if self.in_flight[provider] >= self.max_per_provider:
+            return False
+        bucket = self.buckets.get(provider)
+        if bucket is None:
+            bucket = self.buckets[provider] = TokenBucket(self.rate, self.burst)
+        return bucket.take(now)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        started = True
+        # Round robin: serve one request per provider and pass
+        while started and self.total_in_flight < self.max_per_host:
+            started = False
+            for provider in list(self.queues):
+                if self.total_in_flight >= self.max_per_host:
+                    break
+                if not self._may_start(provider, now):
+                    continue
+                queue = self.queues.pop(provider)
+                (start_func, queued) = queue.popleft()
+                if queue:
+                    # Go to the back of the line
+                    self.queues[provider] = queue
+                self.in_flight[provider] += 1
+                self.total_in_flight += 1
+                self.waits.record(provider or '', now - queued)
+                started = True
+                try:
+                    start_func()
+                except Exception:
+                    logging.exception("Starting request to '%s' failed",
+                                      provider)
+                    self.release(provider)
+                    return
+        self._schedule()
+
+    def _schedule(self):
+        """Wake up once the next token for a waiting provider is there"""
+        if self.timer or self.total_in_flight >= self.max_per_host:
+            return
+        delays = [self.buckets[provider].delay()
+                  for provider in self.queues
+                  if provider in self.buckets and
+                  self.in_flight[provider] < self.max_per_provider]
+        delays = [d for d in delays if d > 0]
+        if not delays:
+            return
+        self.timer = GLib.timeout_add(int(math.ceil(min(delays) * 1000)),
+                                      self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self._dispatch()
+        return False
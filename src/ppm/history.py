@@ -0,0 +1,141 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import collections
+import logging
+import os
+import sqlite3
+
+from gi.repository import GLib
+
+from . accountdb import parse_balance
+
+
+BalanceRecord = collections.namedtuple('BalanceRecord',
+                                       ['identifier',
+                                        'provider',
+                                        'country',
+                                        'balance',
+                                        'amount',
+                                        'timestamp',  # seconds since the epoch
+                                        ])
+
+
+class BalanceHistory(object):
+    """
+    Every balance we got for an account, kept in an sqlite database
+
+    The account store only knows about the latest balance, the history
+    allows to look at how balances developed over time.
+    """
+
+    db_path = os.getenv('PPM_HISTORY_DB',
+                        os.path.join(GLib.get_user_data_dir(),
+                                     'prepaid-manager-applet',
+                                     'history.db'))
+
+    # Rows fetched from the database at once when iterating
+    FETCH_SIZE = 512
+
+    def __init__(self, path=None):
+        self.path = path or self.db_path
+        self.__db = None
+
+    @property
+    def db(self):
+        if self.__db is None:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.__db = sqlite3.connect(self.path)
+            self.__db.execute("CREATE TABLE IF NOT EXISTS balances ("
+                              "identifier TEXT NOT NULL, "
+                              "provider TEXT, "
+                              "country TEXT, "
+                              "balance TEXT, "
+                              "amount REAL, "
+                              "timestamp REAL NOT NULL)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS balances_timestamp "
+                              "ON balances (timestamp)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS balances_identifier "
+                              "ON balances (identifier, timestamp)")
+            self.__db.commit()
+            logging.debug("Using balance history '%s'", self.path)
+        return self.__db
+
+    def close(self):
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+    def add(self, identifier, provider, country, balance, timestamp,
+            commit=True):
+        """Record a balance of the account identifier"""
+        self.db.execute("INSERT INTO balances VALUES (?, ?, ?, ?, ?, ?)",
+                        (identifier, provider, country, balance,
+                         parse_balance(balance), timestamp))
+        if commit:
+            self.db.commit()
+
+    def add_account(self, account):
+        """Record the current balance of an account"""
+        timestamp = account.updated
+        if timestamp is None:
+            return
+        self.add(account.props.identifier, account.props.name,
+                 account.props.code, account.props.balance, timestamp)
+
+    def records(self, since=None, until=None, providers=None,
+                identifiers=None):
+        """
+        Iterate over the recorded balances ordered by time
+
+        Rows are fetched in chunks so memory use doesn't depend on the
+        size of the history.
+
+        @param since: only records at or after this time
+        @param until: only records before this time
+        @param providers: only records for these provider names
+        @param identifiers: only records for these accounts
+        @rtype: iterator over L{BalanceRecord}
+        """
+        query = "SELECT * FROM balances"
+        where = []
+        args = []
+        if since is not None:
+            where.append("timestamp >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("timestamp < ?")
+            args.append(until)
+        for (column, values) in [('provider', providers),
+                                 ('identifier', identifiers)]:
+            if values:
+                where.append("%s IN (%s)" % (column,
+                                             ', '.join('?' * len(values))))
+                args.extend(values)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY timestamp"
+
+        cursor = self.db.execute(query, args)
+        while True:
+            rows = cursor.fetchmany(self.FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield BalanceRecord(*row)
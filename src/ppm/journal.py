@@ -0,0 +1,232 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import fcntl
+import json
+import logging
+import os
+import time
+
+from gi.repository import GLib
+
+from . provider import Provider
+
+
+class Journal(object):
+    """
+    Append-only log of account operations
+
+    Operations are appended as JSON lines and synced to disk in batches.
+    The account store is used in delayed mode so changes to accounts only
+    hit GSettings when the journal gets compacted: the pending changes are
+    applied in one go and the journal is emptied. Operations still in the
+    journal after a crash are replayed into the account store on the next
+    start.
+
+    Every kind of process keeps a journal of its own since compacting
+    empties the whole journal. The journal is locked once it got replayed
+    so a second process of the same kind can't truncate it. If the lock is
+    held by someone else changes go to the account store once the caller
+    made them.
+    """
+
+    path = os.getenv('PPM_JOURNAL',
+                     os.path.join(GLib.get_user_data_dir(),
+                                  'prepaid-manager-applet',
+                                  'journal.jsonl'))
+
+    BALANCE_QUERIED = 'balance-queried'
+    BALANCE_RECEIVED = 'balance-received'
+    TOP_UP_SENT = 'top-up-sent'
+    TOP_UP_CONFIRMED = 'top-up-confirmed'
+    PROVIDER_ASSIGNED = 'provider-assigned'
+
+    # Milliseconds to collect operations before syncing them to disk
+    SYNC_DELAY = 200
+    # Seconds between compactions
+    COMPACT_INTERVAL = 60
+
+    def __init__(self, accountdb, path=None, name=None):
+        """
+        @param accountdb: the account store, should use delayed writes
+        @type accountdb: L{ppm.accountdb.AccountDB}
+        @param name: name of the journal when not using the default one
+        """
+        self.accountdb = accountdb
+        if path is None and name:
+            (base, ext) = os.path.splitext(self.path)
+            path = '%s-%s%s' % (base, name, ext)
+        self.path = path or self.path
+        self.file = None
+        self.lock_file = None
+        self.locked = False
+        self.entries = 0
+        self.sync_timer = None
+        self.compact_timer = None
+        self.apply_idle = None
+
+    def _makedirs(self):
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+    def _open(self):
+        if self.file is None:
+            self._makedirs()
+            self.file = open(self.path, 'a', encoding='utf-8')
+        return self.file
+
+    def lock(self):
+        """
+        Lock the journal for this process
+
+        @return: C{False} if another process holds the lock
+        """
+        if self.lock_file is None:
+            self._makedirs()
+            self.lock_file = open(self.path + '.lock', 'w')
+            try:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.locked = True
+            except OSError:
+                logging.warning("Journal '%s' is in use by another process, "
+                                "writing changes directly", self.path)
+        return self.locked
+
+    def unlock(self):
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+        self.locked = False
+
+    def record(self, op, imsi, **data):
+        """
+        Append an operation on the account of imsi
+
+        Operations affecting the account store must be applied to the
+        account by the caller as well.
+        """
+        if not self.lock():
+            # The caller changes the account after recording it
+            if not self.apply_idle:
+                self.apply_idle = GLib.idle_add(self.on_apply)
+            return
+        entry = {'op': op, 'imsi': imsi, 'time': time.time()}
+        entry.update(data)
+        self._open().write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self.entries += 1
+        if not self.sync_timer:
+            self.sync_timer = GLib.timeout_add(self.SYNC_DELAY, self.on_sync)
+        if not self.compact_timer:
+            self.compact_timer = GLib.timeout_add_seconds(
+                self.COMPACT_INTERVAL, self.on_compact)
+
+    def sync(self):
+        """Make sure all recorded operations are on disk"""
+        if self.sync_timer:
+            GLib.source_remove(self.sync_timer)
+            self.sync_timer = None
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def on_sync(self):
+        self.sync_timer = None
+        self.sync()
+        return False
+
+    def on_apply(self):
+        self.apply_idle = None
+        self.accountdb.apply()
+        return False
+
+    def on_compact(self):
+        self.compact_timer = None
+        self.compact()
+        return False
+
+    def compact(self):
+        """Write pending changes to the account store and empty the journal"""
+        if self.compact_timer:
+            GLib.source_remove(self.compact_timer)
+            self.compact_timer = None
+        self.sync()
+        if not self.locked:
+            if self.apply_idle:
+                GLib.source_remove(self.apply_idle)
+                self.apply_idle = None
+            self.accountdb.apply()
+            return
+        if not self.entries and not os.path.exists(self.path):
+            return
+        self.accountdb.apply()
+        if self.file:
+            self.file.close()
+            self.file = None
+        open(self.path, 'w').close()
+        logging.debug("Compacted %d journal entries", self.entries)
+        self.entries = 0
+
+    def apply(self, entry):
+        """Apply an operation to the account store"""
+        op = entry['op']
+        imsi = entry['imsi']
+        if op == self.PROVIDER_ASSIGNED:
+            account = self.accountdb.fetch(imsi)
+            provider = Provider(entry['country'], entry['name'])
+            if account:
+                account.update_provider(provider)
+            else:
+                self.accountdb.add(imsi, provider)
+        elif op == self.BALANCE_RECEIVED:
+            account = self.accountdb.fetch(imsi)
+            if account:
+                account.update_balance(entry['balance'], entry['timestamp'])
+
+    def replay(self):
+        """
+        Lock the journal, apply the operations left over from the last run
+        and compact
+
+        A line that didn't make it to disk completely is skipped.
+
+        @return: the number of operations replayed
+        """
+        if not self.lock():
+            return 0
+        count = 0
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        logging.warning("Skipping damaged journal entry '%s'",
+                                        line.strip())
+                        continue
+                    count += 1
+        except FileNotFoundError:
+            return 0
+        if count:
+            logging.info("Replayed %d journal entries", count)
+        self.entries = count
+        self.compact()
+        return count
+
+    def close(self):
+        self.compact()
+        self.unlock()
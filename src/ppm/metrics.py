@@ -0,0 +1,306 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import os
+import stat
+import time
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+
+class MetricsError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class RequestStats(object):
+    """
+    Counts and latencies of requests sent to ModemManager
+
+    Latencies are kept as cumulative histogram buckets so rendering them
+    doesn't depend on the number of requests seen so far.
+    """
+
+    # Upper bounds of the latency buckets in seconds
+    BUCKETS = (0.5, 1.0, 2.0, 3.0, 5.0, 8.0, 13.0, 30.0)
+
+    def __init__(self):
+        self.requests = {}
+
+    def record(self, request, latency, ok=True):
+        """Record a finished request that took latency seconds"""
+        stats = self.requests.setdefault(request, {
+            'ok': 0,
+            'error': 0,
+            'sum': 0.0,
+            'buckets': [0] * len(self.BUCKETS),
+        })
+        stats['ok' if ok else 'error'] += 1
+        stats['sum'] += latency
+        for i, bound in enumerate(self.BUCKETS):
+            if latency <= bound:
+                stats['buckets'][i] += 1
+
+
+def _label(value):
+    """Escape a label value for the text exposition format"""
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+
+def _labels(**kw):
+    return '{%s}' % ','.join('%s="%s"' % (k, _label(v))
+                             for (k, v) in sorted(kw.items()))
+
+
+class MetricsExporter(object):
+    """
+    Export balance and modem information in the Prometheus text format
+
+    The exporter only renders the snapshot that got pushed into it via
+    the update_* methods, so a scrape never causes any modem traffic.
+    """
+
+    def __init__(self, request_stats=None, governor=None):
+        """
+        @param governor: the USSD governor to export queue metrics of
+        @type governor: L{ppm.governor.UssdGovernor}
+        """
+        self.request_stats = request_stats or RequestStats()
+        self.governor = governor
+        self.accounts = {}
+        self.modems = {}
+        self.service = None
+        self.unix_path = None
+
+    def update_account(self, account):
+        """Take a snapshot of an account's balance information"""
+        if not account or not account.props.identifier:
+            return
+        self.accounts[account.props.identifier] = {
+            'provider': account.props.name or '',
+            'country': account.props.code or '',
+            'amount': account.amount,
+            'updated': account.updated,
+        }
+
+    def update_modem(self, path, enabled):
+        """Take a snapshot of a modem's state"""
+        self.modems[path] = enabled
+
+    def render(self):
+        """Render the current snapshot"""
+        now = time.time()
+        lines = []
+
+        lines.append('# HELP ppm_balance_amount Parsed balance of the account')
+        lines.append('# TYPE ppm_balance_amount gauge')
+        for (identifier, info) in sorted(self.accounts.items()):
+            if info['amount'] is None:
+                continue
+            lines.append('ppm_balance_amount%s %s' % (
+                _labels(account=identifier,
+                        provider=info['provider'],
+                        country=info['country']),
+                repr(info['amount'])))
+
+        lines.append('# HELP ppm_balance_age_seconds Time since the last successful balance update')
+        lines.append('# TYPE ppm_balance_age_seconds gauge')
+        for (identifier, info) in sorted(self.accounts.items()):
+            if info['updated'] is None:
+                continue
+            lines.append('ppm_balance_age_seconds%s %.3f' % (
+                _labels(account=identifier),
+                max(0.0, now - info['updated'])))
+
+        lines.append('# HELP ppm_modem_enabled Whether the modem is enabled')
+        lines.append('# TYPE ppm_modem_enabled gauge')
+        for (path, enabled) in sorted(self.modems.items()):
+            lines.append('ppm_modem_enabled%s %d' % (_labels(modem=path),
+                                                     1 if enabled else 0))
+
+        requests = self.request_stats.requests
+        lines.append('# HELP ppm_modem_requests_total Requests sent to ModemManager')
+        lines.append('# TYPE ppm_modem_requests_total counter')
+        for (request, stats) in sorted(requests.items()):
+            for result in ['ok', 'error']:
+                lines.append('ppm_modem_requests_total%s %d' % (
+                    _labels(request=request, result=result), stats[result]))
+
+        lines.append('# HELP ppm_modem_request_duration_seconds Latency of requests sent to ModemManager')
+        lines.append('# TYPE ppm_modem_request_duration_seconds histogram')
+        for (request, stats) in sorted(requests.items()):
+            for (bound, count) in zip(RequestStats.BUCKETS, stats['buckets']):
+                lines.append('ppm_modem_request_duration_seconds_bucket%s %d' % (
+                    _labels(request=request, le=bound), count))
+            total = stats['ok'] + stats['error']
+            lines.append('ppm_modem_request_duration_seconds_bucket%s %d' % (
+                _labels(request=request, le='+Inf'), total))
+            lines.append('ppm_modem_request_duration_seconds_sum%s %.3f' % (
+                _labels(request=request), stats['sum']))
+            lines.append('ppm_modem_request_duration_seconds_count%s %d' % (
+                _labels(request=request), total))
+
+        if self.governor:
+            lines.extend(self._render_governor())
+
+        return '\n'.join(lines) + '\n'
+
+    def _render_governor(self):
+        lines = []
+        lines.append('# HELP ppm_ussd_queue_depth USSD requests waiting for the governor')
+        lines.append('# TYPE ppm_ussd_queue_depth gauge')
+        depth = self.governor.queue_depth()
+        for provider in sorted(depth, key=lambda p: p or ''):
+            lines.append('ppm_ussd_queue_depth%s %d' % (
+                _labels(provider=provider or ''), depth[provider]))
+
+        lines.append('# HELP ppm_ussd_in_flight USSD requests let through by the governor and not finished yet')
+        lines.append('# TYPE ppm_ussd_in_flight gauge')
+        in_flight = self.governor.in_flight
+        for provider in sorted(in_flight, key=lambda p: p or ''):
+            lines.append('ppm_ussd_in_flight%s %d' % (
+                _labels(provider=provider or ''), in_flight[provider]))
+
+        lines.append('# HELP ppm_ussd_queue_wait_seconds Time USSD requests waited for the governor')
+        lines.append('# TYPE ppm_ussd_queue_wait_seconds histogram')
+        for (provider, stats) in sorted(self.governor.waits.requests.items()):
+            for (bound, count) in zip(RequestStats.BUCKETS, stats['buckets']):
+                lines.append('ppm_ussd_queue_wait_seconds_bucket%s %d' % (
+                    _labels(provider=provider, le=bound), count))
+            total = stats['ok'] + stats['error']
+            lines.append('ppm_ussd_queue_wait_seconds_bucket%s %d' % (
+                _labels(provider=provider, le='+Inf'), total))
+            lines.append('ppm_ussd_queue_wait_seconds_sum%s %.3f' % (
+                _labels(provider=provider), stats['sum']))
+            lines.append('ppm_ussd_queue_wait_seconds_count%s %d' % (
+                _labels(provider=provider), total))
+        return lines
+
+    @staticmethod
+    def parse_address(address):
+        """
+        Split [host]:port into host and port
+
+        IPv6 hosts need brackets, e.g. [::1]:9100.
+
+        @return: the host, localhost if omitted, and the port
+        @raises MetricsError: if address can't be parsed
+        """
+        if address.startswith('['):
+            (host, sep, port) = address[1:].partition(']:')
+        else:
+            (host, sep, port) = address.rpartition(':')
+        if not sep or not port.isdigit() or int(port) > 65535:
+            raise MetricsError("Invalid metrics address '%s', expected "
+                               "[host]:port" % address)
+        return (host or '127.0.0.1', int(port))
+
+    def listen(self, address):
+        """
+        Serve the metrics via HTTP
+
+        @param address: either an absolute path to a unix socket or
+            [host]:port, host defaults to localhost and must be an IP
+            address
+        @type address: C{str}
+        @raises MetricsError: if address is invalid or a path that is
+            not a socket
+        """
+        if address.startswith('/'):
+            # A socket left over from an earlier run
+            if self._is_socket(address):
+                os.unlink(address)
+            elif os.path.lexists(address):
+                raise MetricsError("Metrics path '%s' exists and is not a "
+                                   "socket" % address)
+            sockaddr = Gio.UnixSocketAddress.new(address)
+            self.unix_path = address
+        else:
+            (host, port) = self.parse_address(address)
+            sockaddr = Gio.InetSocketAddress.new_from_string(host, port)
+            if sockaddr is None:
+                raise MetricsError("Invalid metrics host '%s', expected an "
+                                   "IP address" % host)
+        self.service = Gio.SocketService()
+        self.service.add_address(sockaddr,
+                                 Gio.SocketType.STREAM,
+                                 Gio.SocketProtocol.DEFAULT,
+                                 None)
+        self.service.connect('incoming', self.on_incoming)
+        self.service.start()
+        logging.debug("Serving metrics on '%s'", address)
+
+    @staticmethod
+    def _is_socket(path):
+        try:
+            return stat.S_ISSOCK(os.lstat(path).st_mode)
+        except FileNotFoundError:
+            return False
+
+    def close(self):
+        """Stop serving, called on exit"""
+        if self.service:
+            self.service.stop()
+            self.service.close()
+            self.service = None
+        if self.unix_path and self._is_socket(self.unix_path):
+            os.unlink(self.unix_path)
+        self.unix_path = None
+
+    def on_incoming(self, service, connection, source):
+        connection.get_input_stream().read_bytes_async(4096,
+                                                       GLib.PRIORITY_DEFAULT,
+                                                       None,
+                                                       self.on_request_read,
+                                                       connection)
+        return True
+
+    def on_request_read(self, stream, res, connection):
+        try:
+            request = stream.read_bytes_finish(res).get_data().decode('latin-1')
+        except GLib.Error as err:
+            logging.warning("Reading metrics request failed: %s", err)
+            connection.close(None)
+            return
+
+        try:
+            path = request.split(' ', 2)[1]
+        except IndexError:
+            path = '/'
+
+        if path in ['/', '/metrics']:
+            status = '200 OK'
+            body = self.render()
+        else:
+            status = '404 Not Found'
+            body = 'Not found\n'
+
+        body = body.encode('utf-8')
+        header = ('HTTP/1.0 %s\r\n'
+                  'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                  'Content-Length: %d\r\n'
+                  'Connection: close\r\n\r\n' % (status, len(body)))
+        try:
+            connection.get_output_stream().write_all(header.encode('ascii') + body,
+                                                     None)
+        except GLib.Error as err:
+            logging.warning("Sending metrics failed: %s", err)
+        connection.close(None)
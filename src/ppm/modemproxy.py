@@ -19,36 +19,154 @@ from gi.repository import GLib
 from gi.repository import Gio
 
 import logging
+import time
+
+from . metrics import RequestStats
+from . import profiling
+from . timeouts import AdaptiveTimeouts
+from . ussd import (parse_menu, UssdScriptError)
 
 MM_DBUS_SERVICE = 'org.freedesktop.ModemManager1'
 MM_DBUS_TIMEOUT = 5000
 MM_DBUS_FLAGS = (Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES |
                  Gio.DBusProxyFlags.DO_NOT_CONNECT_SIGNALS)
+# Seconds a whole scripted USSD session may take
+USSD_SESSION_TIMEOUT = 60
+# Seconds to wait for the provider's reply to an SMS
+SMS_REPLY_TIMEOUT = 180
+MM_ERROR_PREFIX = 'org.freedesktop.ModemManager1.Error.'
+DBUS_ERROR_PREFIX = 'org.freedesktop.DBus.Error.'
+
 
 class ModemError(Exception):
-    def __init__(self, msg):
+    """
+    A request to the modem failed
+
+    Subclasses tell what went wrong. Unless retryable is set trying
+    again won't help.
+
+    @ivar msg: human readable description
+    @ivar name: the D-Bus error name if the error came from D-Bus
+    """
+    retryable = False
+
+    def __init__(self, msg, name=None):
         self.msg = msg
+        self.name = name
 
     def is_forbidden(self):
-        return [False, True][self.msg.find("Operation not allowed") != -1]
+        return isinstance(self, ModemForbiddenError)
 
     def is_disabled(self):
-        return [False, True][self.msg.find("not enabled") != -1]
+        return isinstance(self, ModemDisabledError)
+
+
+class ModemForbiddenError(ModemError):
+    """The network or the SIM card doesn't allow the operation"""
+
+
+class ModemDisabledError(ModemError):
+    """The modem isn't enabled"""
+
+
+class SimMissingError(ModemError):
+    """There's no SIM card in the modem"""
+
+
+class ModemRetryableError(ModemError):
+    """A transient failure, e.g. ModemManager restarting"""
+    retryable = True
+
+
+class ModemTimeoutError(ModemRetryableError):
+    """No reply in time"""
+
+
+class ModemGoneError(ModemRetryableError):
+    """ModemManager or the modem went away"""
+
+
+# ModemManager and D-Bus errors that aren't permanent ModemErrors
+DBUS_ERRORS = {
+    MM_ERROR_PREFIX + 'MobileEquipment.NotAllowed': ModemForbiddenError,
+    MM_ERROR_PREFIX + 'MobileEquipment.SimNotInserted': SimMissingError,
+    MM_ERROR_PREFIX + 'MobileEquipment.NetworkTimeout': ModemTimeoutError,
+    MM_ERROR_PREFIX + 'Core.Retry': ModemRetryableError,
+    MM_ERROR_PREFIX + 'Core.InProgress': ModemRetryableError,
+    DBUS_ERROR_PREFIX + 'NoReply': ModemTimeoutError,
+    DBUS_ERROR_PREFIX + 'Timeout': ModemTimeoutError,
+    DBUS_ERROR_PREFIX + 'TimedOut': ModemTimeoutError,
+    DBUS_ERROR_PREFIX + 'ServiceUnknown': ModemGoneError,
+    DBUS_ERROR_PREFIX + 'NameHasNoOwner': ModemGoneError,
+    DBUS_ERROR_PREFIX + 'UnknownObject': ModemGoneError,
+    DBUS_ERROR_PREFIX + 'Disconnected': ModemGoneError,
+}
+
+
+# Returned for disabled modems but also e.g. when a USSD session is
+# already active
+MM_ERROR_WRONG_STATE = MM_ERROR_PREFIX + 'Core.WrongState'
+
+
+def modem_error(err, action, modem=None):
+    """
+    Map the error of a D-Bus call to the matching L{ModemError}
+
+    @param err: the error raised by the call
+    @param action: what we tried to do, e.g. "Getting IMSI"
+    @param modem: the modem the call went to, needed to tell whether a
+        wrong state error means it's disabled
+    """
+    if not isinstance(err, GLib.Error):
+        return ModemError("%s failed: %s" % (action, err))
+
+    if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.TIMED_OUT):
+        return ModemTimeoutError("%s timed out" % action)
+
+    msg = err.message
+    name = Gio.DBusError.get_remote_error(err)
+    if name:
+        remote = 'GDBus.Error:%s: ' % name
+        if msg.startswith(remote):
+            msg = msg[len(remote):]
+    cls = DBUS_ERRORS.get(name, ModemError)
+    if (name == MM_ERROR_WRONG_STATE and modem and modem.modem_proxy and
+            not modem.enabled):
+        cls = ModemDisabledError
+    return cls("%s failed: %s" % (action, msg), name=name)
 
 
 class Modem(GObject.GObject):
     MM_DBUS_INTERFACE_MODEM = 'org.freedesktop.ModemManager1.Modem'
     MM_DBUS_INTERFACE_MODEM_GSM_USSD = "{}.Modem3gpp.Ussd".format(MM_DBUS_INTERFACE_MODEM)
+    MM_DBUS_INTERFACE_MODEM_MESSAGING = "{}.Messaging".format(MM_DBUS_INTERFACE_MODEM)
 
     MM_STATE_ENABLED = 6
 
+    __gsignals__ = {
+        # Emitted with the SMS's object path when an SMS got received
+        'sms-received': (GObject.SignalFlags.RUN_FIRST, None,
+                         [str]),
+    }
+
     def on_new_proxy_done(self, proxy, res, iface_name):
         try:
             _proxy = proxy.new_for_bus_finish(res)
         except GLib.Error:
             logging.exception("Failed to get iface '%s' for modem %s",
                               iface_name, self.path)
+            return
         setattr(self, "_%s_proxy" % iface_name, _proxy)
+        if iface_name == 'messaging':
+            _proxy.connect('g-signal', self.on_messaging_signal)
+
+    def on_messaging_signal(self, proxy, sender, signal, params):
+        if signal != 'Added':
+            return
+        (path, received) = params.unpack()
+        if received:
+            logging.debug("Received SMS %s on %s", path, self.path)
+            self.emit('sms-received', path)
 
     def __init__(self, path):
         GObject.GObject.__init__(self)
@@ -76,6 +194,17 @@ class Modem(GObject.GObject):
                                   self.on_new_proxy_done,
                                   'ussd')
 
+        self._messaging_proxy = None
+        Gio.DBusProxy.new_for_bus(Gio.BusType.SYSTEM,
+                                  Gio.DBusProxyFlags.DO_NOT_LOAD_PROPERTIES,
+                                  None,
+                                  MM_DBUS_SERVICE,
+                                  self.path,
+                                  self.MM_DBUS_INTERFACE_MODEM_MESSAGING,
+                                  None,
+                                  self.on_new_proxy_done,
+                                  'messaging')
+
     @property
     def path(self):
         return self._path
@@ -88,18 +217,362 @@ class Modem(GObject.GObject):
     def ussd_proxy(self):
         return self._ussd_proxy
 
+    @property
+    def messaging_proxy(self):
+        return self._messaging_proxy
+
     @property
     def enabled(self):
         variant = self.modem_proxy.get_cached_property("State")
         return variant.get_int32() >= self.MM_STATE_ENABLED
 
 
+class UssdSession(object):
+    """
+    A scripted USSD session on a single modem
+
+    The session initiates the script's command and answers the network's
+    menus step by step. Once all steps got answered reply_func is invoked
+    with the last reply, on errors or if the session takes longer than
+    timeout seconds error_func gets a L{ModemError}. Sessions on different
+    modems are independent of each other so they can run concurrently.
+    A session waiting for a governor is pending, its timeout includes the
+    time spent waiting.
+
+    @ivar replies: all replies received from the network so far
+    """
+
+    def __init__(self, modem, script, code=None, reply_func=None,
+                 error_func=None, timeout=USSD_SESSION_TIMEOUT, stats=None,
+                 done_func=None, timeouts=None, provider=None):
+        self.modem = modem
+        self.script = script
+        self.code = code
+        self.reply_func = reply_func
+        self.error_func = error_func
+        self.done_func = done_func
+        self.timeout = timeout
+        self.stats = stats
+        self.replies = []
+        self.step = 0
+        self.timer = None
+        self.start_time = None
+        self.finished = False
+        self.cancellable = None
+        self.timeouts = timeouts
+        self.provider = provider
+        self.call_start = None
+        self.call_timeout = MM_DBUS_TIMEOUT
+        self.governor = None
+
+    @property
+    def active(self):
+        return self.start_time is not None and not self.finished
+
+    @property
+    def pending(self):
+        return (self.governor is not None and self.start_time is None and
+                not self.finished)
+
+    @property
+    def name(self):
+        return self.script.name
+
+    def _call(self, method, args, callback):
+        if self.timeouts:
+            self.call_timeout = self.timeouts.get(self.provider,
+                                                  self.script.name)
+        self.call_start = time.monotonic()
+        self.modem.ussd_proxy.call(method, args,
+                                   Gio.DBusCallFlags.NO_AUTO_START,
+                                   self.call_timeout, self.cancellable,
+                                   callback, None)
+
+    def queue(self, governor):
+        """
+        Start the session once governor lets it through
+
+        @type governor: L{ppm.governor.UssdGovernor}
+        """
+        self.governor = governor
+        self.timer = GLib.timeout_add_seconds(self.timeout, self.on_timeout)
+        governor.submit(self.provider, self.start)
+
+    def start(self):
+        logging.debug("Starting USSD session '%s' on %s", self.script.name,
+                      self.modem.path)
+        self.start_time = time.monotonic()
+        self.cancellable = Gio.Cancellable()
+        if not self.timer:
+            self.timer = GLib.timeout_add_seconds(self.timeout,
+                                                  self.on_timeout)
+        try:
+            self._call("Initiate",
+                       GLib.Variant('(s)',
+                                    (self.script.get_command(self.code),)),
+                       self.on_reply)
+        except Exception as err:
+            # Finish right away so we don't block the modem
+            logging.exception("Starting USSD session '%s' failed",
+                              self.script.name)
+            self._finish(False)
+            if self.error_func:
+                self.error_func(ModemError("Starting USSD session '%s' "
+                                           "failed: %s" % (self.script.name,
+                                                           err)))
+
+    def cancel(self):
+        """Cancel a running or pending session"""
+        if not self.active and not self.pending:
+            return
+        self._fail(ModemError("USSD session '%s' canceled" % self.script.name))
+
+    def _finish(self, ok):
+        self.finished = True
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.stats and self.start_time is not None:
+            self.stats.record('ussd_session', time.monotonic() - self.start_time,
+                              ok=ok)
+        if self.done_func:
+            self.done_func(self)
+
+    def _cancel_network_session(self):
+        # Ignore failures, the network might have closed the session already
+        self.modem.ussd_proxy.call("Cancel", None,
+                                   Gio.DBusCallFlags.NO_AUTO_START,
+                                   MM_DBUS_TIMEOUT, None, None, None)
+
+    def _fail(self, error):
+        if self.pending:
+            self.governor.cancel(self.provider, self.start)
+        else:
+            self.cancellable.cancel()
+            self._cancel_network_session()
+        self._finish(False)
+        logging.debug("USSD session '%s' on %s failed: %s", self.script.name,
+                      self.modem.path, error.msg)
+        if self.error_func:
+            self.error_func(error)
+
+    def on_timeout(self):
+        self.timer = None
+        self._fail(ModemTimeoutError("USSD session '%s' timed out after %d "
+                                     "seconds" % (self.script.name,
+                                                  self.timeout)))
+        return False
+
+    def on_reply(self, proxy, res, user_data):
+        if not self.active:
+            return
+        try:
+            reply = proxy.call_finish(res).unpack()[0]
+        except GLib.Error as err:
+            if err.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED):
+                return
+            error = modem_error(err, "USSD session '%s'" % self.script.name,
+                                self.modem)
+            if self.timeouts and isinstance(error, ModemTimeoutError):
+                self.timeouts.record(self.provider, self.script.name, None,
+                                     timeout=self.call_timeout)
+            self._fail(error)
+            return
+
+        if self.timeouts:
+            self.timeouts.record(self.provider, self.script.name,
+                                 time.monotonic() - self.call_start)
+
+        logging.debug("USSD reply: %s", reply)
+        self.replies.append(reply)
+        if self.step < len(self.script.steps):
+            try:
+                response = self.script.get_response(self.step, reply, self.code)
+            except UssdScriptError as err:
+                self._fail(ModemError(err.msg))
+                return
+            self.step += 1
+            self._call("Respond", GLib.Variant('(s)', (response,)),
+                       self.on_reply)
+            return
+
+        # Don't leave the network waiting for input we won't send
+        (_, entries) = parse_menu(reply)
+        if entries:
+            self._cancel_network_session()
+        self._finish(True)
+        if self.reply_func:
+            self.reply_func(GLib.Variant('(s)', (reply,)), self)
+
+
+class SmsRequest(object):
+    """
+    Send an SMS to a provider and wait for the reply
+
+    The reply is the first SMS that arrives on the modem after sending the
+    request and is either from the number the request went to or from one
+    of the provider's reply senders as providers often reply from short
+    codes or alphanumeric senders. The matching is done by
+    L{ModemManagerProxy} which hands received messages to the pending
+    requests via L{deliver}.
+    """
+
+    MM_DBUS_INTERFACE_SMS = 'org.freedesktop.ModemManager1.Sms'
+    DBUS_INTERFACE_PROPERTIES = 'org.freedesktop.DBus.Properties'
+
+    MM_SMS_STATE_RECEIVING = 2
+
+    # Seconds between checks whether a multipart SMS is complete
+    RECEIVING_POLL = 2
+
+    def __init__(self, modem, number, text, reply_func=None, error_func=None,
+                 timeout=SMS_REPLY_TIMEOUT, stats=None, done_func=None,
+                 reply_senders=None):
+        """
+        @param reply_senders: senders besides number the provider replies
+            from
+        """
+        self.modem = modem
+        self.number = number
+        self.text = text
+        self.reply_senders = set(self._normalize(sender)
+                                 for sender in reply_senders or [])
+        self.reply_func = reply_func
+        self.error_func = error_func
+        self.done_func = done_func
+        self.timeout = timeout
+        self.stats = stats
+        self.timer = None
+        self.start_time = None
+        self.finished = False
+        self.sent_at = None
+        self.cancellable = None
+
+    @property
+    def name(self):
+        return 'sms'
+
+    @property
+    def active(self):
+        return self.start_time is not None and not self.finished
+
+    @staticmethod
+    def _normalize(number):
+        return number.strip().lstrip('+').replace(' ', '')
+
+    def matches(self, sender, received):
+        """
+        Whether an SMS from sender is a reply to this request
+
+        @param received: when the SMS arrived, in C{time.monotonic()} time
+        """
+        if self.sent_at is None or received < self.sent_at:
+            return False
+        sender = self._normalize(sender or '')
+        if not sender:
+            return False
+        return (sender == self._normalize(self.number) or
+                sender in self.reply_senders)
+
+    def _messaging_call(self, method, args, callback):
+        self.modem.messaging_proxy.call(method, args,
+                                        Gio.DBusCallFlags.NO_AUTO_START,
+                                        MM_DBUS_TIMEOUT, self.cancellable,
+                                        callback, None)
+
+    def start(self):
+        logging.debug("Sending '%s' to %s via %s", self.text, self.number,
+                      self.modem.path)
+        self.start_time = time.monotonic()
+        if not self.modem.messaging_proxy:
+            self._fail(ModemError("%s can't send SMS" % self.modem.path))
+            return
+        self.cancellable = Gio.Cancellable()
+        self.timer = GLib.timeout_add_seconds(self.timeout, self.on_timeout)
+        props = {'number': GLib.Variant('s', self.number),
+                 'text': GLib.Variant('s', self.text)}
+        self._messaging_call("Create", GLib.Variant('(a{sv})', (props,)),
+                             self.on_created)
+
+    def _finish(self, ok):
+        self.finished = True
+        if self.timer:
+            GLib.source_remove(self.timer)
+            self.timer = None
+        if self.stats:
+            self.stats.record('sms_request', time.monotonic() - self.start_time,
+                              ok=ok)
+        if self.done_func:
+            self.done_func(self)
+
+    def _fail(self, error):
+        if self.cancellable:
+            self.cancellable.cancel()
+        self._finish(False)
+        logging.debug("SMS request to %s failed: %s", self.number, error.msg)
+        if self.error_func:
+            self.error_func(error)
+
+    def delete(self, path):
+        """Delete an SMS from the modem's storage"""
+        # Ignore failures, the SMS might be gone already
+        if self.modem.messaging_proxy:
+            self.modem.messaging_proxy.call("Delete",
+                                            GLib.Variant('(o)', (path,)),
+                                            Gio.DBusCallFlags.NO_AUTO_START,
+                                            MM_DBUS_TIMEOUT, None, None, None)
+
+    def on_created(self, proxy, res, user_data):
+        if not self.active:
+            return
+        try:
+            (path,) = proxy.call_finish(res).unpack()
+        except GLib.Error as err:
+            self._fail(modem_error(err, "Creating SMS", self.modem))
+            return
+
+        # The reply can arrive before we learn that sending succeeded
+        self.sent_at = time.monotonic()
+        proxy.get_connection().call(MM_DBUS_SERVICE, path,
+                                    self.MM_DBUS_INTERFACE_SMS, "Send", None,
+                                    None, Gio.DBusCallFlags.NO_AUTO_START,
+                                    MM_DBUS_TIMEOUT, self.cancellable,
+                                    self.on_sent, path)
+
+    def on_sent(self, connection, res, path):
+        if not self.active:
+            return
+        try:
+            connection.call_finish(res)
+        except GLib.Error as err:
+            self._fail(modem_error(err, "Sending SMS", self.modem))
+            return
+        logging.debug("Sent SMS %s, awaiting reply", path)
+        self.delete(path)
+
+    def on_timeout(self):
+        self.timer = None
+        self._fail(ModemTimeoutError("No reply to SMS sent to %s within %d "
+                                     "seconds" % (self.number, self.timeout)))
+        return False
+
+    def deliver(self, text):
+        """Hand the provider's reply to this request"""
+        self._finish(True)
+        if self.reply_func:
+            self.reply_func(GLib.Variant('(s)', (text,)), self)
+
+
 class ModemManagerProxy(GObject.GObject):
     """Interface to ModemManager DBus API
-    @ivar request: current pending request to ModemManager
-    @type request: string
+    @ivar requests: requests to ModemManager awaiting their reply
+    @type requests: C{list}
     @ivar modem: dbus path of modem we're currently acting on
     @type modem: string
+    @ivar stats: counts and latencies of finished requests
+    @type stats: L{RequestStats}
+    @ivar governor: limits the USSD traffic, if any
+    @type governor: L{ppm.governor.UssdGovernor}
     """
 
     DBUS_INTERFACE_PROPERTIES = 'org.freedesktop.DBus.Properties'
@@ -111,12 +584,18 @@ class ModemManagerProxy(GObject.GObject):
     IMSI_RE = r'\d{14,15}'
 
     __gsignals__ = {
-        # Emitted when a request to MM starts
+        # Emitted with the request's name when a request to MM got sent
         'request-started': (GObject.SignalFlags.RUN_FIRST, None,
                             [object]),
-        # Emitted when a request has finished
+        # Emitted with the request's name when a request has finished
         'request-finished': (GObject.SignalFlags.RUN_FIRST, None,
                              [object]),
+        # Emitted when a scripted USSD session or SMS request starts
+        'session-started': (GObject.SignalFlags.RUN_FIRST, None,
+                            [object]),
+        # Emitted when a scripted USSD session or SMS request has finished
+        'session-finished': (GObject.SignalFlags.RUN_FIRST, None,
+                             [object]),
         # Emitted when modem search completed
         'got-modems': (GObject.SignalFlags.RUN_FIRST, None,
                        [object]),
@@ -130,14 +609,31 @@ class ModemManagerProxy(GObject.GObject):
         else:
             self.object_manager = proxy
 
-    def __init__(self):
+    def __init__(self, stats=None, timeouts=None, governor=None,
+                 modem_filter=None):
+        """
+        @param stats: where to record request statistics
+        @param timeouts: D-Bus timeouts to use for requests to the network
+        @type timeouts: L{AdaptiveTimeouts}
+        @param governor: USSD requests and sessions wait for it to let them
+            through
+        @type governor: L{ppm.governor.UssdGovernor}
+        @param modem_filter: only handle modems whose D-Bus path this
+            returns C{True} for
+        """
         GObject.GObject.__init__(self)
-        self.request = None
-        self.reply_func = None
-        self.error_func = None
+        self.requests = []
+        self.stats = stats if stats is not None else RequestStats()
+        self.timeouts = (timeouts if timeouts is not None
+                         else AdaptiveTimeouts(MM_DBUS_TIMEOUT))
+        self.governor = governor
+        self.modem_filter = modem_filter
         self.modem = None
         self.obj = None
         self.objs = None
+        self.sessions = {}
+        self.sms_requests = []
+        self.find_modems_span = None
 
         self.object_manager = None
         Gio.DBusProxy.new_for_bus(Gio.BusType.SYSTEM,
@@ -164,63 +660,89 @@ class ModemManagerProxy(GObject.GObject):
     def set_modem(self, modem):
         self.modem = modem
 
-    def mm_request(func):
-        def wrapped_f(self, *args, **kw):
-            self.request = "%s" % func.__name__
-            if 'reply_func' in kw:
-                self.reply_func = kw['reply_func']
-            if 'error_func' in kw:
-                self.error_func = kw['error_func']
-            self.emit('request-started', self)
-            func(self, *args, **kw)
-        wrapped_f.__name__ = func.__name__
-        wrapped_f.__doc__ = func.__doc__
-        return wrapped_f
-
-    def mm_request_done(func):
-        def wrapped_f(self, *args, **kw):
-            self.emit('request-finished', self)
-            ret = func(self, *args, **kw)
-            self.reply_func = None
-            self.error_func = None
-            self.request = None
-            return ret
-        wrapped_f.__name__ = func.__name__
-        wrapped_f.__doc__ = func.__doc__
-        return wrapped_f
-
     def request_pending(self):
-        if self.request:
-            return True
-        else:
-            return False
+        return True if self.requests else False
 
     @property
     def modems(self):
         return self._modems
 
-    @mm_request_done
-    def handle_dbus_reply(self, obj, result, user_data):
+    def _new_request(self, name, reply_func, error_func, provider=None,
+                     operation=None):
+        """
+        Everything needed to send a request and handle its reply
+
+        Requests might wait for the governor while others get sent so
+        each request keeps its own state.
+
+        @param operation: what the request does, used to pick the timeout
+            for provider, defaults to name
+        """
+        operation = operation or name
+        return {
+            'name': name,
+            'operation': operation,
+            'start': None,
+            'provider': provider,
+            'timeout': self.timeouts.get(provider, operation),
+            'modem': self.modem,
+            'reply_func': reply_func,
+            'error_func': error_func,
+            'governed': False,
+        }
+
+    def _send(self, request, call):
+        """
+        Send request, call does the actual D-Bus call
+
+        The reply must be handed to L{handle_dbus_reply} with the request
+        as user data.
+        """
+        request['start'] = time.monotonic()
+        self.requests.append(request)
+        self.emit('request-started', request['name'])
+        try:
+            call()
+        except Exception as err:
+            # No reply will come to finish the request
+            logging.exception("Sending %s failed", request['name'])
+            self._request_done(request)
+            if request['error_func']:
+                request['error_func'](ModemError("Sending %s failed: %s" %
+                                                 (request['name'], err)))
+
+    def _request_done(self, request):
+        self.requests.remove(request)
+        if request['governed']:
+            self.governor.release(request['provider'])
+        self.emit('request-finished', request['name'])
+
+    def handle_dbus_reply(self, obj, result, request):
+        self._request_done(request)
+        name = request['name']
+        latency = time.monotonic() - request['start']
         try:
             res = obj.call_finish(result)
-            if self.reply_func:
-                self.reply_func(res, user_data)
         except Exception as err:
-            if self.error_func:
-                # We don't get a proper error domain so we assume
-                # 'GDBus.Error:org.freedesktop.*: <error message>
-                msg = err.message.split(':', 2)
-                if len(msg) == 3:
-                    msg = msg[-1]
-                else:
-                    msg = err.message
-                print(msg)
-                me = ModemError("%s failed: %s" % (self.request.replace('_', ' '),
-                                                   msg))
-                self.error_func(me)
+            self.stats.record(name, latency, ok=False)
+            me = modem_error(err, name.replace('_', ' '), request['modem'])
+            if isinstance(me, ModemTimeoutError):
+                self.timeouts.record(request['provider'],
+                                     request['operation'], None,
+                                     timeout=request['timeout'])
+            if request['error_func']:
+                request['error_func'](me)
+        else:
+            self.stats.record(name, latency)
+            self.timeouts.record(request['provider'], request['operation'],
+                                 latency)
+            if request['reply_func']:
+                request['reply_func'](res, None)
 
     def on_get_managed_objects_finished(self, proxy, res, user_data):
         self._modems = []
+        profiling.end(self.find_modems_span)
+        self.find_modems_span = None
 
         try:
             objs = proxy.call_finish(res)
@@ -229,10 +751,15 @@ class ModemManagerProxy(GObject.GObject):
             objs = []
             return
 
+        self.objs = {}
         for obj in objs:
+            self.objs.update(obj)
             for path, ifaces in obj.items():
-                if Modem.MM_DBUS_INTERFACE_MODEM in ifaces:
-                    self._modems.append(Modem(path))
+                if Modem.MM_DBUS_INTERFACE_MODEM not in ifaces:
+                    continue
+                if self.modem_filter and not self.modem_filter(path):
+                    continue
+                self._modems.append(Modem(path))
         logging.debug("Found modems: %s", self.modems)
         self.emit('got-modems', self)
 
@@ -242,6 +769,7 @@ class ModemManagerProxy(GObject.GObject):
 
         Result will be in modems property
         """
+        self.find_modems_span = profiling.begin('dbus_find_modems')
         self.object_manager.call("GetManagedObjects",
                                  None,
                                  Gio.DBusCallFlags.NO_AUTO_START,
@@ -250,37 +778,224 @@ class ModemManagerProxy(GObject.GObject):
                                  self.on_get_managed_objects_finished,
                                  None)
 
-    def get_imsi(self):
+    def _get_sim_path(self, modem):
+        return self.objects()[modem.path][Modem.MM_DBUS_INTERFACE_MODEM]['Sim']
+
+    def get_imsi(self, modem=None):
+        modem = modem or self.modem
+        sim_path = self._get_sim_path(modem)
+        if sim_path == '/':
+            raise SimMissingError("No SIM card in %s" % modem.path)
         card = Gio.DBusProxy.new_for_bus_sync(
             Gio.BusType.SYSTEM,
             MM_DBUS_FLAGS,
             None,
             MM_DBUS_SERVICE,
-            self.objects()[self.modem.path][Modem.MM_DBUS_INTERFACE_MODEM]['Sim'],
+            sim_path,
             self.DBUS_INTERFACE_PROPERTIES,
             None)
         try:
             return card.Get('(ss)', self.MM_DBUS_INTERFACE_SIM, 'Imsi')
-        except Exception as msg:
-            raise ModemError("Getting IMSI failed: %s" % msg)
+        except Exception as err:
+            raise modem_error(err, "Getting IMSI", modem)
+
+    def get_imsi_async(self, modem, reply_func, error_func):
+        """
+        Async method to get the IMSI of the SIM card in modem
 
-    def get_network_id(self):
+        reply_func is called with the IMSI and the modem, error_func
+        with a L{ModemError}
+        """
+        def on_done(connection, res, user_data):
+            try:
+                (imsi,) = connection.call_finish(res).unpack()
+            except GLib.Error as err:
+                error_func(modem_error(err, "Getting IMSI", modem))
+                return
+            reply_func(imsi, modem)
+
+        try:
+            sim_path = self._get_sim_path(modem)
+        except KeyError:
+            sim_path = '/'
+        if sim_path == '/':
+            error_func(SimMissingError("No SIM card in %s" % modem.path))
+            return
+
+        self.object_manager.get_connection().call(
+            MM_DBUS_SERVICE, sim_path,
+            self.DBUS_INTERFACE_PROPERTIES, "Get",
+            GLib.Variant('(ss)', (self.MM_DBUS_INTERFACE_SIM, 'Imsi')),
+            GLib.VariantType('(v)'),
+            Gio.DBusCallFlags.NO_AUTO_START,
+            MM_DBUS_TIMEOUT, None, on_done, None)
+
+    def get_network_id(self, resolver=None):
+        """
+        The mcc and mnc of the current modem's SIM card
+
+        @param resolver: knows the MNC lengths, without it a two digit MNC
+            is assumed
+        @type resolver: L{ppm.providerindex.NetworkIdResolver}
+        """
         imsi = self.get_imsi()
-        mcc = imsi[0:3]
-        mnc = imsi[3:5]
-        return (mcc, mnc)
+        if resolver:
+            return resolver.get_network_id(imsi)
+        return (imsi[0:3], imsi[3:5])
+
+    def ussd_initiate(self, command, reply_func=None, error_func=None,
+                      provider=None, operation=None):
+        """
+        @param provider: the provider's key to pick the timeout
+        @param operation: what the request does, e.g. 'balance' or
+            'top-up', so it shares its latencies with the USSD sessions
+            doing the same
+        """
+        request = self._new_request('ussd_initiate', reply_func, error_func,
+                                    provider=provider, operation=operation)
+
+        def start():
+            self._send(request, lambda: request['modem'].ussd_proxy.call(
+                "Initiate", GLib.Variant('(s)', (command,)),
+                Gio.DBusCallFlags.NO_AUTO_START, request['timeout'],
+                None, self.handle_dbus_reply, request))
+
+        if self.governor:
+            # Only counts as started once the governor lets it through
+            request['governed'] = True
+            self.governor.submit(provider, start)
+        else:
+            start()
+
+    def ussd_session(self, script, modem=None, code=None, reply_func=None,
+                     error_func=None, timeout=USSD_SESSION_TIMEOUT,
+                     provider=None):
+        """
+        Run a scripted USSD session, see L{UssdSession}
+
+        Only one session can run per modem but sessions on different modems
+        run concurrently.
+
+        @param modem: the modem to use, defaults to the current one
+        @param code: replaces the script's placeholder, e.g. a top up code
+        @param provider: the provider's key to pick the timeouts of the
+            single steps
+        @return: the session or C{None} if another session is active or
+            it failed to start
+        """
+        modem = modem or self.modem
+        if modem.path in self.sessions:
+            if error_func:
+                error_func(ModemError("USSD session already active on %s" %
+                                      modem.path))
+            return None
+
+        session = UssdSession(modem, script, code=code,
+                              reply_func=reply_func,
+                              error_func=error_func,
+                              timeout=timeout,
+                              stats=self.stats,
+                              done_func=self.on_ussd_session_done,
+                              timeouts=self.timeouts,
+                              provider=provider)
+        self.sessions[modem.path] = session
+        self.emit('session-started', session)
+        if self.governor:
+            session.queue(self.governor)
+        else:
+            session.start()
+        return None if session.finished else session
+
+    def on_ussd_session_done(self, session):
+        # Sessions canceled while waiting never got through the governor
+        if self.governor and session.start_time is not None:
+            self.governor.release(session.provider)
+        self.sessions.pop(session.modem.path, None)
+        self.emit('session-finished', session)
+
+    def sms_request(self, number, text, modem=None, reply_func=None,
+                    error_func=None, timeout=SMS_REPLY_TIMEOUT,
+                    reply_senders=None):
+        """
+        Send an SMS and wait for the reply, see L{SmsRequest}
 
-    @mm_request
-    def ussd_initiate(self, command, reply_func=None, error_func=None):
-        self.modem.ussd_proxy.call("Initiate", GLib.Variant('(s)', (command,)),
-                                   Gio.DBusCallFlags.NO_AUTO_START, MM_DBUS_TIMEOUT, None,
-                                   self.handle_dbus_reply, None)
+        reply_func and error_func are invoked like for the USSD requests
+        so callers can handle both the same way.
+
+        @param modem: the modem to use, defaults to the current one
+        @param reply_senders: senders besides number the provider replies
+            from
+        @return: the pending request
+        """
+        modem = modem or self.modem
+        if not any(request.modem is modem for request in self.sms_requests):
+            modem.connect('sms-received', self.on_sms_received)
+
+        request = SmsRequest(modem, number, text,
+                             reply_func=reply_func,
+                             error_func=error_func,
+                             timeout=timeout,
+                             stats=self.stats,
+                             done_func=self.on_sms_request_done,
+                             reply_senders=reply_senders)
+        self.sms_requests.append(request)
+        self.emit('session-started', request)
+        request.start()
+        return request
+
+    def on_sms_request_done(self, request):
+        self.sms_requests.remove(request)
+        if not any(r.modem is request.modem for r in self.sms_requests):
+            request.modem.disconnect_by_func(self.on_sms_received)
+        self.emit('session-finished', request)
+
+    def on_sms_received(self, modem, path, attempt=0, received=None):
+        if received is None:
+            received = time.monotonic()
+        if not modem.messaging_proxy:
+            return False
+        modem.messaging_proxy.get_connection().call(
+            MM_DBUS_SERVICE, path,
+            SmsRequest.DBUS_INTERFACE_PROPERTIES, "GetAll",
+            GLib.Variant('(s)', (SmsRequest.MM_DBUS_INTERFACE_SMS,)),
+            GLib.VariantType('(a{sv})'),
+            Gio.DBusCallFlags.NO_AUTO_START,
+            MM_DBUS_TIMEOUT, None,
+            self.on_sms_properties, (modem, path, attempt, received))
+        return False
+
+    def on_sms_properties(self, connection, res, user_data):
+        (modem, path, attempt, received) = user_data
+        try:
+            (props,) = connection.call_finish(res).unpack()
+        except GLib.Error as err:
+            logging.warning("Reading SMS %s failed: %s", path, err.message)
+            return
+
+        if (props.get('State') == SmsRequest.MM_SMS_STATE_RECEIVING and
+                attempt * SmsRequest.RECEIVING_POLL < SMS_REPLY_TIMEOUT):
+            # Not all parts of a multipart SMS arrived yet
+            GLib.timeout_add_seconds(SmsRequest.RECEIVING_POLL,
+                                     self.on_sms_received,
+                                     modem, path, attempt + 1, received)
+            return
+
+        sender = props.get('Number', '')
+        for request in self.sms_requests:
+            if request.modem is modem and request.matches(sender, received):
+                logging.debug("SMS %s from %s answers request to %s",
+                              path, sender, request.number)
+                request.delete(path)
+                request.deliver(props.get('Text', ''))
+                return
+        logging.debug("Ignoring SMS %s from %s", path, sender)
 
-    @mm_request
     def _modem__enable(self, enable, reply_func=None, error_func=None):
-        self.modem.modem_proxy.call("Enable", GLib.Variant('(b)', (enable,)),
-                                    Gio.DBusCallFlags.NO_AUTO_START, MM_DBUS_TIMEOUT, None,
-                                    self.handle_dbus_reply, None)
+        request = self._new_request('_modem__enable', reply_func, error_func)
+        self._send(request, lambda: request['modem'].modem_proxy.call(
+            "Enable", GLib.Variant('(b)', (enable,)),
+            Gio.DBusCallFlags.NO_AUTO_START, MM_DBUS_TIMEOUT, None,
+            self.handle_dbus_reply, request))
 
     def modem_enable(self, reply_func=None, error_func=None):
         self._modem__enable(True,
@@ -288,6 +1003,6 @@ class ModemManagerProxy(GObject.GObject):
                             error_func=error_func)
 
     def modem_disable(self, reply_func=None, error_func=None):
-        self._modem_enable(False,
-                           reply_func=reply_func,
-                           error_func=error_func)
+        self._modem__enable(False,
+                            reply_func=reply_func,
+                            error_func=error_func)
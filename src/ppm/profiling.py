@@ -0,0 +1,148 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""
+Find out where time goes
+
+When enabled the whole process runs under cProfile and named spans
+record when interesting phases like loading the provider database start
+and how long they take. Both are written out on exit. When disabled
+L{span}, L{begin} and L{end} do next to nothing.
+"""
+
+from builtins import object
+import atexit
+import cProfile
+import contextlib
+import json
+import logging
+import time
+
+_profiler = None
+
+
+class Profiler(object):
+    """
+    cProfile data and a timeline of spans
+
+    @ivar spans: finished spans as (name, start, duration) with start
+        relative to when profiling started
+    """
+
+    def __init__(self, path):
+        """
+        @param path: file to write the cProfile data to, the span timeline
+            goes to I{path}.spans
+        """
+        self.path = path
+        self.profile = cProfile.Profile()
+        self.origin = time.monotonic()
+        self.spans = []
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def record(self, name, start, end):
+        self.spans.append((name, start - self.origin, end - start))
+
+    def write(self):
+        self.profile.dump_stats(self.path)
+        with open(self.path + '.spans', 'w') as f:
+            for (name, start, duration) in sorted(self.spans,
+                                                  key=lambda s: s[1]):
+                f.write(json.dumps({'name': name,
+                                    'start': round(start, 6),
+                                    'duration': round(duration, 6)}) + '\n')
+        logging.info("Wrote profile to '%s' and spans to '%s.spans'",
+                     self.path, self.path)
+
+
+def enable(path):
+    """Profile the rest of the process and write the results on exit"""
+    global _profiler
+
+    if _profiler:
+        return _profiler
+    _profiler = Profiler(path)
+    atexit.register(_write)
+    _profiler.start()
+    return _profiler
+
+
+def _write():
+    global _profiler
+
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return
+    profiler.stop()
+    profiler.write()
+
+
+def begin(name):
+    """
+    Start a span that ends in a different place, e.g. in a callback
+
+    @return: token to pass to L{end}
+    """
+    if _profiler is None:
+        return None
+    return (name, time.monotonic())
+
+
+def end(token):
+    """End a span started with L{begin}"""
+    if _profiler is None or token is None:
+        return
+    (name, start) = token
+    _profiler.record(name, start, time.monotonic())
+
+
+@contextlib.contextmanager
+def _span(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if _profiler:
+            _profiler.record(name, start, time.monotonic())
+
+
+_no_span = contextlib.nullcontext()
+
+
+def span(name):
+    """Context manager recording the time spent in its body as span name"""
+    if _profiler is None:
+        return _no_span
+    return _span(name)
+
+
+def spanned(name):
+    """Decorator recording every call of the function as span name"""
+    def decorator(func):
+        def wrapped_f(*args, **kw):
+            if _profiler is None:
+                return func(*args, **kw)
+            with _span(name):
+                return func(*args, **kw)
+        wrapped_f.__name__ = func.__name__
+        wrapped_f.__doc__ = func.__doc__
+        return wrapped_f
+    return decorator
@@ -17,6 +17,8 @@
 from builtins import object
 import logging
 
+from . ussd import UssdScript
+
 
 class ProviderError(Exception):
     def __init__(self, msg):
@@ -38,6 +40,8 @@ class Provider(object):
         self.name = name
         self.fetch_balance_cmds = {}
         self.top_up_cmds = {}
+        self.ussd_scripts = {}
+        self.sms_reply_senders = []
         logging.debug("New provider: %s, %s", country, name)
 
     def add_fetch_balance_cmd(self, cmd):
@@ -48,23 +52,35 @@ class Provider(object):
         self.top_up_cmds.update(cmd)
         logging.debug("Adding top up %s" % cmd)
 
+    def add_sms_reply_senders(self, senders):
+        """Short codes or names replies to our SMS come from"""
+        self.sms_reply_senders.extend(sender for sender in senders
+                                      if sender not in self.sms_reply_senders)
+
+    def add_ussd_script(self, script):
+        """Add a scripted USSD session, see L{ppm.ussd.UssdScript}"""
+        self.ussd_scripts[script.name] = script
+        logging.debug("Adding USSD script %s" % script)
+
     def has_fetch_balance_cmd(self):
-        # Only USSD for now
-        if 'ussd' in self.fetch_balance_cmds:
+        if ('ussd' in self.fetch_balance_cmds or
+                'sms' in self.fetch_balance_cmds or
+                'balance' in self.ussd_scripts):
             return True
         else:
             return False
 
     def has_top_up_cmd(self):
-        # Only USSD for now
-        if 'ussd' in self.top_up_cmds:
+        if ('ussd' in self.top_up_cmds or
+                'sms' in self.top_up_cmds or
+                'top-up' in self.ussd_scripts):
             return True
         else:
             return False
 
     def get_top_up_code_length(self):
         """The length of the topup code"""
-        if self.has_top_up_cmd():
+        if 'ussd' in self.top_up_cmds:
             return self.top_up_cmds['ussd'][2]
         else:
             return 0
@@ -73,22 +89,77 @@ class Provider(object):
     def top_up_code_length(self):
         return self.get_top_up_code_length()
 
-    def fetch_balance(self, mm, reply_func=None, error_func=None):
-        if self.has_fetch_balance_cmd():
+    @property
+    def key(self):
+        """Identifies the provider across countries, e.g. in settings"""
+        return '%s:%s' % (self.country, self.name)
+
+    def fetch_balance(self, mm, reply_func=None, error_func=None, modem=None):
+        """
+        Query the balance
+
+        @param modem: the modem to use. If given the query runs as a USSD
+            session on that modem so queries on several modems can run
+            concurrently. Otherwise mm's current modem is used.
+        @return: C{False} if the query didn't start, error_func might have
+            been called already
+        """
+        if 'balance' in self.ussd_scripts:
+            return bool(mm.ussd_session(self.ussd_scripts['balance'],
+                                        modem=modem,
+                                        provider=self.key,
+                                        reply_func=reply_func,
+                                        error_func=error_func))
+        elif 'ussd' in self.fetch_balance_cmds and modem:
+            return bool(mm.ussd_session(
+                UssdScript('balance', self.fetch_balance_cmds['ussd']),
+                modem=modem,
+                provider=self.key,
+                reply_func=reply_func,
+                error_func=error_func))
+        elif 'ussd' in self.fetch_balance_cmds:
             mm.ussd_initiate(self.fetch_balance_cmds['ussd'],
+                             provider=self.key,
+                             operation='balance',
                              reply_func=reply_func,
                              error_func=error_func)
             return True
+        elif 'sms' in self.fetch_balance_cmds:
+            (number, text) = self.fetch_balance_cmds['sms']
+            mm.sms_request(number, text,
+                           modem=modem,
+                           reply_func=reply_func,
+                           error_func=error_func,
+                           reply_senders=self.sms_reply_senders)
+            return True
         else:
             return False
 
     def top_up(self, mm, code, reply_func=None, error_func=None):
-        if self.has_top_up_cmd():
+        if 'top-up' in self.ussd_scripts:
+            return bool(mm.ussd_session(self.ussd_scripts['top-up'],
+                                        code=code,
+                                        provider=self.key,
+                                        reply_func=reply_func,
+                                        error_func=error_func))
+        elif 'ussd' in self.top_up_cmds:
             cmd = self.top_up_cmds['ussd'][0].replace(
                 self.top_up_cmds['ussd'][1],
                 code)
             logging.debug("Top up cmd: %s", cmd)
-            mm.ussd_initiate(cmd, reply_func=reply_func, error_func=error_func)
+            mm.ussd_initiate(cmd, provider=self.key, operation='top-up',
+                             reply_func=reply_func, error_func=error_func)
+            return True
+        elif 'sms' in self.top_up_cmds:
+            (number, text, replacement) = self.top_up_cmds['sms']
+            if replacement:
+                text = text.replace(replacement, code)
+            else:
+                text = "%s %s" % (text, code)
+            logging.debug("Top up SMS to %s: %s", number, text)
+            mm.sms_request(number, text, reply_func=reply_func,
+                           error_func=error_func,
+                           reply_senders=self.sms_reply_senders)
             return True
         else:
             return False
@@ -14,50 +14,171 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program; if not, see <http://www.gnu.org/licenses/>.
 
-from builtins import object
+import gettext
+import locale
 import os
 import logging
+import threading
 from lxml import etree
+from gi.repository import GLib
+from gi.repository import GObject
+from gi.repository import Gio
 
 from . provider import Provider
+from . providerindex import (ProviderIndex, NetworkIdResolver)
+from . import profiling
+from . ussd import (UssdScript, UssdScriptError)
 
 
-class ProviderDB(object):
-    """Proxy to mobile broadband provider database"""
+class ProviderDB(GObject.GObject):
+    """
+    Proxy to mobile broadband provider database
+
+    Once L{watch} got called the database files are monitored. On changes
+    the tree and all indexes get rebuilt in a background thread and swapped
+    in from the main loop in one go, after that 'changed' is emitted.
+    """
+
+    __gsignals__ = {
+        # Emitted after the database got reloaded
+        'changed': (GObject.SignalFlags.RUN_FIRST, None,
+                    []),
+    }
+
+    # Milliseconds to wait for further file changes before reloading
+    RELOAD_DELAY = 1000
 
     provider_info = os.getenv('PPM_PROVIDER_DB',
                               '/usr/share/mobile-broadband-provider-info/'
                               'serviceproviders.xml')
     country_codes = '/usr/share/zoneinfo/iso3166.tab'
+    # Local additions using the same layout as the provider database
+    ussd_scripts = os.getenv('PPM_USSD_SCRIPTS',
+                             os.path.join(GLib.get_user_config_dir(),
+                                          'prepaid-manager-applet',
+                                          'ussd-scripts.xml'))
+
+    # gettext domains of the iso-codes country name translations
+    country_domains = ['iso_3166-1', 'iso_3166']
 
     def __init__(self):
+        GObject.GObject.__init__(self)
         self.__tree = None
-        self.__countries = {}
+        self.__countries = None
+        self.__country_table = None
+        self.__index = None
+        self.__network_ids = None
+        self.__scripts = None
+        self.monitors = []
+        self.reload_timer = None
+        self.reloading = False
+        self.reload_pending = False
 
     @property
     def tree(self):
         if self.__tree:
             return self.__tree
         else:
-            self.__tree = etree.parse(self.provider_info)
+            with profiling.span('ProviderDB.tree'):
+                self.__tree = etree.parse(self.provider_info)
             return self.__tree
 
+    @property
+    def index(self):
+        """Search index over countries and providers"""
+        if self.__index is None:
+            self.__index = ProviderIndex(self.tree, self.countries)
+        return self.__index
+
+    @property
+    def network_ids(self):
+        """Resolver from IMSIs to network ids and providers"""
+        if self.__network_ids is None:
+            self.__network_ids = NetworkIdResolver(self.tree)
+        return self.__network_ids
+
+    @property
+    def scripts(self):
+        """USSD scripts keyed by (country code, provider name)"""
+        if self.__scripts is None:
+            self.__scripts = self._load_ussd_scripts()
+        return self.__scripts
+
+    def _load_ussd_scripts(self):
+        """
+        Load scripted USSD sessions. The file looks like the provider
+        database with the providers having ussd-script elements:
+
+        <ussd-script name="balance">
+          <initiate>*100#</initiate>
+          <select>Balance</select>
+          <respond>1</respond>
+        </ussd-script>
+        """
+        scripts = {}
+        if not os.path.exists(self.ussd_scripts):
+            return scripts
+
+        try:
+            tree = etree.parse(self.ussd_scripts)
+        except etree.XMLSyntaxError as msg:
+            logging.warning("Loading USSD scripts failed: %s" % msg)
+            return scripts
+
+        for elem in tree.iter(tag='ussd-script'):
+            try:
+                provider_elem = elem.getparent()
+                key = (provider_elem.getparent().attrib['code'],
+                       provider_elem.findtext('name'))
+                name = elem.attrib['name']
+            except (AttributeError, KeyError):
+                logging.warning("Skipping USSD script without provider or "
+                                "name in line %s", elem.sourceline)
+                continue
+            command = elem.findtext('initiate')
+            if not command:
+                logging.warning("Skipping USSD script '%s' for %s: no "
+                                "initiate", name, key)
+                continue
+            script = UssdScript(name, command,
+                                replacement=elem.attrib.get('replacement'))
+            try:
+                for step in elem.iterchildren(tag=etree.Element):
+                    if step.tag != 'initiate':
+                        script.add_step(step.tag, step.text)
+            except UssdScriptError as err:
+                logging.warning("Skipping USSD script '%s' for %s: %s",
+                                script.name, key, err.msg)
+                continue
+            scripts.setdefault(key, []).append(script)
+        return scripts
+
     @property
     def countries(self):
-        if self.__countries:
-            return self.__countries
-        else:
-            self._tree = self._load_countries()
-            return self.__countries
+        """Map of lower case country codes to localized country names"""
+        if self.__countries is None:
+            self.__countries = self._load_countries()
+        return self.__countries
+
+    def _get_country_translation(self):
+        for domain in self.country_domains:
+            try:
+                return gettext.translation(domain)
+            except (IOError, OSError):
+                continue
+        return gettext.NullTranslations()
 
     def _load_countries(self):
+        countries = {}
+        translation = self._get_country_translation()
         try:
             for line in open(self.country_codes, 'r'):
                 if line[0] != '#':
                     (code, country) = line.split('\t', 2)
-                    self.__countries[code.lower()] = country.strip()
+                    countries[code.lower()] = translation.gettext(country.strip())
         except IOError as msg:
             logging.warning("Loading country code database failed: %s" % msg)
+        return countries
 
     def _fill_provider_info(self, provider_elem):
         """Fill a provider object with data from the XML"""
@@ -69,6 +190,8 @@ class ProviderDB(object):
         if gsm_elem:
             self._fill_balance_check_cmd(gsm_elem[0], provider)
             self._fill_top_up_cmd(gsm_elem[0], provider)
+        for script in self.scripts.get((country, name), []):
+            provider.add_ussd_script(script)
         return provider
 
     def _fill_balance_check_cmd(self, xmlelemnt, provider):
@@ -83,6 +206,7 @@ class ProviderDB(object):
                     number = t.text
                     text = t.attrib['text']
                     provider.add_fetch_balance_cmd({'sms': (number, text)})
+                    self._fill_sms_reply_senders(t, provider)
 
     def _fill_top_up_cmd(self, xmlelement, provider):
         for child in xmlelement.iter(tag='balance-top-up'):
@@ -101,7 +225,16 @@ class ProviderDB(object):
                 if t.tag == 'sms':
                     number = t.text
                     text = t.attrib['text']
-                    provider.add_top_up_cmd({'sms': (number, text)})
+                    replacement = t.attrib.get('replacement')
+                    provider.add_top_up_cmd({'sms': (number, text,
+                                                     replacement)})
+                    self._fill_sms_reply_senders(t, provider)
+
+    def _fill_sms_reply_senders(self, xmlelement, provider):
+        """Senders the provider replies from, comma separated in reply-from"""
+        senders = xmlelement.attrib.get('reply-from', '')
+        provider.add_sms_reply_senders([sender.strip() for sender in
+                                        senders.split(',') if sender.strip()])
 
     def get_providers(self, mcc, mnc):
         """
@@ -119,6 +252,18 @@ class ProviderDB(object):
             return None
         return providers
 
+    def get_providers_by_imsi(self, imsi):
+        """
+        Get possible providers for a SIM card with two or three digit MNC
+
+        @return: mcc, mnc and the list of providers
+        """
+        try:
+            (mcc, mnc, elems) = self.network_ids.resolve(imsi)
+        except etree.XMLSyntaxError:
+            return (imsi[0:3], imsi[3:5], [])
+        return (mcc, mnc, [self._fill_provider_info(elem) for elem in elems])
+
     def get_provider(self, country_code, name):
         path = "//country[@code='%s']/provider[name='%s']" % (country_code, name)
         searcher = etree.ETXPath(path)
@@ -127,11 +272,11 @@ class ProviderDB(object):
             return self._fill_provider_info(r)
         return None
 
-    def get_country_codes(self):
+    def get_country_codes(self, tree=None):
         path = "/serviceproviders/country"
         searcher = etree.ETXPath(path)
 
-        for r in searcher(self.tree):
+        for r in searcher(tree or self.tree):
             yield r.attrib['code']
 
     def get_country_by_code(self, code):
@@ -141,17 +286,106 @@ class ProviderDB(object):
         except KeyError:
             return None
 
+    def get_country_table(self):
+        """
+        All countries in the provider database as (name, code) tuples sorted
+        by their localized name. Countries without a known name use the
+        country code as name.
+
+        The table is only built once.
+        """
+        if self.__country_table is None:
+            self.__country_table = self._build_country_table(self.tree,
+                                                             self.countries)
+        return self.__country_table
+
+    def _build_country_table(self, tree, countries):
+        table = []
+        for code in self.get_country_codes(tree):
+            table.append((countries.get(code, code), code))
+        table.sort(key=lambda entry: locale.strxfrm(entry[0]))
+        return table
+
     def get_countries(self):
-        for code in self.get_country_codes():
-            try:
-                yield (self.countries[code], code)
-            except KeyError:
-                yield (None, code)
+        return iter(self.get_country_table())
 
     def get_providers_by_code(self, country_code):
-        path = ("/serviceproviders/country[@code='%s']/provider/name" %
-                country_code)
-        searcher = etree.ETXPath(path)
+        return iter(self.index.get_provider_names(country_code))
 
-        for r in searcher(self.tree):
-            yield r.text
+    def search(self, query, kind=None, country_code=None):
+        """
+        Search countries and providers by name or network id
+
+        See L{ProviderIndex.search}
+        """
+        return self.index.search(query, kind=kind, country_code=country_code)
+
+    def watch(self):
+        """Reload the database when its files change"""
+        for path in [self.provider_info, self.ussd_scripts]:
+            monitor = Gio.File.new_for_path(path).monitor_file(
+                Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect('changed', self.on_file_changed)
+            self.monitors.append(monitor)
+
+    def on_file_changed(self, monitor, file, other_file, event_type):
+        if event_type not in [Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                              Gio.FileMonitorEvent.CREATED,
+                              Gio.FileMonitorEvent.DELETED,
+                              Gio.FileMonitorEvent.RENAMED,
+                              Gio.FileMonitorEvent.MOVED_IN]:
+            return
+        logging.debug("'%s' changed", file.get_path())
+        # Package updates touch the file several times, reload once
+        if self.reload_timer:
+            GLib.source_remove(self.reload_timer)
+        self.reload_timer = GLib.timeout_add(self.RELOAD_DELAY, self.reload)
+
+    def reload(self):
+        """Rebuild the tree and indexes in a thread and swap them in"""
+        self.reload_timer = None
+        if self.reloading:
+            self.reload_pending = True
+            return False
+
+        self.reloading = True
+        thread = threading.Thread(target=self._rebuild,
+                                  args=(self.countries,),
+                                  name='ppm-providerdb-reload',
+                                  daemon=True)
+        thread.start()
+        return False
+
+    def _rebuild(self, countries):
+        """Runs in a separate thread, must not touch the current state"""
+        state = None
+        try:
+            tree = etree.parse(self.provider_info)
+            state = (tree,
+                     self._build_country_table(tree, countries),
+                     ProviderIndex(tree, countries),
+                     NetworkIdResolver(tree),
+                     self._load_ussd_scripts())
+        except (IOError, etree.XMLSyntaxError) as msg:
+            logging.warning("Reloading provider database failed: %s", msg)
+        except Exception:
+            logging.exception("Reloading provider database failed")
+        finally:
+            # Always swap so later reloads aren't blocked
+            GLib.idle_add(self._swap, state)
+
+    def _swap(self, state):
+        self.reloading = False
+        if state:
+            (self.__tree,
+             self.__country_table,
+             self.__index,
+             self.__network_ids,
+             self.__scripts) = state
+            logging.info("Reloaded provider database")
+            self.emit('changed')
+
+        if self.reload_pending:
+            self.reload_pending = False
+            self.reload()
+        return False
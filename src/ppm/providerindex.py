@@ -0,0 +1,217 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import bisect
+import collections
+import re
+import unicodedata
+
+
+SearchEntry = collections.namedtuple('SearchEntry',
+                                     ['kind',         # 'country' or 'provider'
+                                      'code',         # country code
+                                      'country',      # country name
+                                      'provider',     # provider name or None
+                                      'network_ids',  # mcc + mnc strings
+                                      ])
+
+_SPLIT_RE = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize(text):
+    """Lower case text and strip accents so 'Österreich' matches 'oster'"""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _is_subsequence(needle, haystack):
+    it = iter(haystack)
+    return all(c in it for c in needle)
+
+
+class ProviderIndex(object):
+    """
+    Search index over countries, providers and network ids
+
+    The index is built in a single pass over the provider database's XML so
+    lookups don't need to touch the XML anymore. Matches are ranked: prefix
+    of the full name first, then prefix of a word in the name or of a
+    network id and finally fuzzy (subsequence) matches.
+    """
+
+    RANK_PREFIX, RANK_WORD, RANK_FUZZY = list(range(0, 3))
+
+    def __init__(self, tree, countries):
+        """
+        @param tree: the parsed provider database
+        @param countries: map of country codes to country names
+        """
+        self.entries = []
+        self.providers_by_code = {}
+        self._names = []
+        self._tokens = []
+        self._last = (None, None)
+        self._build(tree, countries)
+
+    def _add(self, entry, name, extra_tokens=()):
+        entry_id = len(self.entries)
+        self.entries.append(entry)
+        name = normalize(name)
+        self._names.append(name)
+        for token in set([t for t in _SPLIT_RE.split(name) if t] + list(extra_tokens)):
+            self._tokens.append((token, entry_id))
+
+    def _build(self, tree, countries):
+        for country_elem in tree.getroot().iterfind('country'):
+            code = country_elem.attrib['code']
+            country = countries.get(code, code)
+            self._add(SearchEntry('country', code, country, None, ()),
+                      country, [code])
+
+            names = self.providers_by_code.setdefault(code, [])
+            for provider_elem in country_elem.iterfind('provider'):
+                name = provider_elem.findtext('name')
+                if not name:
+                    continue
+                names.append(name)
+                network_ids = tuple(elem.attrib.get('mcc', '') +
+                                    elem.attrib.get('mnc', '')
+                                    for elem in provider_elem.iter('network-id'))
+                self._add(SearchEntry('provider', code, country, name,
+                                      network_ids),
+                          name, network_ids)
+        self._tokens.sort()
+
+    def _prefix_matches(self, query):
+        """Ids of all entries having a token starting with query"""
+        ids = set()
+        start = bisect.bisect_left(self._tokens, (query, -1))
+        for (token, entry_id) in self._tokens[start:]:
+            if not token.startswith(query):
+                break
+            ids.add(entry_id)
+        return ids
+
+    def _rank(self, query, candidates):
+        words = self._prefix_matches(query)
+        ranked = []
+        for entry_id in candidates:
+            name = self._names[entry_id]
+            if name.startswith(query):
+                rank = self.RANK_PREFIX
+            elif entry_id in words:
+                rank = self.RANK_WORD
+            elif _is_subsequence(query, name):
+                rank = self.RANK_FUZZY
+            else:
+                continue
+            ranked.append((rank, name, entry_id))
+        ranked.sort()
+        return [entry_id for (_, _, entry_id) in ranked]
+
+    def search(self, query, kind=None, country_code=None):
+        """
+        Find countries and providers matching query
+
+        Since every additional character can only narrow down the result
+        consecutive queries extending the previous one (as happens while
+        typing) only look at the previous matches.
+
+        @param query: name or network id (mcc + mnc) prefix
+        @param kind: only return entries of this kind ('country', 'provider')
+        @param country_code: only return entries from this country
+        @return: matching entries, best match first
+        @rtype: C{list} of L{SearchEntry}
+        """
+        query = normalize(query.strip())
+        if not query:
+            return []
+
+        (last_query, last_ids) = self._last
+        if last_query and query.startswith(last_query):
+            candidates = last_ids
+        else:
+            candidates = range(len(self.entries))
+
+        ids = self._rank(query, candidates)
+        self._last = (query, ids)
+
+        return [self.entries[i] for i in ids
+                if (kind is None or self.entries[i].kind == kind) and
+                (country_code is None or self.entries[i].code == country_code)]
+
+    def get_provider_names(self, country_code):
+        """Names of all providers in the given country"""
+        return self.providers_by_code.get(country_code, [])
+
+
+class NetworkIdResolver(object):
+    """
+    Map IMSIs to the providers whose network id they start with
+
+    The network ids (mcc + mnc) of all providers are kept in a trie so an
+    IMSI resolves in one walk over its first digits no matter whether the
+    network uses a two or three digit MNC. If both match the longer one
+    wins.
+    """
+
+    MCC_LEN = 3
+    MAX_MNC_LEN = 3
+
+    def __init__(self, tree):
+        """
+        @param tree: the parsed provider database
+        """
+        self._trie = {}
+        for elem in tree.getroot().iter('network-id'):
+            mcc = elem.attrib.get('mcc', '')
+            mnc = elem.attrib.get('mnc', '')
+            if len(mcc) != self.MCC_LEN or not mnc:
+                continue
+            provider_elem = next(elem.iterancestors('provider'), None)
+            if provider_elem is None:
+                continue
+            node = self._trie
+            for digit in mcc + mnc:
+                node = node.setdefault(digit, {})
+            providers = node.setdefault(None, (mcc, mnc, []))[2]
+            if provider_elem not in providers:
+                providers.append(provider_elem)
+
+    def resolve(self, imsi):
+        """
+        Find the network id at the start of imsi
+
+        @return: mcc, mnc and the matching provider elements. If nothing
+            matches the MNC is assumed to have two digits and the list of
+            providers is empty.
+        """
+        node = self._trie
+        match = None
+        for digit in imsi[:self.MCC_LEN + self.MAX_MNC_LEN]:
+            node = node.get(digit)
+            if node is None:
+                break
+            match = node.get(None, match)
+        if match:
+            return match
+        return (imsi[0:3], imsi[3:5], [])
+
+    def get_network_id(self, imsi):
+        """mcc and mnc of imsi"""
+        (mcc, mnc, _) = self.resolve(imsi)
+        return (mcc, mnc)
@@ -0,0 +1,207 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import time
+
+from gi.repository import GLib
+
+from . accountdb import (AccountDB, parse_balance)
+from . scheduler import RefreshScheduler
+
+
+class BalanceRefresher(object):
+    """
+    Fetch the balances of all modems' accounts without user interaction
+
+    The provider of a SIM card is taken from the account store, if the
+    account isn't known yet it's looked up by the IMSI's network id and only
+    used if that's unambiguous. Queries on different modems run
+    concurrently. Every result is handed to result_func as dict with the
+    keys modem, imsi, identifier, provider, country, balance, timestamp,
+    latency and error.
+
+    In continuous mode the balances are refreshed periodically by a
+    L{RefreshScheduler} instead of once. Modems whose account can't be
+    determined are tried again after L{RefreshScheduler.RETRY_INTERVAL}.
+    """
+
+    # Milliseconds between checks for a modem's D-Bus proxies
+    MODEM_RETRY = 100
+    # Checks before giving up on a modem
+    MODEM_RETRIES = 50
+
+    def __init__(self, mm, providerdb, accountdb, result_func,
+                 done_func=None, modem_filter=None, continuous=False):
+        """
+        @param result_func: called with the result of each modem
+        @param done_func: called once all modems got refreshed, never
+            called in continuous mode
+        @param modem_filter: only refresh modems for which this returns
+            C{True}
+        @param continuous: keep refreshing the balances when they're due
+        """
+        self.mm = mm
+        self.providerdb = providerdb
+        self.accountdb = accountdb
+        self.result_func = result_func
+        self.done_func = done_func
+        self.modem_filter = modem_filter
+        self.pending = set()
+        # Retry timers by modem path
+        self.retries = {}
+        self.scheduler = (RefreshScheduler.from_accountdb(accountdb,
+                                                          self.on_due)
+                          if continuous else None)
+
+    def start(self):
+        """Find the modems and refresh their balances"""
+        self.mm.connect('got-modems', self.on_got_modems)
+        GLib.timeout_add(500, self.on_wait_for_mm)
+
+    def on_wait_for_mm(self):
+        if not self.mm.ready():
+            return True
+        self.mm.dbus_find_modems()
+        return False
+
+    def on_got_modems(self, obj, mm):
+        modems = [modem for modem in mm.modems
+                  if not self.modem_filter or self.modem_filter(modem)]
+        logging.debug("Refreshing modems %s", [m.path for m in modems])
+        if not modems:
+            self._check_done()
+        # Mark all as pending first, results can arrive synchronously
+        self.pending.update(modem.path for modem in modems)
+        for modem in modems:
+            self.refresh(modem)
+
+    def refresh(self, modem):
+        """Refresh the balance of the account in modem"""
+        timer = self.retries.pop(modem.path, None)
+        if timer:
+            GLib.source_remove(timer)
+        self.pending.add(modem.path)
+        self.mm.get_imsi_async(modem, self.on_imsi,
+                               lambda error: self._result(modem,
+                                                          error=error.msg))
+
+    def _result(self, modem, imsi=None, provider=None, balance=None,
+                error=None, start=None):
+        result = {
+            'modem': modem.path,
+            'imsi': imsi,
+            'identifier': AccountDB.imsi_to_identifier(imsi) if imsi else None,
+            'provider': provider.name if provider else None,
+            'country': provider.country if provider else None,
+            'balance': balance,
+            'timestamp': time.time(),
+            'latency': time.monotonic() - start if start else None,
+            'error': error,
+        }
+        if error:
+            logging.warning("Refreshing %s failed: %s", modem.path, error)
+        self.result_func(result)
+        self.pending.discard(modem.path)
+        if self.scheduler:
+            if provider:
+                self.scheduler.finished(result['identifier'],
+                                        amount=parse_balance(balance),
+                                        ok=not error)
+            else:
+                # The scheduler doesn't know about the account yet
+                self._retry(modem)
+        self._check_done()
+
+    def _retry(self, modem):
+        if modem.path not in self.retries:
+            self.retries[modem.path] = GLib.timeout_add_seconds(
+                RefreshScheduler.RETRY_INTERVAL, self.on_retry, modem.path)
+
+    def on_retry(self, path):
+        del self.retries[path]
+        modems = [modem for modem in self.mm.modems if modem.path == path]
+        if modems:
+            self.refresh(modems[0])
+        else:
+            logging.debug("Modem %s is gone, not retrying", path)
+        return False
+
+    def _check_done(self):
+        if self.scheduler:
+            return
+        if not self.pending and self.done_func:
+            self.done_func()
+
+    def get_provider(self, imsi):
+        """Find the provider of the SIM card with imsi"""
+        account = self.accountdb.fetch(imsi)
+        if account:
+            return self.providerdb.get_provider(account.props.code,
+                                                account.props.name)
+
+        (_, _, providers) = self.providerdb.get_providers_by_imsi(imsi)
+        if len(providers) == 1:
+            return providers[0]
+        return None
+
+    def on_imsi(self, imsi, modem):
+        provider = self.get_provider(imsi)
+        if not provider:
+            self._result(modem, imsi=imsi, error="Provider of '%s' unknown" % imsi)
+        elif self.scheduler:
+            account = self.accountdb.fetch(imsi)
+            self.scheduler.add(AccountDB.imsi_to_identifier(imsi),
+                               modem.path,
+                               data=(modem, imsi, provider),
+                               updated=account.updated if account else None,
+                               amount=account.amount if account else None,
+                               min_interval=(account.props.min_interval
+                                             if account else 0))
+        else:
+            self.fetch_balance(modem, imsi, provider)
+
+    def on_due(self, identifier, data):
+        (modem, imsi, provider) = data
+        self.fetch_balance(modem, imsi, provider)
+
+    def fetch_balance(self, modem, imsi, provider, attempt=0):
+        if not modem.ussd_proxy or not modem.messaging_proxy:
+            if attempt < self.MODEM_RETRIES:
+                GLib.timeout_add(self.MODEM_RETRY, self.fetch_balance,
+                                 modem, imsi, provider, attempt + 1)
+            else:
+                self._result(modem, imsi, provider, error="Modem not ready")
+            return False
+
+        start = time.monotonic()
+        errors = []
+
+        def on_error(error):
+            errors.append(error)
+            self._result(modem, imsi, provider, error=error.msg, start=start)
+
+        if not provider.fetch_balance(
+                self.mm,
+                reply_func=lambda var, data: self._result(
+                    modem, imsi, provider, balance=var.unpack()[0], start=start),
+                error_func=on_error,
+                modem=modem) and not errors:
+            self._result(modem, imsi, provider,
+                         error="No idea how to fetch the balance for %s in %s" %
+                         (provider.name, provider.country))
+        return False
@@ -0,0 +1,215 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import heapq
+import itertools
+import logging
+import time
+
+from gi.repository import GLib
+
+
+class ScheduledAccount(object):
+    """
+    An account known to the L{RefreshScheduler}
+
+    @ivar due: when to refresh next in seconds since the epoch
+    @ivar volatility: moving average of the relative balance change per
+        refresh
+    """
+
+    def __init__(self, key, modem, data=None, amount=None, min_interval=0):
+        self.key = key
+        self.modem = modem
+        self.data = data
+        self.amount = amount
+        self.min_interval = min_interval
+        self.volatility = 0.0
+        self.due = None
+        self.running = False
+
+
+class RefreshScheduler(object):
+    """
+    Refresh accounts periodically, the ones due first
+
+    Accounts are kept in a heap ordered by the time they're due. An account
+    is due once its refresh interval has passed since its last balance
+    update. The interval shrinks with the volatility of the balance but
+    never drops below the account's minimum interval. Only due accounts
+    are handed to refresh_func and only if their modem isn't busy with
+    another refresh already, so the work per wakeup depends on the number of
+    due accounts rather than on the number of accounts.
+    """
+
+    # Weight of the latest balance change in the volatility
+    VOLATILITY_SMOOTHING = 0.3
+    # How much a relative change of 1.0 per refresh shortens the interval
+    VOLATILITY_WEIGHT = 20.0
+    # Seconds to wait before retrying a failed refresh
+    RETRY_INTERVAL = 300
+
+    def __init__(self, refresh_func, interval, min_interval=0):
+        """
+        @param refresh_func: called as refresh_func(key, data) when an
+            account is due, L{finished} must be called once the refresh is
+            done
+        @param interval: seconds between refreshes of an account with a
+            steady balance
+        @param min_interval: seconds between refreshes of an account at
+            least
+        """
+        self.refresh_func = refresh_func
+        self.interval = interval
+        self.min_interval = min_interval
+        self.accounts = {}
+        self.heap = []
+        self.busy = set()
+        self.waiting = {}
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_due = None
+
+    @classmethod
+    def from_accountdb(klass, accountdb, refresh_func):
+        """Create a scheduler with the intervals configured in GSettings"""
+        return klass(refresh_func,
+                     accountdb.refresh_interval,
+                     accountdb.refresh_min_interval)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def _interval(self, account):
+        interval = self.interval / (1.0 + self.VOLATILITY_WEIGHT *
+                                    account.volatility)
+        minimum = max(self.min_interval, account.min_interval)
+        return max(min(interval, self.interval), minimum)
+
+    def _push(self, account, due):
+        account.due = due
+        # Older heap entries of the account become stale and get skipped
+        heapq.heappush(self.heap, (due, next(self.counter), account.key))
+        if self.timer_due is None or due < self.timer_due:
+            self._arm(due)
+
+    def add(self, key, modem, data=None, updated=None, amount=None,
+            min_interval=0):
+        """
+        Schedule refreshes of an account
+
+        Adding a known account updates it.
+
+        @param key: identifies the account
+        @param modem: the modem's D-Bus path, only one refresh runs per modem
+        @param data: passed to refresh_func
+        @param updated: time of the last balance update, C{None} if the
+            account should be refreshed right away
+        @param amount: the last balance
+        @param min_interval: the account's minimum interval in seconds
+        """
+        account = self.accounts.get(key)
+        if account:
+            account.modem = modem
+            account.data = data
+            account.min_interval = min_interval
+        else:
+            account = self.accounts[key] = ScheduledAccount(key, modem, data,
+                                                            amount,
+                                                            min_interval)
+        if account.running:
+            return
+        due = updated + self._interval(account) if updated else time.time()
+        self._push(account, due)
+
+    def remove(self, key):
+        """Stop refreshing an account"""
+        account = self.accounts.pop(key, None)
+        if account and account.running:
+            self._release(account.modem)
+            self._dispatch()
+
+    def finished(self, key, amount=None, ok=True):
+        """
+        A refresh of an account finished
+
+        This also reschedules accounts that weren't refreshed by the
+        scheduler.
+
+        @param amount: the new balance
+        @param ok: whether the refresh succeeded
+        """
+        account = self.accounts.get(key)
+        if not account:
+            return
+        if account.running:
+            account.running = False
+            self._release(account.modem)
+
+        now = time.time()
+        if not ok:
+            self._push(account, now + max(self.RETRY_INTERVAL,
+                                          account.min_interval))
+        else:
+            if amount is not None and account.amount is not None:
+                change = abs(amount - account.amount) / max(abs(account.amount),
+                                                             1.0)
+                account.volatility += self.VOLATILITY_SMOOTHING * (
+                    change - account.volatility)
+            if amount is not None:
+                account.amount = amount
+            self._push(account, now + self._interval(account))
+        self._dispatch()
+
+    def _release(self, modem):
+        self.busy.discard(modem)
+        for entry in self.waiting.pop(modem, []):
+            heapq.heappush(self.heap, entry)
+
+    def _arm(self, due):
+        if self.timer:
+            GLib.source_remove(self.timer)
+        delay = max(0, int((due - time.time()) * 1000))
+        self.timer_due = due
+        self.timer = GLib.timeout_add(delay, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.timer_due = None
+        self._dispatch()
+        return False
+
+    def _dispatch(self):
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            (due, _, key) = entry
+            account = self.accounts.get(key)
+            if not account or account.due != due or account.running:
+                continue
+            if account.modem in self.busy:
+                # Goes back to the heap once the modem is free
+                self.waiting.setdefault(account.modem, []).append(entry)
+                continue
+            account.running = True
+            self.busy.add(account.modem)
+            logging.debug("Refreshing '%s', due since %.1fs", key, now - due)
+            self.refresh_func(key, account.data)
+
+        if self.heap and (self.timer_due is None or
+                          self.heap[0][0] < self.timer_due):
+            self._arm(self.heap[0][0])
@@ -0,0 +1,183 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import time
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . accountdb import (AccountDB, parse_timestamp)
+
+
+INTERFACE = 'org.gnome.PrepaidManager.Balances'
+
+INTROSPECTION_XML = """
+<node>
+  <interface name='%s'>
+    <method name='ListAccounts'>
+      <arg type='a(sss)' name='accounts' direction='out'/>
+    </method>
+    <method name='GetBalance'>
+      <arg type='s' name='account' direction='in'/>
+      <arg type='s' name='balance' direction='out'/>
+      <arg type='s' name='timestamp' direction='out'/>
+      <arg type='d' name='age' direction='out'/>
+    </method>
+    <method name='RequestRefresh'>
+      <arg type='s' name='account' direction='in'/>
+      <arg type='s' name='balance' direction='out'/>
+      <arg type='s' name='timestamp' direction='out'/>
+    </method>
+    <signal name='BalanceChanged'>
+      <arg type='s' name='account'/>
+      <arg type='s' name='balance'/>
+      <arg type='s' name='timestamp'/>
+    </signal>
+  </interface>
+</node>
+""" % INTERFACE
+
+ERROR_UNKNOWN_ACCOUNT = 'org.gnome.PrepaidManager.Error.UnknownAccount'
+ERROR_FAILED = 'org.gnome.PrepaidManager.Error.Failed'
+
+
+class BalanceService(object):
+    """
+    Serve the known balances via D-Bus
+
+    ListAccounts returns (account, country, provider) tuples, GetBalance
+    the balance text, its timestamp and its age in seconds (-1 if
+    unknown). Both are answered from the snapshot pushed in via
+    L{update_account} so queries never cause modem traffic. RequestRefresh
+    queries the network and replies once the new balance arrived,
+    concurrent requests for an account share a single query.
+    BalanceChanged is emitted whenever an account's balance changes.
+    """
+
+    def __init__(self, refresh_func=None):
+        """
+        @param refresh_func: called as refresh_func(account, reply_func,
+            error_func) to query an account's balance from the network,
+            returns C{False} if that's not possible. Failures must only be
+            reported to error_func since they belong to the D-Bus client.
+        """
+        self.refresh_func = refresh_func
+        self.accounts = {}
+        self.registrations = []
+        self.node_info = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION_XML)
+
+    def register(self, connection, object_path):
+        """Export the service on connection at object_path"""
+        reg_id = connection.register_object(object_path,
+                                            self.node_info.interfaces[0],
+                                            self.on_method_call,
+                                            None, None)
+        self.registrations.append((connection, object_path, reg_id))
+        logging.debug("Serving balances at '%s'", object_path)
+
+    def unregister(self, connection, object_path):
+        for registration in list(self.registrations):
+            (conn, path, reg_id) = registration
+            if conn == connection and path == object_path:
+                conn.unregister_object(reg_id)
+                self.registrations.remove(registration)
+
+    def _set(self, identifier, country, name, balance, timestamp):
+        old = self.accounts.get(identifier)
+        self.accounts[identifier] = {
+            'country': country or '',
+            'provider': name or '',
+            'balance': balance or '',
+            'timestamp': timestamp or '',
+        }
+        if timestamp and (not old or (old['balance'], old['timestamp']) !=
+                          (balance, timestamp)):
+            self._emit_balance_changed(identifier, balance, timestamp)
+
+    def update_account(self, account):
+        """Take a snapshot of an account's balance information"""
+        if not account or not account.props.identifier:
+            return
+        self._set(account.props.identifier,
+                  account.props.code,
+                  account.props.name,
+                  account.props.balance if account.props.timestamp else '',
+                  account.props.timestamp)
+
+    def update_snapshot(self, snapshot):
+        """
+        Take the accounts from a warm start snapshot
+
+        @type snapshot: L{ppm.warmstart.WarmStartSnapshot}
+        """
+        for entry in snapshot.entries.values():
+            identifier = AccountDB.imsi_to_identifier(entry.imsi)
+            if identifier not in self.accounts:
+                self._set(identifier, entry.country, entry.name,
+                          entry.balance if entry.timestamp else '',
+                          entry.timestamp)
+
+    def _emit_balance_changed(self, identifier, balance, timestamp):
+        for (connection, object_path, _) in self.registrations:
+            try:
+                connection.emit_signal(None, object_path, INTERFACE,
+                                       'BalanceChanged',
+                                       GLib.Variant('(sss)', (identifier,
+                                                              balance,
+                                                              timestamp)))
+            except GLib.Error as err:
+                logging.warning("Failed to emit BalanceChanged: %s", err)
+
+    def on_method_call(self, connection, sender, object_path, interface_name,
+                       method_name, parameters, invocation):
+        if method_name == 'ListAccounts':
+            accounts = [(identifier, info['country'], info['provider'])
+                        for (identifier, info) in sorted(self.accounts.items())]
+            invocation.return_value(GLib.Variant('(a(sss))', (accounts,)))
+            return
+
+        (identifier,) = parameters.unpack()
+        info = self.accounts.get(identifier)
+        if info is None:
+            invocation.return_dbus_error(ERROR_UNKNOWN_ACCOUNT,
+                                         "Unknown account '%s'" % identifier)
+        elif method_name == 'GetBalance':
+            updated = parse_timestamp(info['timestamp'])
+            age = max(0.0, time.time() - updated) if updated else -1.0
+            invocation.return_value(GLib.Variant('(ssd)', (info['balance'],
+                                                           info['timestamp'],
+                                                           age)))
+        elif method_name == 'RequestRefresh':
+            self._refresh(identifier, invocation)
+
+    def _refresh(self, identifier, invocation):
+        def on_reply(balance, timestamp):
+            invocation.return_value(GLib.Variant('(ss)', (balance, timestamp)))
+
+        def on_error(error):
+            invocation.return_dbus_error(ERROR_FAILED, error.msg)
+
+        started = False
+        if self.refresh_func:
+            try:
+                started = self.refresh_func(identifier, on_reply, on_error)
+            except Exception:
+                logging.exception("Refreshing '%s' failed", identifier)
+        if not started:
+            invocation.return_dbus_error(ERROR_FAILED,
+                                         "Can't refresh '%s' now" % identifier)
@@ -0,0 +1,232 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import logging
+import math
+import random
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . modemproxy import (Modem, ModemManagerProxy, MM_DBUS_SERVICE,
+                          MM_ERROR_PREFIX)
+
+
+MODEM_PATH = ModemManagerProxy.MM_DBUS_OBJECT_MODEM_MANAGER + '/Modem/%d'
+SIM_PATH = ModemManagerProxy.MM_DBUS_OBJECT_MODEM_MANAGER + '/SIM/%d'
+
+# MCC and MNC reserved for test networks
+NETWORK_ID = ('001', '01')
+
+INTROSPECTION_XML = """
+<node>
+  <interface name='%(object_manager)s'>
+    <method name='GetManagedObjects'>
+      <arg type='a{oa{sa{sv}}}' name='objects' direction='out'/>
+    </method>
+  </interface>
+  <interface name='%(modem)s'>
+    <property type='o' name='Sim' access='read'/>
+    <property type='i' name='State' access='read'/>
+    <property type='s' name='EquipmentIdentifier' access='read'/>
+  </interface>
+  <interface name='%(ussd)s'>
+    <method name='Initiate'>
+      <arg type='s' name='command' direction='in'/>
+      <arg type='s' name='reply' direction='out'/>
+    </method>
+    <method name='Respond'>
+      <arg type='s' name='response' direction='in'/>
+      <arg type='s' name='reply' direction='out'/>
+    </method>
+    <method name='Cancel'/>
+  </interface>
+  <interface name='%(messaging)s'>
+    <signal name='Added'>
+      <arg type='o' name='path'/>
+      <arg type='b' name='received'/>
+    </signal>
+  </interface>
+  <interface name='%(sim)s'>
+    <property type='s' name='Imsi' access='read'/>
+    <property type='s' name='SimIdentifier' access='read'/>
+  </interface>
+</node>
+""" % {
+    'object_manager': ModemManagerProxy.DBUS_INTERFACE_OBJECT_MANAGER,
+    'modem': Modem.MM_DBUS_INTERFACE_MODEM,
+    'ussd': Modem.MM_DBUS_INTERFACE_MODEM_GSM_USSD,
+    'messaging': Modem.MM_DBUS_INTERFACE_MODEM_MESSAGING,
+    'sim': ModemManagerProxy.MM_DBUS_INTERFACE_SIM,
+}
+
+
+def imsi_of(index):
+    """The IMSI of the simulated SIM card in modem index"""
+    return '%s%s%010d' % (NETWORK_ID + (index,))
+
+
+class ModemManagerSimulator(object):
+    """
+    Just enough of ModemManager to refresh balances
+
+    Every modem is enabled and has a SIM card of the test network. USSD
+    requests get a balance reply after a latency drawn from a log-normal
+    distribution or fail with the given probability.
+    """
+
+    STATE_REGISTERED = 8
+
+    def __init__(self, connection, modems, latency=500, sigma=0.0,
+                 error_rate=0.0, seed=None):
+        """
+        @param connection: message bus connection to serve on
+        @param modems: number of modems
+        @param latency: median USSD latency in milliseconds
+        @param sigma: spread of the log-normal latency distribution, 0
+            gives a fixed latency
+        @param error_rate: probability of a USSD request failing
+        """
+        self.connection = connection
+        self.modems = modems
+        self.latency = latency
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.node_info = Gio.DBusNodeInfo.new_for_xml(INTROSPECTION_XML)
+        self.registrations = []
+        self.requests = 0
+        self.failed = 0
+
+    def _interface(self, name):
+        return self.node_info.lookup_interface(name)
+
+    def _modem_properties(self, index):
+        return {
+            'Sim': GLib.Variant('o', SIM_PATH % index),
+            'State': GLib.Variant('i', self.STATE_REGISTERED),
+            'EquipmentIdentifier': GLib.Variant('s', '%015d' % index),
+        }
+
+    def _sim_properties(self, index):
+        return {
+            'Imsi': GLib.Variant('s', imsi_of(index)),
+            'SimIdentifier': GLib.Variant('s', '89%018d' % index),
+        }
+
+    def _register(self, path, interface):
+        reg_id = self.connection.register_object(path,
+                                                 self._interface(interface),
+                                                 self.on_method_call,
+                                                 None, None)
+        self.registrations.append(reg_id)
+
+    def start(self):
+        """Export the objects and take ModemManager's bus name"""
+        self._register(ModemManagerProxy.MM_DBUS_OBJECT_MODEM_MANAGER,
+                       ModemManagerProxy.DBUS_INTERFACE_OBJECT_MANAGER)
+        for index in range(self.modems):
+            for interface in [Modem.MM_DBUS_INTERFACE_MODEM,
+                              Modem.MM_DBUS_INTERFACE_MODEM_GSM_USSD,
+                              Modem.MM_DBUS_INTERFACE_MODEM_MESSAGING]:
+                self._register(MODEM_PATH % index, interface)
+            self._register(SIM_PATH % index,
+                           ModemManagerProxy.MM_DBUS_INTERFACE_SIM)
+
+        self.connection.call_sync('org.freedesktop.DBus',
+                                  '/org/freedesktop/DBus',
+                                  'org.freedesktop.DBus',
+                                  'RequestName',
+                                  GLib.Variant('(su)', (MM_DBUS_SERVICE, 0)),
+                                  GLib.VariantType('(u)'),
+                                  Gio.DBusCallFlags.NONE, -1, None)
+        logging.debug("Simulating %d modems", self.modems)
+
+    def stop(self):
+        for reg_id in self.registrations:
+            self.connection.unregister_object(reg_id)
+        self.registrations = []
+
+    @staticmethod
+    def _index(path):
+        return int(path.rsplit('/', 1)[-1])
+
+    def _managed_objects(self):
+        objects = {}
+        for index in range(self.modems):
+            objects[MODEM_PATH % index] = {
+                Modem.MM_DBUS_INTERFACE_MODEM: self._modem_properties(index),
+                Modem.MM_DBUS_INTERFACE_MODEM_GSM_USSD: {},
+                Modem.MM_DBUS_INTERFACE_MODEM_MESSAGING: {},
+            }
+            objects[SIM_PATH % index] = {
+                ModemManagerProxy.MM_DBUS_INTERFACE_SIM:
+                    self._sim_properties(index),
+            }
+        return objects
+
+    def _properties(self, path, interface):
+        index = self._index(path)
+        if interface == Modem.MM_DBUS_INTERFACE_MODEM:
+            return self._modem_properties(index)
+        elif interface == ModemManagerProxy.MM_DBUS_INTERFACE_SIM:
+            return self._sim_properties(index)
+        return {}
+
+    def _delay(self):
+        """A latency in milliseconds"""
+        if not self.sigma:
+            return self.latency
+        return int(self.latency * math.exp(self.random.gauss(0, self.sigma)))
+
+    def _ussd_reply(self, path, invocation):
+        self.requests += 1
+        if self.random.random() < self.error_rate:
+            self.failed += 1
+            invocation.return_dbus_error(MM_ERROR_PREFIX + 'Core.Failed',
+                                         "Simulated failure")
+        else:
+            amount = (self._index(path) * 7) % 10000 / 100.0
+            invocation.return_value(GLib.Variant(
+                '(s)', ("Your balance is %.2f EUR" % amount,)))
+        return False
+
+    def on_method_call(self, connection, sender, object_path, interface_name,
+                       method_name, parameters, invocation):
+        if interface_name == ModemManagerProxy.DBUS_INTERFACE_PROPERTIES:
+            # GDBus hands us property access for interfaces without
+            # property handlers
+            if method_name == 'Get':
+                (interface, name) = parameters.unpack()
+                value = self._properties(object_path, interface)[name]
+                invocation.return_value(GLib.Variant('(v)', (value,)))
+            elif method_name == 'GetAll':
+                (interface,) = parameters.unpack()
+                invocation.return_value(GLib.Variant(
+                    '(a{sv})', (self._properties(object_path, interface),)))
+            else:
+                invocation.return_dbus_error(
+                    'org.freedesktop.DBus.Error.PropertyReadOnly',
+                    "Properties are read only")
+        elif method_name == 'GetManagedObjects':
+            invocation.return_value(GLib.Variant('(a{oa{sa{sv}}})',
+                                                 (self._managed_objects(),)))
+        elif method_name in ['Initiate', 'Respond']:
+            GLib.timeout_add(self._delay(), self._ussd_reply, object_path,
+                             invocation)
+        elif method_name == 'Cancel':
+            invocation.return_value(None)
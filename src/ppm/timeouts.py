@@ -0,0 +1,185 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import collections
+import json
+import logging
+import math
+import os
+
+from gi.repository import GLib
+
+
+class AdaptiveTimeouts(object):
+    """
+    D-Bus timeouts for requests to the network based on how long the
+    provider took to answer before
+
+    Latencies are kept per provider and request type. Once there are
+    enough samples the timeout is a multiple of their 95th percentile so
+    fast providers fail fast. Requests that timed out count as samples
+    above the timeout used so the timeout grows for slow providers right
+    away. The samples are kept between runs.
+
+    @ivar recorded: samples recorded since the last L{take_recorded}
+    """
+
+    path = os.getenv('PPM_LATENCIES',
+                     os.path.join(GLib.get_user_data_dir(),
+                                  'prepaid-manager-applet',
+                                  'latencies.json'))
+
+    # Samples kept per provider and request type
+    WINDOW = 50
+    # Samples needed before the timeout may drop below the default
+    MIN_SAMPLES = 5
+    PERCENTILE = 0.95
+    # Timeout relative to the percentile
+    FACTOR = 2.0
+    # Sample recorded for a timed out request relative to the timeout used
+    TIMEOUT_PENALTY = 1.5
+    # Bounds in milliseconds
+    MIN_TIMEOUT = 2000
+    MAX_TIMEOUT = 30000
+    # Seconds to collect samples before saving them
+    SAVE_DELAY = 30
+
+    def __init__(self, default, path=None, autosave=False):
+        """
+        @param default: timeout in milliseconds as long as we know nothing
+            about a provider
+        @param autosave: save new samples shortly after they got recorded
+        """
+        self.default = default
+        self.path = path or self.path
+        self.autosave = autosave
+        self.save_timer = None
+        self.samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.WINDOW))
+        self.recorded = collections.defaultdict(list)
+        self.dirty = False
+
+    @staticmethod
+    def _key(provider, request):
+        return "%s/%s" % (provider, request)
+
+    @staticmethod
+    def percentile(values, p):
+        """The p-th percentile of values using the nearest rank method"""
+        ordered = sorted(values)
+        rank = max(int(math.ceil(p * len(ordered))), 1)
+        return ordered[rank - 1]
+
+    def get(self, provider, request):
+        """
+        The timeout for request to provider in milliseconds
+
+        @param provider: the provider's key, C{None} if unknown
+        @param request: the kind of request, e.g. the USSD script's name
+        """
+        if provider is None:
+            return self.default
+        samples = self.samples.get(self._key(provider, request))
+        if not samples:
+            return self.default
+
+        timeout = self.percentile(samples, self.PERCENTILE) * 1000 * self.FACTOR
+        if len(samples) < self.MIN_SAMPLES:
+            timeout = max(timeout, self.default)
+        return int(min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT))
+
+    def record(self, provider, request, latency, timeout=None):
+        """
+        Record how long a request took
+
+        @param latency: seconds until the reply arrived
+        @param timeout: the timeout in milliseconds if the request timed out
+        """
+        if provider is None:
+            return
+        if timeout is not None:
+            latency = timeout / 1000.0 * self.TIMEOUT_PENALTY
+        key = self._key(provider, request)
+        self.samples[key].append(latency)
+        self.recorded[key].append(latency)
+        self._changed()
+
+    def _changed(self):
+        self.dirty = True
+        if self.autosave and not self.save_timer:
+            self.save_timer = GLib.timeout_add_seconds(self.SAVE_DELAY,
+                                                       self.on_save)
+
+    def on_save(self):
+        self.save_timer = None
+        self.save()
+        return False
+
+    def take_recorded(self):
+        """
+        The samples recorded since the last call
+
+        @return: lists of samples keyed like the saved latencies
+        """
+        (recorded, self.recorded) = (dict(self.recorded),
+                                     collections.defaultdict(list))
+        return recorded
+
+    def merge(self, samples):
+        """
+        Add samples recorded elsewhere, e.g. by another process
+
+        @param samples: as returned by L{take_recorded}
+        """
+        for (key, values) in samples.items():
+            self.samples[key].extend(float(value) for value in values)
+            self._changed()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as err:
+            logging.warning("Failed to load latencies from '%s': %s",
+                            self.path, err)
+            return
+        for (key, samples) in data.items():
+            self.samples[key].extend(float(s) for s in samples)
+        logging.debug("Loaded latencies for %s", list(self.samples))
+
+    def save(self):
+        if self.save_timer:
+            GLib.source_remove(self.save_timer)
+            self.save_timer = None
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        try:
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({key: list(samples)
+                           for (key, samples) in self.samples.items()}, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logging.warning("Failed to save latencies to '%s': %s",
+                            self.path, err)
+            return
+        self.dirty = False
@@ -0,0 +1,108 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import re
+
+
+# A menu entry like "1. Balance", "2) Top up" or "*: Back"
+_MENU_ENTRY_RE = re.compile(r'^\s*([0-9]{1,2}|[*#])\s*[.):\-]\s*(\S.*?)\s*$')
+
+
+def parse_menu(reply):
+    """
+    Split a USSD reply into its text and menu entries
+
+    @return: the text lines that aren't menu entries and a list of
+        (key, label) tuples
+    @rtype: C{tuple}
+    """
+    text = []
+    entries = []
+    for line in (reply or '').splitlines():
+        m = _MENU_ENTRY_RE.match(line)
+        if m:
+            entries.append((m.group(1), m.group(2)))
+        elif line.strip():
+            text.append(line.strip())
+    return ('\n'.join(text), entries)
+
+
+class UssdScriptError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class UssdScript(object):
+    """
+    A scripted walk through a provider's USSD menu
+
+    A script starts with the initiating USSD command followed by steps
+    answering the menus sent back by the network. A step either sends a
+    fixed response ('respond') or selects the menu entry whose label
+    matches a regular expression ('select').
+    """
+
+    RESPOND, SELECT = 'respond', 'select'
+
+    def __init__(self, name, command, steps=None, replacement=None):
+        """
+        @param name: what the script does, e.g. 'balance' or 'top-up'
+        @param command: the USSD command starting the session
+        @param steps: list of (action, value) tuples
+        @param replacement: placeholder in command and steps that gets
+            replaced by e.g. the top up code
+        """
+        self.name = name
+        self.command = command
+        self.steps = steps or []
+        self.replacement = replacement
+
+    def __repr__(self):
+        return "<UssdScript %s: %s %s>" % (self.name, self.command, self.steps)
+
+    def add_step(self, action, value):
+        if action not in [self.RESPOND, self.SELECT]:
+            raise UssdScriptError("Unknown USSD script action '%s'" % action)
+        self.steps.append((action, value))
+
+    def _replace(self, value, code):
+        if code is not None and self.replacement:
+            return value.replace(self.replacement, code)
+        return value
+
+    def get_command(self, code=None):
+        return self._replace(self.command, code)
+
+    def get_response(self, step, reply, code=None):
+        """
+        The response to send to the network for the given step
+
+        @param step: index of the step
+        @param reply: the network's last reply
+        @raises UssdScriptError: if the menu entry to select isn't in the reply
+        """
+        (action, value) = self.steps[step]
+        value = self._replace(value, code)
+        if action == self.RESPOND:
+            return value
+
+        (_, entries) = parse_menu(reply)
+        for (key, label) in entries:
+            if re.search(value, label, re.IGNORECASE):
+                return key
+        raise UssdScriptError("No menu entry matching '%s' in '%s'" %
+                              (value, reply))
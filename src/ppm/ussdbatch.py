@@ -0,0 +1,226 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import collections
+import json
+import logging
+import re
+import time
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . modemproxy import USSD_SESSION_TIMEOUT
+from . ussd import UssdScript
+
+
+class UssdBatch(object):
+    """
+    Send raw USSD commands to many modems
+
+    Each input line holds a modem and a USSD command separated by
+    whitespace. The modem is either its D-Bus object path, the number at
+    the end of that path or the IMSI of its SIM card. Commands for
+    different modems run concurrently, commands for the same modem one
+    after another. Every result is written as JSON object on a line of
+    its own as soon as it's known.
+    """
+
+    IMSI_RE = re.compile(r'^\d{14,15}$')
+    # Milliseconds to wait for a modem's D-Bus proxies to show up
+    MODEM_RETRY = 100
+    # Checks before giving up on a modem
+    MODEM_RETRIES = 50
+
+    def __init__(self, mm, input_stream, output, loop,
+                 timeout=USSD_SESSION_TIMEOUT):
+        """
+        @param mm: the modem manager proxy to use
+        @param input_stream: the commands
+        @type input_stream: C{Gio.InputStream}
+        @param output: file like object the results are written to
+        @param loop: main loop to quit once all commands are done
+        """
+        self.mm = mm
+        self.input = Gio.DataInputStream.new(input_stream)
+        self.output = output
+        self.loop = loop
+        self.timeout = timeout
+        self.lineno = 0
+        self.eof = False
+        self.ready = False
+        self.failed = 0
+        # Lines read before we know all modems
+        self.pending = []
+        self.modems = {}
+        self.imsis = {}
+        self.imsis_missing = 0
+        self.queues = collections.defaultdict(collections.deque)
+        self.active = {}
+        # Modems we wait for to become ready
+        self.waiting = set()
+
+    def start(self):
+        self.mm.connect('got-modems', self.on_got_modems)
+        GLib.timeout_add(500, self.on_wait_for_mm)
+        self._read_line()
+
+    def on_wait_for_mm(self):
+        if not self.mm.ready():
+            return True
+        self.mm.dbus_find_modems()
+        return False
+
+    def on_got_modems(self, obj, mm):
+        for modem in mm.modems:
+            self.modems[modem.path] = modem
+            self.modems[modem.path.rsplit('/', 1)[-1]] = modem
+
+        self.imsis_missing = len(mm.modems)
+        for modem in mm.modems:
+            mm.get_imsi_async(modem, self.on_imsi, self.on_imsi_error)
+        if not mm.modems:
+            self._all_modems_known()
+
+    def on_imsi(self, imsi, modem):
+        self.imsis[imsi] = modem
+        self._imsi_done()
+
+    def on_imsi_error(self, error):
+        logging.warning(error.msg)
+        self._imsi_done()
+
+    def _imsi_done(self):
+        self.imsis_missing -= 1
+        if not self.imsis_missing:
+            self._all_modems_known()
+
+    def _all_modems_known(self):
+        logging.debug("Known modems: %s, IMSIs: %s",
+                      [m for m in self.modems if m.startswith('/')],
+                      list(self.imsis))
+        self.ready = True
+        for (lineno, target, command) in self.pending:
+            self._dispatch(lineno, target, command)
+        self.pending = []
+        self._check_done()
+
+    def _read_line(self):
+        self.input.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                                   self.on_line_read, None)
+
+    def on_line_read(self, stream, res, user_data):
+        try:
+            (line, length) = stream.read_line_finish_utf8(res)
+        except GLib.Error as err:
+            logging.error("Reading commands failed: %s", err.message)
+            line = None
+
+        if line is None:
+            self.eof = True
+            self._check_done()
+            return
+
+        self.lineno += 1
+        line = line.strip()
+        if line and not line.startswith('#'):
+            fields = line.split(None, 1)
+            if len(fields) != 2:
+                self._write(self.lineno, fields[0], None, None,
+                            error="Malformed line '%s'" % line)
+            elif self.ready:
+                self._dispatch(self.lineno, fields[0], fields[1])
+            else:
+                self.pending.append((self.lineno, fields[0], fields[1]))
+        self._read_line()
+
+    def _find_modem(self, target):
+        if self.IMSI_RE.match(target):
+            return self.imsis.get(target)
+        return self.modems.get(target)
+
+    def _dispatch(self, lineno, target, command):
+        modem = self._find_modem(target)
+        if not modem:
+            self._write(lineno, target, None, command,
+                        error="Unknown modem '%s'" % target)
+            return
+        self.queues[modem.path].append((lineno, target, command))
+        self._run_next(modem)
+
+    def _run_next(self, modem, attempt=0):
+        if attempt:
+            self.waiting.discard(modem.path)
+        elif modem.path in self.waiting:
+            return False
+        if modem.path in self.active or not self.queues[modem.path]:
+            return False
+        if not modem.ussd_proxy:
+            if attempt < self.MODEM_RETRIES:
+                self.waiting.add(modem.path)
+                GLib.timeout_add(self.MODEM_RETRY, self._run_next, modem,
+                                 attempt + 1)
+            else:
+                queue = self.queues.pop(modem.path)
+                for (lineno, target, command) in queue:
+                    self._write(lineno, target, modem.path, command,
+                                error="Modem not ready")
+                self._check_done()
+            return False
+
+        (lineno, target, command) = self.queues[modem.path].popleft()
+        self.active[modem.path] = (lineno, target, command, time.monotonic())
+        self.mm.ussd_session(UssdScript('raw', command),
+                             modem=modem,
+                             reply_func=self.on_reply,
+                             error_func=lambda error: self.on_error(modem, error),
+                             timeout=self.timeout)
+        return False
+
+    def _finish(self, modem, reply=None, error=None):
+        (lineno, target, command, start) = self.active.pop(modem.path)
+        self._write(lineno, target, modem.path, command, reply=reply,
+                    error=error, latency=time.monotonic() - start)
+        self._run_next(modem)
+        self._check_done()
+
+    def on_reply(self, var, session):
+        self._finish(session.modem, reply=var.unpack()[0])
+
+    def on_error(self, modem, error):
+        self._finish(modem, error=error.msg)
+
+    def _write(self, lineno, target, modem, command, reply=None, error=None,
+               latency=None):
+        if error:
+            self.failed += 1
+        record = collections.OrderedDict([
+            ('line', lineno),
+            ('target', target),
+            ('modem', modem),
+            ('command', command),
+            ('reply', reply),
+            ('error', error),
+            ('latency', round(latency, 3) if latency is not None else None),
+        ])
+        self.output.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.output.flush()
+
+    def _check_done(self):
+        if (self.eof and self.ready and not self.pending and not self.active and
+                not any(self.queues.values())):
+            self.loop.quit()
@@ -0,0 +1,144 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import collections
+import json
+import logging
+import os
+
+from gi.repository import GLib
+
+from . modemproxy import (Modem, ModemManagerProxy)
+
+
+SnapshotEntry = collections.namedtuple('SnapshotEntry',
+                                       ['sim',       # SIM card identifier
+                                        'imsi',
+                                        'country',   # provider's country code
+                                        'name',      # provider's name
+                                        'balance',
+                                        'timestamp',
+                                        ])
+
+
+def _identifiers(objects, modem_path):
+    """
+    The modem's equipment identifier and the identifier of its SIM card
+    as found in ModemManager's managed objects
+    """
+    try:
+        modem = objects[modem_path][Modem.MM_DBUS_INTERFACE_MODEM]
+        equipment = modem['EquipmentIdentifier']
+        sim = objects[modem['Sim']][ModemManagerProxy.MM_DBUS_INTERFACE_SIM]
+        return (equipment or None, sim['SimIdentifier'] or None)
+    except (KeyError, TypeError):
+        return (None, None)
+
+
+class WarmStartSnapshot(object):
+    """
+    What we knew about each modem's SIM card when we last ran
+
+    Entries are keyed by the modem's equipment identifier and only used if
+    the SIM card identifier still matches. Both come with ModemManager's
+    managed objects so checking an entry doesn't need any extra D-Bus
+    round trip. Changes are saved shortly after they happened.
+    """
+
+    path = os.getenv('PPM_WARM_START',
+                     os.path.join(GLib.get_user_cache_dir(),
+                                  'prepaid-manager-applet',
+                                  'warm-start.json'))
+
+    # Seconds to collect changes before saving them
+    SAVE_DELAY = 5
+
+    def __init__(self, path=None):
+        self.path = path or self.path
+        self.entries = {}
+        self.dirty = False
+        self.save_timer = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.entries = {equipment: SnapshotEntry(**entry)
+                            for (equipment, entry) in data.items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as err:
+            logging.warning("Ignoring warm start snapshot '%s': %s",
+                            self.path, err)
+            self.entries = {}
+
+    def save(self):
+        if self.save_timer:
+            GLib.source_remove(self.save_timer)
+            self.save_timer = None
+        if not self.dirty:
+            return
+        dirname = os.path.dirname(self.path)
+        try:
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({equipment: entry._asdict()
+                           for (equipment, entry) in self.entries.items()}, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logging.warning("Failed to save warm start snapshot '%s': %s",
+                            self.path, err)
+            return
+        self.dirty = False
+
+    def lookup(self, objects, modem_path):
+        """
+        The entry for a modem if its SIM card didn't change
+
+        @param objects: ModemManager's managed objects
+        @return: the entry or C{None}
+        @rtype: L{SnapshotEntry}
+        """
+        (equipment, sim) = _identifiers(objects, modem_path)
+        entry = self.entries.get(equipment)
+        if not entry or entry.sim != sim or not sim:
+            return None
+        return entry
+
+    def update(self, objects, modem_path, imsi, account):
+        """Remember the account in the modem's SIM card"""
+        (equipment, sim) = _identifiers(objects, modem_path)
+        if not equipment or not sim:
+            return
+        entry = SnapshotEntry(sim, imsi,
+                              account.props.code,
+                              account.props.name,
+                              account.props.balance,
+                              account.props.timestamp)
+        if self.entries.get(equipment) != entry:
+            self.entries[equipment] = entry
+            self.dirty = True
+            if not self.save_timer:
+                self.save_timer = GLib.timeout_add_seconds(self.SAVE_DELAY,
+                                                           self.on_save)
+
+    def on_save(self):
+        self.save_timer = None
+        self.save()
+        return False
@@ -0,0 +1,210 @@
+# vim: set fileencoding=utf-8 :
+#
+# (C) 2026 Guido Günther <agx@sigxcpu.org>
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+from builtins import object
+import json
+import logging
+import sqlite3
+import time
+import zlib
+
+from gi.repository import GLib
+from gi.repository import Gio
+
+from . governor import UssdGovernor
+from . modemproxy import (ModemManagerProxy, MM_DBUS_TIMEOUT)
+from . journal import Journal
+from . provider import Provider
+from . refresh import BalanceRefresher
+from . timeouts import AdaptiveTimeouts
+
+
+def shard_of(path, shards):
+    """The shard a modem belongs to given its D-Bus object path"""
+    index = path.rsplit('/', 1)[-1]
+    if index.isdigit():
+        return int(index) % shards
+    return zlib.crc32(path.encode('utf-8')) % shards
+
+
+class Worker(object):
+    """
+    Refresh the balances of one shard of the modems
+
+    The worker has its own L{ModemManagerProxy} and writes the results as
+    JSON lines to output so a L{Supervisor} can collect them. The latencies
+    it measured are passed on the same way in lines with a latencies key.
+    It doesn't write to the account store or the latencies file itself.
+    """
+
+    def __init__(self, shard, shards, providerdb, accountdb, output, loop,
+                 continuous=False):
+        """
+        @param continuous: keep refreshing balances when they're due instead
+            of quitting after one round
+        """
+        self.shard = shard
+        self.shards = shards
+        self.output = output
+        self.loop = loop
+        # The supervisor saves the latencies so workers don't race on the
+        # file
+        self.timeouts = AdaptiveTimeouts(MM_DBUS_TIMEOUT)
+        self.timeouts.load()
+        # The workers share the host's USSD limits
+        governor = UssdGovernor.from_settings(accountdb.settings, share=shards)
+        self.mm = ModemManagerProxy(timeouts=self.timeouts, governor=governor,
+                                    modem_filter=self.in_shard_path)
+        self.refresher = BalanceRefresher(self.mm, providerdb, accountdb,
+                                          self.on_result,
+                                          done_func=self.loop.quit,
+                                          modem_filter=self.in_shard,
+                                          continuous=continuous)
+
+    def in_shard_path(self, path):
+        return shard_of(path, self.shards) == self.shard
+
+    def in_shard(self, modem):
+        return self.in_shard_path(modem.path)
+
+    def start(self):
+        logging.debug("Worker %d/%d starting", self.shard, self.shards)
+        self.refresher.start()
+
+    def on_result(self, result):
+        latencies = self.timeouts.take_recorded()
+        if latencies:
+            self.output.write(json.dumps({'latencies': latencies}) + '\n')
+        self.output.write(json.dumps(result) + '\n')
+        self.output.flush()
+
+
+class Supervisor(object):
+    """
+    Spread the modems over several worker processes
+
+    Each worker handles the modems of its shard with its own D-Bus
+    connection and main loop. The results are read from the workers'
+    stdout and written to the single account store and balance history by
+    the supervisor. The workers' latencies are merged into timeouts.
+    """
+
+    def __init__(self, worker_argv, workers, accountdb, history, loop,
+                 result_func=None, journal=None, timeouts=None):
+        """
+        @param worker_argv: command to start a worker, --shard and --shards
+            get appended
+        @param workers: number of worker processes
+        @param result_func: additionally called with every result
+        @param journal: journal to record the results in
+        @type journal: L{ppm.journal.Journal}
+        @param timeouts: where to merge the workers' latencies into
+        @type timeouts: L{AdaptiveTimeouts}
+        """
+        self.worker_argv = worker_argv
+        self.workers = workers
+        self.accountdb = accountdb
+        self.history = history
+        self.loop = loop
+        self.result_func = result_func
+        self.journal = journal
+        self.timeouts = timeouts
+        self.running = 0
+        # Worker streams not read to the end yet
+        self.reading = 0
+        self.results = 0
+        self.failed = 0
+
+    def start(self):
+        for shard in range(self.workers):
+            argv = self.worker_argv + ['--shard', str(shard),
+                                       '--shards', str(self.workers)]
+            logging.debug("Starting worker: %s", ' '.join(argv))
+            proc = Gio.Subprocess.new(argv, Gio.SubprocessFlags.STDOUT_PIPE)
+            stream = Gio.DataInputStream.new(proc.get_stdout_pipe())
+            self.running += 1
+            self.reading += 1
+            self._read_line(stream, shard)
+            proc.wait_check_async(None, self.on_worker_exited, shard)
+
+    def _read_line(self, stream, shard):
+        stream.read_line_async(GLib.PRIORITY_DEFAULT, None,
+                               self.on_line_read, shard)
+
+    def on_line_read(self, stream, res, shard):
+        try:
+            (line, length) = stream.read_line_finish_utf8(res)
+        except GLib.Error as err:
+            logging.error("Reading from worker %d failed: %s", shard,
+                          err.message)
+            line = None
+
+        if line is None:
+            self.reading -= 1
+            self._check_done()
+            return
+        try:
+            data = json.loads(line)
+            if 'latencies' in data:
+                if self.timeouts:
+                    self.timeouts.merge(data['latencies'])
+            else:
+                self.apply(data)
+        except ValueError:
+            logging.error("Garbage from worker %d: %s", shard, line)
+        self._read_line(stream, shard)
+
+    def on_worker_exited(self, proc, res, shard):
+        try:
+            proc.wait_check_finish(res)
+        except GLib.Error as err:
+            logging.error("Worker %d failed: %s", shard, err.message)
+        self.running -= 1
+        self._check_done()
+
+    def _check_done(self):
+        # Results might still be buffered in the pipes of exited workers
+        if not self.running and not self.reading:
+            self.loop.quit()
+
+    def apply(self, result):
+        """Write a worker's result to the account store"""
+        self.results += 1
+        if self.result_func:
+            self.result_func(result)
+        if result['error']:
+            self.failed += 1
+            return
+
+        imsi = result['imsi']
+        timestamp = time.asctime(time.localtime(result['timestamp']))
+        account = self.accountdb.fetch(imsi)
+        if not account:
+            if self.journal:
+                self.journal.record(Journal.PROVIDER_ASSIGNED, imsi,
+                                    country=result['country'],
+                                    name=result['provider'])
+            account = self.accountdb.add(imsi, Provider(result['country'],
+                                                        result['provider']))
+        if self.journal:
+            self.journal.record(Journal.BALANCE_RECEIVED, imsi,
+                                balance=result['balance'],
+                                timestamp=timestamp)
+        account.update_balance(result['balance'], timestamp)
+        try:
+            self.history.add_account(account)
+        except sqlite3.Error as err:
+            logging.warning("Failed to record balance history: %s", err)
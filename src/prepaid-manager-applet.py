@@ -18,16 +18,32 @@
 from builtins import str
 from builtins import range
 from builtins import object
+import functools
 import locale
 import logging
 import os
+import sqlite3
 import sys
 import time
 
 import ppm
-from ppm.modemproxy import (ModemManagerProxy, ModemError)
+from ppm.modemproxy import (ModemManagerProxy, ModemError,
+                            ModemDisabledError, ModemGoneError,
+                            MM_DBUS_TIMEOUT)
 from ppm.providerdb import ProviderDB
 from ppm.accountdb import AccountDB
+from ppm.alerts import (LowBalanceMonitor, run_hook)
+from ppm.governor import UssdGovernor
+from ppm.dashboard import DashboardModel
+from ppm.history import BalanceHistory
+from ppm.journal import Journal
+from ppm.metrics import (MetricsExporter, MetricsError, RequestStats)
+from ppm.refresh import BalanceRefresher
+from ppm.scheduler import RefreshScheduler
+from ppm.service import BalanceService
+from ppm.timeouts import AdaptiveTimeouts
+from ppm.warmstart import WarmStartSnapshot
+from ppm import profiling
 
 import gettext
 import gi
@@ -40,6 +56,7 @@ from gi.repository import Gdk  # noqa: E402
 
 
 _ = None
+ngettext = None
 
 
 # Needs to happen early so we can use it to create classes based on templates
@@ -55,8 +72,23 @@ class PPMController(Gtk.Application):
     @ivar imsi: the imsi if we could fetch it from the modem
     @ivar account: the account associated with the SIM card
     @ivar provider: current provider
+    @ivar metrics: metrics exporter if enabled
+    @ivar timeouts: D-Bus timeouts adapted to the providers' latencies
+    @ivar journal: log of account operations, the account store only gets
+        written when it's compacted
+    @ivar snapshot: accounts and providers of the modems' SIM cards when we
+        last ran
+    @ivar balance_requests: callbacks waiting for a balance query in flight
+        keyed by account identifier
+    @ivar service: serves the known balances via D-Bus
+    @ivar dashboard: all modems and their accounts
+    @ivar dashboard_refresher: queries the balances of the modems besides
+        the current one for the dashboard
     """
 
+    # How often to retry fetching the IMSI on transient errors
+    IMSI_RETRIES = 5
+
     __gsignals__ = {
         # Emitted when we got the new account balance from the provider
         'balance-info-changed': (GObject.SignalFlags.RUN_FIRST, None,
@@ -64,41 +96,160 @@ class PPMController(Gtk.Application):
         # Emitted when the provider changed
         'provider-changed': (GObject.SignalFlags.RUN_FIRST, None,
                              [object]),
+        # Emitted with the account, its balance and threshold when the
+        # balance dropped below the threshold
+        'balance-low': (GObject.SignalFlags.RUN_FIRST, None,
+                        [object, float, float]),
     }
 
+    def do_dbus_register(self, connection, object_path):
+        if not Gtk.Application.do_dbus_register(self, connection, object_path):
+            return False
+        self.service.register(connection, object_path)
+        return True
+
+    def do_dbus_unregister(self, connection, object_path):
+        self.service.unregister(connection, object_path)
+        Gtk.Application.do_dbus_unregister(self, connection, object_path)
+
+    def do_activate(self):
+        """Another instance got started, show ourself instead"""
+        if self.view:
+            self.view.present()
+
     def _connect_mm_signals(self):
         self.mm.connect('request-started', self.on_mm_request_started)
         self.mm.connect('request-finished', self.on_mm_request_finished)
         self.mm.connect('got-modems', self.on_mm_got_modems)
+        self.mm.connect('session-started', self.on_mm_session_started)
+        self.mm.connect('session-finished', self.on_mm_session_finished)
 
     def __init__(self):
         Gtk.Application.__init__(self, application_id=ppm.app_id)
         self.mm = None
         self.mm_tries = 0
+        self.imsi_tries = 0
         self.imsi = None
         self.provider = None
         self.account = None
         self.view = None
         self.providerdb = ProviderDB()
-        self.accountdb = AccountDB()
+        self.accountdb = AccountDB(delay=True)
+        # Replayed once we know we're the primary instance
+        self.journal = Journal(self.accountdb)
+        self.history = BalanceHistory()
+        self.snapshot = WarmStartSnapshot()
+        self.snapshot.load()
+        self.low_balance = LowBalanceMonitor(self.accountdb)
+        self.request_stats = RequestStats()
+        self.timeouts = AdaptiveTimeouts(MM_DBUS_TIMEOUT, autosave=True)
+        self.timeouts.load()
+        self.governor = UssdGovernor.from_settings(self.accountdb.settings)
+        self.metrics = None
+        self.balance_requests = {}
+        self.dashboard = DashboardModel()
+        self.dashboard_window = None
+        self.dashboard_refresher = None
+        self.service = BalanceService(refresh_func=self.refresh_account)
+        self.service.update_snapshot(self.snapshot)
+        self.scheduler = None
+        if self.accountdb.refresh_interval:
+            self.scheduler = RefreshScheduler.from_accountdb(self.accountdb,
+                                                             self.on_refresh_due)
 
         self.connect('provider-changed', self.on_provider_changed)
         self.connect('balance-info-changed', self.on_balance_info_changed)
+        self.connect('balance-low', self.on_balance_low)
+        self.providerdb.connect('changed', self.on_providerdb_changed)
+        self.providerdb.watch()
+
+    def _journal(self, op, **data):
+        if self.imsi:
+            self.journal.record(op, self.imsi, **data)
+
+    def _balance_request_key(self):
+        if self.account:
+            return self.account.props.identifier
+        return self.imsi
+
+    def _request_balance(self, waiter):
+        """
+        Query the balance from the network unless a query for the current
+        account is already in flight. In both cases waiter gets notified
+        once the query finishes.
+        """
+        key = self._balance_request_key()
+        if key in self.balance_requests:
+            logging.debug("Balance query for '%s' already in flight", key)
+            self.balance_requests[key].append(waiter)
+            return True
+
+        self.balance_requests[key] = [waiter]
+        self._journal(Journal.BALANCE_QUERIED)
+        started = False
+        try:
+            started = self.provider.fetch_balance(
+                self.mm,
+                reply_func=functools.partial(self.on_balance_info_fetched,
+                                             key=key),
+                error_func=functools.partial(self.on_balance_info_error,
+                                             key=key))
+        finally:
+            # Later queries would wait for this one forever. If it's gone
+            # already the waiters got the error.
+            if not started and self.balance_requests.pop(key, None) is None:
+                started = True
+        return bool(started)
+
+    def refresh_account(self, identifier, reply_func, error_func=None):
+        """
+        Query the balance of the account identified by identifier
+
+        @return: C{False} if the account isn't the current one or we don't
+            know how to query its balance
+        """
+        if not self.account or self.account.props.identifier != identifier:
+            return False
+        if not self.provider or not self.mm or not self.mm.modem:
+            return False
+        return self._request_balance((reply_func, error_func))
 
     def fetch_balance(self):
         """Fetch the current account balance from the  network"""
         if not self.mm.modem.enabled:
             self.view.show_modem_enable()
 
-        if not self.provider.fetch_balance(self.mm,
-                                           reply_func=self.on_balance_info_fetched,
-                                           error_func=self.on_modem_error):
+        if not self._request_balance((None, None)):
             self.view.show_provider_balance_info_missing(self.provider)
             logging.error("No idea how to fetch account information for "
                           "%s in %s.", self.provider.name, self.provider.country)
 
+    def get_balance(self, reply_func, error_func=None, max_age=None):
+        """
+        Get the current account balance, prefer the stored one
+
+        @param reply_func: called as reply_func(balance, timestamp)
+        @param error_func: called with the L{ModemError} if the query failed
+        @param max_age: use the stored balance if it's younger than this many
+            seconds, defaults to the configured maximum age
+        @return: C{False} if we don't know how to query the balance
+        """
+        if max_age is None:
+            max_age = self.accountdb.balance_max_age
+
+        if self.account:
+            updated = self.account.updated
+            if updated is not None and 0 <= time.time() - updated <= max_age:
+                logging.debug("Using stored balance from %s",
+                              self.account.props.timestamp)
+                reply_func(self.account.props.balance,
+                           self.account.props.timestamp)
+                return True
+        return self._request_balance((reply_func, error_func))
+
     def top_up_balance(self):
         code = self.view.get_top_up_code()
+        self._journal(Journal.TOP_UP_SENT)
         if not self.provider.top_up(self.mm, code,
                                     reply_func=self.on_balance_topped_up,
                                     error_func=self.on_modem_error):
@@ -129,9 +280,7 @@ class PPMController(Gtk.Application):
 
     def _imsi_to_network_id(self, imsi):
         """Extract mmc and mnc from imsi"""
-        mcc = imsi[0:3]
-        mnc = imsi[3:5]
-        return (mcc, mnc)
+        return self.providerdb.network_ids.get_network_id(imsi)
 
     def get_provider_interactive(self, imsi=None):
         """
@@ -145,8 +294,7 @@ class PPMController(Gtk.Application):
         """
         self.providers = []
         if imsi:
-            mcc, mnc = self._imsi_to_network_id(imsi)
-            self.providers = self.providerdb.get_providers(mcc, mnc)
+            mcc, mnc, self.providers = self.providerdb.get_providers_by_imsi(imsi)
 
         if len(self.providers) == 1:
             self.set_provider(self.providers[0])
@@ -168,25 +316,37 @@ class PPMController(Gtk.Application):
             self.set_provider(account=self.account)
         return self.account
 
-    def init_account_and_provider(self):
-        """Fetch the imsi and deduce account and provider information"""
+    @profiling.spanned('init_account_and_provider')
+    def init_account_and_provider(self, imsi=None):
+        """
+        Fetch the imsi and deduce account and provider information
+
+        @param imsi: the IMSI if already known
+        """
 
         logging.debug("Fetching account information")
 
+        self._update_modem_metrics()
         if not self.mm.modem.enabled:
             self.view.show_modem_enable()
             return False
 
         try:
-            self.imsi = self.mm.get_imsi()
+            self.imsi = imsi or self.mm.get_imsi()
         except ModemError as me:
             logging.warning("Can't get imsi: %s", me.msg)
+            if me.retryable and self.imsi_tries < self.IMSI_RETRIES:
+                # Keep the timer running
+                self.imsi_tries += 1
+                return True
+            self.imsi_tries = 0
             if me.is_forbidden():
                 self.view.show_provider_assistant()
                 return False
 
             self.view.show_modem_error(me.msg)
             return False
+        self.imsi_tries = 0
 
         try:
             account = self._get_account_from_accountdb(self.imsi)
@@ -208,14 +368,78 @@ class PPMController(Gtk.Application):
         return False
 
     def on_mm_got_modems(self, obj, mm_proxy):
+        objects = mm_proxy.objects()
+        present = set(modem.path for modem in mm_proxy.modems)
+        for path in self.dashboard.modems - present:
+            self.dashboard.remove(path)
+        for modem in mm_proxy.modems:
+            entry = self.snapshot.lookup(objects, modem.path)
+            if entry:
+                self.dashboard.update(modem.path,
+                                      account=AccountDB.imsi_to_identifier(entry.imsi),
+                                      provider=entry.name,
+                                      balance=entry.balance if entry.timestamp else None,
+                                      updated=entry.timestamp)
+            else:
+                self.dashboard.update(modem.path)
         if mm_proxy.modems:
             modem = mm_proxy.modems[0]  # FIXME: handle multiple modems
             logging.debug("Using modem %s" % modem)
             self.mm.set_modem(modem)
-            GLib.timeout_add(500, self.init_account_and_provider)
+            imsi = self.warm_start(modem)
+            GLib.timeout_add(500, self.init_account_and_provider, imsi)
+            if self.dashboard_window and self.dashboard_window.get_visible():
+                self.refresh_dashboard()
         else:
             self.view.show_no_modem_found()
 
+    def warm_start(self, modem):
+        """
+        Show what we knew about the modem's SIM card when we last ran
+
+        @return: the IMSI if the SIM card didn't change
+        """
+        entry = self.snapshot.lookup(self.mm.objects(), modem.path)
+        if not entry:
+            return None
+
+        logging.debug("Warm start for %s with %s", modem.path, entry.imsi)
+        self.view.update_provider_name(entry.name)
+        if entry.timestamp:
+            self.view.update_account_balance_information(entry.balance,
+                                                         entry.timestamp)
+        return entry.imsi
+
+    def _schedule_refresh(self):
+        """Refresh the current account's balance in the background"""
+        if self.scheduler and self.account and self.mm and self.mm.modem:
+            self.scheduler.add(self.account.props.identifier,
+                               self.mm.modem.path,
+                               updated=self.account.updated,
+                               amount=self.account.amount,
+                               min_interval=self.account.props.min_interval)
+
+    def _publish_account(self):
+        """Pass the current account on to everyone showing it"""
+        if self.metrics:
+            self.metrics.update_account(self.account)
+        self.service.update_account(self.account)
+        if self.mm and self.mm.modem:
+            self.dashboard.update(self.mm.modem.path,
+                                  account=self.account.props.identifier,
+                                  provider=self.account.props.name,
+                                  balance=(self.account.props.balance
+                                           if self.account.props.timestamp
+                                           else None),
+                                  updated=self.account.props.timestamp)
+        self._update_snapshot()
+
+    def _update_snapshot(self):
+        if self.account and self.imsi and self.mm and self.mm.modem:
+            self.snapshot.update(self.mm.objects(), self.mm.modem.path,
+                                 self.imsi, self.account)
+
+    @profiling.spanned('setup')
     def setup(self):
         logging.debug("Setting up")
         # Wait for MM Proxy to become ready:
@@ -230,11 +454,19 @@ class PPMController(Gtk.Application):
         self.mm.dbus_find_modems()
         return False
 
+    @profiling.spanned('schedule_setup')
     def schedule_setup(self):
         """Schedule another run of setup"""
 
-        self.mm = ModemManagerProxy()
+        self.mm = ModemManagerProxy(stats=self.request_stats,
+                                    timeouts=self.timeouts,
+                                    governor=self.governor)
         self._connect_mm_signals()
+        # The current modem is handled by us, the refresher does the rest
+        self.dashboard_refresher = BalanceRefresher(
+            self.mm, self.providerdb, self.accountdb,
+            self.on_dashboard_result,
+            modem_filter=lambda modem: modem is not self.mm.modem)
         GLib.timeout_add(500, self.setup)
 
     def enable_modem(self):
@@ -242,10 +474,62 @@ class PPMController(Gtk.Application):
         self.mm.modem_enable(reply_func=self.on_modem_enable,
                              error_func=self.on_modem_error)
 
+    def show_dashboard(self):
+        """Show the overview of all modems"""
+        if not self.dashboard_window:
+            self.dashboard_window = PPMDashboard(self.dashboard)
+        self.dashboard_window.present()
+        self.refresh_dashboard()
+
+    def refresh_dashboard(self):
+        """Query the balances of all modems but the current one"""
+        refresher = self.dashboard_refresher
+        if not refresher or not self.mm.modem:
+            return
+        for modem in self.mm.modems:
+            if (refresher.modem_filter(modem) and
+                    modem.path not in refresher.pending):
+                refresher.refresh(modem)
+
+    def on_dashboard_result(self, result):
+        if result['error']:
+            self.dashboard.update(result['modem'],
+                                  account=result['identifier'],
+                                  provider=result['provider'],
+                                  state=result['error'])
+        else:
+            self.dashboard.update(result['modem'],
+                                  account=result['identifier'],
+                                  provider=result['provider'],
+                                  balance=result['balance'],
+                                  updated=time.asctime(
+                                      time.localtime(result['timestamp'])),
+                                  state=None)
+
+    def enable_metrics(self, address):
+        """Serve balance and modem metrics on address"""
+        self.metrics = MetricsExporter(self.request_stats,
+                                       governor=self.governor)
+        self.metrics.listen(address)
+
+    def _update_modem_metrics(self):
+        modem = self.mm.modem if self.mm else None
+        if not modem or not modem.modem_proxy:
+            return
+        if self.metrics:
+            self.metrics.update_modem(modem.path, modem.enabled)
+        self.dashboard.update(modem.path,
+                              state=_("enabled") if modem.enabled
+                              else _("disabled"))
+
     def quit(self):
-        """Clean up"""
+        """Clean up, called once the main window is gone"""
         logging.debug("Quitting...")
-        self.view.close()
+        self.timeouts.save()
+        self.snapshot.save()
+        self.journal.close()
+        if self.metrics:
+            self.metrics.close()
         Gtk.main_quit()
 
     def get_provider_countries(self):
@@ -257,22 +541,80 @@ class PPMController(Gtk.Application):
     def get_country_by_code(self, code):
         return self.providerdb.get_country_by_code(code)
 
-    def on_mm_request_started(self, obj, mm_proxy):
-        logging.debug("Started modem request: %s", mm_proxy.request)
+    def search_providers(self, query, kind=None, country_code=None):
+        return self.providerdb.search(query, kind=kind,
+                                      country_code=country_code)
+
+    def on_mm_request_started(self, obj, request):
+        logging.debug("Started modem request: %s", request)
         self.view.show_modem_response()
 
-    def on_mm_request_finished(self, obj, mm_proxy):
+    def on_mm_request_finished(self, obj, request):
         logging.debug("Finished modem request")
         self.view.close_modem_response()
+        self._update_modem_metrics()
 
-    def on_balance_info_fetched(self, var, user_data):
+    def on_mm_session_started(self, obj, session):
+        logging.debug("Started modem session: %s", session.name)
+        self.view.show_modem_response()
+
+    def on_mm_session_finished(self, obj, session):
+        logging.debug("Finished modem session: %s", session.name)
+        self.view.close_modem_response()
+        self._update_modem_metrics()
+
+    def on_balance_info_fetched(self, var, user_data, key=None):
         """Callback for succesful MM fetch balance info call"""
         balance = var.unpack()[0]
         self.emit('balance-info-changed', balance)
 
+        timestamp = self.account.props.timestamp if self.account else time.asctime()
+        for (reply_func, error_func) in self.balance_requests.pop(key, []):
+            if reply_func:
+                reply_func(balance, timestamp)
+
+    def on_balance_info_error(self, e, key=None):
+        """Callback for failed MM fetch balance info call"""
+        if self.scheduler:
+            self.scheduler.finished(key, ok=False)
+        show = False
+        for (reply_func, error_func) in self.balance_requests.pop(key, []):
+            if error_func:
+                error_func(e)
+            else:
+                # Only the user's own queries come without an error handler
+                show = True
+        if show:
+            self.on_modem_error(e)
+
+    def on_refresh_error(self, e):
+        logging.warning("Background balance refresh failed: %s", e.msg)
+
+    def on_refresh_due(self, identifier, data):
+        """The scheduler wants the balance of identifier refreshed"""
+        if not self.account or self.account.props.identifier != identifier:
+            # The SIM card changed
+            self.scheduler.remove(identifier)
+            return
+        modem = self.mm.modem if self.mm else None
+        if (not self.provider or not modem or not modem.modem_proxy or
+                not modem.enabled):
+            logging.debug("Modem not ready, not refreshing '%s'", identifier)
+            self.scheduler.finished(identifier, ok=False)
+            return
+        logging.debug("Refreshing balance of '%s'", identifier)
+        try:
+            started = self._request_balance((None, self.on_refresh_error))
+        except Exception:
+            logging.exception("Refreshing balance of '%s' failed", identifier)
+            started = False
+        if not started:
+            self.scheduler.finished(identifier, ok=False)
+
     def on_balance_topped_up(self, var, user_data):
         """Callback for succesful MM topup balance call"""
         reply = var.unpack()[0]
+        self._journal(Journal.TOP_UP_CONFIRMED, reply=reply)
         self.view.update_top_up_information(reply)
 
     def on_modem_enable(self, var, user_data):
@@ -286,9 +628,15 @@ class PPMController(Gtk.Application):
 
     def on_modem_error(self, e):
         logging.error(e.msg)
+        if isinstance(e, ModemDisabledError):
+            self.view.show_modem_enable()
+            return
+
         self.view.show_modem_error(e.msg)
-        # The modem might have disconnected. So reschedule the setup
-        self.schedule_setup()
+        # Only start over if the modem disconnected, timeouts and other
+        # transient failures are just reported
+        if isinstance(e, ModemGoneError):
+            self.schedule_setup()
 
     def on_provider_changed(self, obj, provider):
         """Act on provider-changed signal"""
@@ -297,9 +645,16 @@ class PPMController(Gtk.Application):
         self.view.update_provider_name(provider.name)
         self.view.update_topup_length(provider.top_up_code_length)
 
+        if not self.account or (self.account.props.code,
+                                self.account.props.name) != (provider.country,
+                                                             provider.name):
+            self._journal(Journal.PROVIDER_ASSIGNED, country=provider.country,
+                          name=provider.name)
         if self.imsi and not self.account:
             # We have an imsi and the user told us what provider to use:
             self.account = self.accountdb.add(self.imsi, provider)
+            self._publish_account()
+            self._schedule_refresh()
         elif self.account:
             # Update an existing account with the user provided information
             self.account.update_provider(provider)
@@ -307,6 +662,19 @@ class PPMController(Gtk.Application):
                 self.view.update_account_balance_information(
                     self.account.balance,
                     self.account.timestamp)
+            self._publish_account()
+            self._schedule_refresh()
+
+    def on_providerdb_changed(self, obj):
+        """Pick up new commands for the current provider"""
+        if not self.provider:
+            return
+        try:
+            self.set_provider(country_code=self.provider.country,
+                              name=self.provider.name)
+        except Exception:
+            logging.warning("Provider '%s' in '%s' vanished from the provider "
+                            "database", self.provider.name, self.provider.country)
 
     def on_balance_info_changed(self, obj, balance):
         """Act on balance-info-changed signal"""
@@ -314,10 +682,32 @@ class PPMController(Gtk.Application):
 
         timestamp = time.asctime()
         if self.account:
+            self._journal(Journal.BALANCE_RECEIVED, balance=balance,
+                          timestamp=timestamp)
             self.account.update_balance(balance, timestamp)
+            try:
+                self.history.add_account(self.account)
+            except sqlite3.Error as err:
+                logging.warning("Failed to record balance history: %s", err)
+            self._publish_account()
+            if self.scheduler:
+                self.scheduler.finished(self.account.props.identifier,
+                                        amount=self.account.amount)
+            threshold = self.low_balance.check(self.account)
+            if threshold is not None:
+                self.emit('balance-low', self.account, self.account.amount,
+                          threshold)
 
         self.view.update_account_balance_information(balance, timestamp)
 
+    def on_balance_low(self, obj, account, amount, threshold):
+        """Act on balance-low signal"""
+        logging.warning("Balance of '%s' is %s, below %s",
+                        account.props.identifier, amount, threshold)
+        hook = self.accountdb.low_balance_hook
+        if hook:
+            run_hook(hook, account, amount, threshold)
+
 # Views
 @Gtk.Template.from_resource('/org/gnome/PrepaidManager/ui/ppm-error-dialog.ui')
 class PPMErrorDialog(Gtk.Dialog):
@@ -381,6 +771,12 @@ class PPMDialog(Gtk.ApplicationWindow):
 
         self.add_action(action)
 
+        action = Gio.SimpleAction(name='dashboard')
+        action.set_enabled(True)
+        action.connect('activate', self.on_dashboard_activated, None)
+
+        self.add_action(action)
+
     def __init__(self, controller):
         Gtk.ApplicationWindow.__init__(self)
         self.code_len = 0
@@ -390,8 +786,12 @@ class PPMDialog(Gtk.ApplicationWindow):
 
         self._add_actions()
         self._setup_ui()
+        self.connect('destroy', self.on_destroy)
         self.show()
 
+    def on_destroy(self, widget):
+        self.controller.quit()
+
     @property
     def info_bar_container(self):
         """The widget that contains the main info bar"""
@@ -408,6 +808,9 @@ class PPMDialog(Gtk.ApplicationWindow):
     def on_about_activated(self, *argv):
         self.about_dialog.show()
 
+    def on_dashboard_activated(self, *argv):
+        self.controller.show_dashboard()
+
     @Gtk.Template.Callback("on_balance_info_renew_clicked")
     def on_balance_info_renew_clicked(self, dummy):
         self.controller.fetch_balance()
@@ -525,30 +928,49 @@ class PPMEnableModemInfoBar(PPMInfoBar):
 
 
 class PPMModemResponseInfoBar(PPMInfoBar):
-    """Info bar used when waiting for a modem response"""
+    """
+    Info bar used when waiting for a modem response
+
+    Every request shows the bar and hides it once done, the bar stays
+    until the last pending request finished. The spinner is animated by
+    GTK's frame clock so nothing runs while the bar is hidden.
+
+    @ivar pending: number of requests awaiting a response
+    """
     def __init__(self, view):
         PPMInfoBar.__init__(self, view)
+        self.pending = 0
         self.info_bar.set_message_type(Gtk.MessageType.INFO)
-        self.progressbar = Gtk.ProgressBar(text=_("Awaiting modem response..."))
-        self.progressbar.set_show_text(True)
+        self.spinner = Gtk.Spinner()
+        self.label = Gtk.Label(label=_("Awaiting modem response..."))
         content_area = self.info_bar.get_content_area()
-        content_area.add(self.progressbar)
+        content_area.add(self.spinner)
+        content_area.add(self.label)
+
+    def _update_label(self):
+        if self.pending > 1:
+            self.label.set_text(ngettext("Awaiting %d modem response...",
+                                         "Awaiting %d modem responses...",
+                                         self.pending) % self.pending)
+        else:
+            self.label.set_text(_("Awaiting modem response..."))
 
     def show(self):
-        logging.debug("Awaiting modem resonse")
-        self.timer = GLib.timeout_add(50, self.do_progress,
-                                      priority=GLib.PRIORITY_HIGH)
-        PPMInfoBar.show(self)
+        logging.debug("Awaiting modem response")
+        self.pending += 1
+        self._update_label()
+        if self.pending == 1:
+            PPMInfoBar.show(self)
+            self.spinner.start()
 
     def hide(self):
-        if self.timer:
-            GLib.source_remove(self.timer)
-            self.timer = None
-        PPMInfoBar.hide(self)
-
-    def do_progress(self):
-        self.progressbar.pulse()
-        return True
+        if not self.pending:
+            return
+        self.pending -= 1
+        self._update_label()
+        if not self.pending:
+            self.spinner.stop()
+            PPMInfoBar.hide(self)
 
 
 class PPMNoModemFoundInfoBar(PPMInfoBar):
@@ -567,6 +989,33 @@ class PPMNoModemFoundInfoBar(PPMInfoBar):
         self.controller.schedule_setup()
 
 
+@Gtk.Template.from_resource('/org/gnome/PrepaidManager/ui/ppm-dashboard.ui')
+class PPMDashboard(Gtk.ApplicationWindow):
+    """Overview of all modems, their accounts and balances"""
+    __gtype_name__ = "PPMDashboard"
+
+    treeview_dashboard = Gtk.Template.Child()
+
+    def __init__(self, model):
+        Gtk.ApplicationWindow.__init__(self)
+        self.model = model
+        self.treeview_dashboard.set_model(model.store)
+        self.connect('map', self.on_map)
+        self.connect('unmap', self.on_unmap)
+
+    def on_map(self, widget):
+        self.model.attach(self)
+
+    def on_unmap(self, widget):
+        # Keep collecting updates while hidden
+        self.model.detach()
+
+    @Gtk.Template.Callback("on_delete_event")
+    def on_delete_event(self, widget, event):
+        self.hide()
+        return True
+
+
 @Gtk.Template.from_resource('/org/gnome/PrepaidManager/ui/ppm-provider-assistant.ui')
 class PPMProviderAssistant(Gtk.Assistant):
     PAGE_INTRO, PAGE_COUNTRIES, PAGE_PROVIDERS, PAGE_CONFIRM = list(range(0, 4))
@@ -578,6 +1027,10 @@ class PPMProviderAssistant(Gtk.Assistant):
     vbox_providers = Gtk.Template.Child()
     treeview_providers = Gtk.Template.Child()
     liststore_providers = Gtk.Template.Child()
+    filter_countries = Gtk.Template.Child()
+    filter_providers = Gtk.Template.Child()
+    entry_search_countries = Gtk.Template.Child()
+    entry_search_providers = Gtk.Template.Child()
     label_country = Gtk.Template.Child()
     label_provider = Gtk.Template.Child()
 
@@ -589,16 +1042,56 @@ class PPMProviderAssistant(Gtk.Assistant):
         self.provider = None
         self.possible_providers = None
         self.providers_initialized = False
+        # The provider database changed while we were shown
+        self.lists_stale = False
+        # Country codes and provider names matching the current search,
+        # None shows all rows
+        self.visible_countries = None
+        self.visible_providers = None
+        self.filter_countries.set_visible_func(self._country_visible_func)
+        self.filter_providers.set_visible_func(self._provider_visible_func)
         self.controller = Gio.Application.get_default()
+        self.controller.providerdb.connect('changed', self.on_providerdb_changed)
+
+    def on_providerdb_changed(self, providerdb):
+        """Refill the lists next time they're shown"""
+        if self.get_visible():
+            # Don't pull the rows away under the user
+            self.lists_stale = True
+            return
+        self._forget_lists()
+
+    def _forget_lists(self):
+        self.lists_stale = False
+        if self.liststore_countries:
+            self.liststore_countries.clear()
+            self.liststore_countries = None
+        self.providers_initialized = False
 
     def _get_current_country_from_locale(self):
         (l, enc) = locale.getlocale()
-        code = l.lower().split('_')[0]
+        if not l:
+            return None
+        # Use the territory if present (de_AT -> at), the language otherwise
+        code = l.lower().split('_')[-1]
         logging.debug("Assuming your in country %s" % code)
         return code
 
+    def _country_visible_func(self, model, iter, data):
+        if self.visible_countries is None:
+            return True
+        return model.get_value(iter, 1) in self.visible_countries
+
+    def _provider_visible_func(self, model, iter, data):
+        if self.visible_providers is None:
+            return True
+        return model.get_value(iter, 0) in self.visible_providers
+
     def _select_country_row(self, iter):
-        path = self.liststore_countries.get_path(iter)
+        path = self.filter_countries.convert_child_path_to_path(
+            self.liststore_countries.get_path(iter))
+        if path is None:
+            return
         treeselection = self.treeview_countries.get_selection()
         treeselection.select_path(path)
         self.treeview_countries.scroll_to_cell(path)
@@ -606,18 +1099,23 @@ class PPMProviderAssistant(Gtk.Assistant):
 
     def _fill_liststore_countries(self):
         """Fille the countries liststore with all known countries"""
+        if self.liststore_countries:
+            return
+
         lcode = self._get_current_country_from_locale()
-        if not self.liststore_countries:
-            self.liststore_countries = self.treeview_countries.get_model()
-            for (country, code) in self.controller.get_provider_countries():
-                if country is None:
-                    country = code
-                iter = self.liststore_countries.append()
-                self.liststore_countries.set_value(iter, 0, country)
-                self.liststore_countries.set_value(iter, 1, code)
-                if code == lcode:
-                    self.country_code = code
-                    self._select_country_row(iter)
+        selected = None
+        self.liststore_countries = self.filter_countries.get_model()
+        # Detach the model so the view doesn't update on every row
+        self.treeview_countries.set_model(None)
+        for (country, code) in self.controller.get_provider_countries():
+            iter = self.liststore_countries.append([country, code])
+            if code == lcode:
+                selected = iter
+        self.treeview_countries.set_model(self.filter_countries)
+
+        if selected:
+            self.country_code = lcode
+            self._select_country_row(selected)
 
     def _providers_only_page_func(self, current_page, user_data):
         if current_page < self.PAGE_PROVIDERS:
@@ -629,9 +1127,13 @@ class PPMProviderAssistant(Gtk.Assistant):
         return current_page + 1
 
     def show(self, providers=None):
+        if self.lists_stale:
+            self._forget_lists()
         self.possible_providers = providers
         self.provider = None
         self.providers_initialized = False
+        self.entry_search_countries.set_text('')
+        self.entry_search_providers.set_text('')
 
         if not self.possible_providers:
             # No list of possible providers so allow to select the country first
@@ -652,19 +1154,46 @@ class PPMProviderAssistant(Gtk.Assistant):
         logging.debug("Assistant canceled.")
         self.close()
 
-    def _fill_provider_liststore_by_country_code(self, country_code):
+    def _fill_provider_liststore(self, names):
+        self.treeview_providers.set_model(None)
         self.liststore_providers.clear()
-        for provider in self.controller.get_provider_providers(country_code):
-            iter = self.liststore_providers.append()
-            self.liststore_providers.set_value(iter, 0, provider)
+        for name in sorted(names, key=locale.strxfrm):
+            self.liststore_providers.append([name])
+        self.treeview_providers.set_model(self.filter_providers)
+        # The search might have been for another country
+        self.on_entry_search_providers_changed(self.entry_search_providers)
+
+    def _fill_provider_liststore_by_country_code(self, country_code):
+        self._fill_provider_liststore(
+            self.controller.get_provider_providers(country_code))
 
     def _fill_provider_liststore_by_providers(self):
-        self.liststore_providers.clear()
-        for provider in self.possible_providers:
-            iter = self.liststore_providers.append()
-            self.liststore_providers.set_value(iter,
-                                               0,
-                                               provider.name)
+        self._fill_provider_liststore(
+            [provider.name for provider in self.possible_providers])
+
+    @Gtk.Template.Callback("on_entry_search_countries_changed")
+    def on_entry_search_countries_changed(self, entry):
+        query = entry.get_text()
+        if query.strip():
+            # Also show the countries of matching providers
+            self.visible_countries = set(
+                match.code for match in self.controller.search_providers(query))
+        else:
+            self.visible_countries = None
+        self.filter_countries.refilter()
+
+    @Gtk.Template.Callback("on_entry_search_providers_changed")
+    def on_entry_search_providers_changed(self, entry):
+        query = entry.get_text()
+        if query.strip():
+            self.visible_providers = set(
+                match.provider for match in
+                self.controller.search_providers(query,
+                                                 kind='provider',
+                                                 country_code=self.country_code))
+        else:
+            self.visible_providers = None
+        self.filter_providers.refilter()
 
     @Gtk.Template.Callback("on_ppm_provider_assistant_prepare")
     def on_ppm_provider_assistant_prepare(self, obj, page):
@@ -763,12 +1292,13 @@ class PPMProviderInfoMissingDialog(object):
 
 
 def setup_i18n():
-    global _
+    global _, ngettext
     locale.setlocale(locale.LC_ALL, '')
     gettext.install(ppm.gettext_app, ppm.gettext_dir)
     gettext.bindtextdomain(ppm.gettext_app, ppm.gettext_dir)
     locale.bindtextdomain(ppm.gettext_app, ppm.gettext_dir)
     _ = gettext.gettext
+    ngettext = gettext.ngettext
     logging.debug('Using locale: %s', locale.getlocale())
 
 
@@ -783,6 +1313,13 @@ def main(args):
     parser = GLib.option.OptionParser()
     parser.add_option("--debug", "-d", action="store_true", dest="debug",
                       help="enable debugging", default=False)
+    parser.add_option("--metrics", dest="metrics", metavar="ADDRESS",
+                      help="serve metrics on [host]:port or a unix socket path",
+                      default=None)
+    parser.add_option("--profile", dest="profile", metavar="FILE",
+                      help="write cProfile data to FILE and a timeline of "
+                           "startup phases to FILE.spans on exit",
+                      default=None)
     options, args = parser.parse_args()
 
     if options.debug:
@@ -793,12 +1330,35 @@ def main(args):
     logging.basicConfig(level=log_level,
                         format='ppm: %(levelname)s: %(message)s')
     logging.debug("%s %s", ppm.app_id, ppm.version)
+    if options.profile:
+        profiling.enable(options.profile)
 
     setup_i18n()
     setup_prgname()
 
     controller = PPMController()
+    remote = False
+    try:
+        controller.register(None)
+        remote = controller.get_is_remote()
+    except GLib.Error as err:
+        logging.warning("Failed to register on the session bus: %s", err)
+    if remote:
+        # Only the primary instance may touch the modems and the journal
+        logging.info("Already running, showing the running instance")
+        controller.activate()
+        return
+    controller.journal.replay()
     PPMDialog(controller)
+    if options.metrics:
+        try:
+            controller.enable_metrics(options.metrics)
+        except MetricsError as err:
+            logging.error(err.msg)
+            sys.exit(1)
+        except GLib.Error as err:
+            logging.error("Can't serve metrics: %s", err.message)
+            sys.exit(1)
     controller.schedule_setup()
 
     Gtk.main()